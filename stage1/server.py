@@ -1,23 +1,17 @@
 import socket
-from datetime import datetime
+import time
+from collections import OrderedDict
 
-class User:
-    def __init__(self, username):
-        self.username = username
-        self.last_visited_time = datetime.now()
-        self.exists = True
-
-    def update_last_visited_time(self):
-        self.last_visited_time = datetime.now()
-
-    def is_session_active(self):
-        timeout_seconds = 60
-        time_difference = datetime.now() - self.last_visited_time
-        return time_difference.seconds <= timeout_seconds
+from user import User
 
 class Server:
     def __init__(self):
-        self.clients = {}
+        # 生存中のクライアントだけを最終アクセスが古い順に保持する
+        # (発言したクライアントを末尾に移すので、先頭から見ればタイムアウトしたものを順に取り除ける)
+        self.clients = OrderedDict()
+        # 中継先アドレスのキャッシュ(参加・退出したときだけ作り直す)
+        self.recipients = ()
+        self.timeout_seconds = 60
         self.server_address = ("0.0.0.0", 9001)
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.server_socket.bind(self.server_address)
@@ -35,40 +29,49 @@ class Server:
             self.server_socket.close()
 
     def handle_client_message(self, client_message, send_client_address):
+        now = time.monotonic()
+        self.evict_inactive_clients(now)
+        # タイムアウトで取り除かれたクライアントは、次のメッセージをユーザー名として参加し直す
         if send_client_address not in self.clients:
-            self.register_new_client(client_message, send_client_address)
+            self.register_new_client(client_message, send_client_address, now)
         else:
-            self.process_client_message(client_message, send_client_address)
+            self.process_client_message(client_message, send_client_address, now)
 
-    def register_new_client(self, client_message, send_client_address):
-        self.clients[send_client_address] = User(client_message)
+    def register_new_client(self, client_message, send_client_address, now=None):
+        self.clients[send_client_address] = User(client_message, now)
+        self.recipients = tuple(self.clients)
         print("Session in user: " + self.clients[send_client_address].username)
 
-    def process_client_message(self, client_message, send_client_address):
-        client = self.clients[send_client_address]
+    def evict_inactive_clients(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        evicted = False
+        while self.clients:
+            address, client = next(iter(self.clients.items()))
+            if client.is_session_active(now, self.timeout_seconds):
+                break
+            del self.clients[address]
+            evicted = True
+            print("Session out user: " + client.username)
+        if evicted:
+            self.recipients = tuple(self.clients)
 
-        if not client.exists:
-            return
+    def process_client_message(self, client_message, send_client_address, now=None):
+        client = self.clients[send_client_address]
 
-        if not client.is_session_active():
-            client.exists = False
-            print("Session out user: " + client.username)
-            return
-        
         if client_message:
-            client.update_last_visited_time()
+            client.update_last_visited_time(now)
+            self.clients.move_to_end(send_client_address)
             response_message = client.username + ": " + client_message
             self.relay_message(response_message, send_client_address)
 
     def relay_message(self, message, sender_address):
-        for receive_client_address, client in self.clients.items():
-            if not client.is_session_active():
-                client.exists = False
-                print("Session out user: " + client.username)
-                continue
+        # エンコードは1回だけ行い、生存中のクライアントにだけ送る
+        data = message.encode("utf-8")
+        for receive_client_address in self.recipients:
             if sender_address == receive_client_address:
                 continue
-            self.server_socket.sendto(message.encode("utf-8"), receive_client_address)
+            self.server_socket.sendto(data, receive_client_address)
 
 if __name__ == "__main__":
     try:
@@ -1,15 +1,18 @@
-from datetime import datetime
+import time
 
 class User:
-    def __init__(self, username):
+    # 大量のセッションを保持してもメモリが増えすぎないよう属性を固定する
+    __slots__ = ("username", "last_visited_time")
+
+    def __init__(self, username, now=None):
         self.username = username
-        self.last_visited_time = datetime.now()
-        self.exists = True
+        # 時刻は単調時計で持つ(システム時刻の変更に影響されない)
+        self.last_visited_time = time.monotonic() if now is None else now
 
-    def update_last_visited_time(self):
-        self.last_visited_time = datetime.now()
+    def update_last_visited_time(self, now=None):
+        self.last_visited_time = time.monotonic() if now is None else now
 
-    def is_session_active(self):
-        timeout_seconds = 60
-        time_defference = datetime.now() - self.last_visited_time
-        return time_defference.seconds <= timeout_seconds
\ No newline at end of file
+    def is_session_active(self, now=None, timeout_seconds=60):
+        if now is None:
+            now = time.monotonic()
+        return now - self.last_visited_time <= timeout_seconds
@@ -0,0 +1,426 @@
+import asyncio
+import itertools
+import json
+
+import control
+import fragment
+import handshake
+import history
+import packet
+import reliable
+import tcrp
+
+# TCRPのアクション番号
+CREATE_ROOM = 1
+JOIN_ROOM = 2
+FETCH_HISTORY = 4
+CONTROL_CHANNEL = 5
+LEAVE_ROOM = 6
+LIST_ROOMS = 7
+
+# 受信イベントの種類
+MESSAGE = "message"
+LEFT = "left"
+CLOSED = "closed"
+
+EVENT_TYPES = {
+    packet.KIND_DATA: MESSAGE,
+    packet.KIND_LEFT: LEFT,
+    packet.KIND_CLOSED: CLOSED,
+}
+
+
+class Event:
+    """セッションが受信したイベント
+
+    type: MESSAGE(発言)、LEFT(参加者の退出)、CLOSED(ホスト退出による部屋の終了)
+    session_id: 発言・退出した参加者のセッションID(従来形式のテキストを受信した場合はNone)
+    text: 表示用のテキスト("ユーザー名: メッセージ"または通知文)
+    """
+
+    __slots__ = ("type", "room_name", "session_id", "text")
+
+    def __init__(self, type, room_name, session_id, text):
+        self.type = type
+        self.room_name = room_name
+        self.session_id = session_id
+        self.text = text
+
+    def __repr__(self):
+        return f"Event({self.type!r}, {self.room_name!r}, {self.session_id!r}, {self.text!r})"
+
+
+class SessionProtocol(asyncio.DatagramProtocol):
+    """セッションのUDPソケットで受信したデータグラムをセッションに渡す"""
+
+    def __init__(self):
+        self.session = None
+
+    def datagram_received(self, data, addr):
+        if self.session is not None:
+            self.session.datagram_received(data)
+
+
+class Session:
+    """1つのチャットルームへの参加(信頼モード)
+
+    UDPソケットはセッションごとに1つ持つが、スレッドは使わずイベントループ上で送受信する。
+    受信したイベントは async for で取り出す。退出・部屋の終了で反復が終わる。
+    """
+
+    def __init__(self, client, room_name, user_name, transport, response, history_messages):
+        self.client = client
+        self.room_name = room_name
+        self.user_name = user_name
+        self.transport = transport
+        self.token = response["token"]
+        self.session_id = response["session_id"]
+        # メッセージの送信先(クラスター構成では部屋を担当するノード)
+        self.udp_address = (
+            tuple(response["udp_address"])
+            if response.get("udp_address") is not None
+            else client.udp_address
+        )
+        # データグラムにMACを付けるセッション鍵
+        self.mac_key = packet.session_key(self.token)
+        # 入室時に取得した履歴(テキストのリスト)
+        self.history = history_messages
+        self.receiver = reliable.ReliableReceiver(nack_interval=client.nack_interval)
+        self.receiver.start(response["sequence"])
+        self.events = asyncio.Queue()
+        self.client_sequence = 0
+        # 1つのデータグラムに収まらないメッセージは断片に分けて送り、受信側で組み立てる
+        self.message_id = 0
+        self.reassembler = fragment.Reassembler()
+        # 送信中のメッセージのACK待ち(ClientSeq -> Future)
+        self.acks = {}
+        # サーバーは重複排除のためClientSeqの順に受け付けるので、1件ずつ送る
+        self.send_lock = asyncio.Lock()
+        self.nack_timer = None
+        self.closed = False
+
+    def datagram_received(self, data):
+        """受信したデータグラムをイベントに変換する
+
+        :param data: 受信データ
+        """
+        if self.closed:
+            return
+        for datagram in packet.split_datagrams(data):
+            if datagram[0] != packet.COMPACT_MARKER:
+                # 信頼モードでない通知(テキスト)
+                self.__emit(packet.KIND_DATA, None, datagram)
+                continue
+            if datagram[1] == packet.KIND_ACK:
+                _, _, client_sequence, room_sequence = packet.SEQUENCED_HEADER.unpack_from(
+                    datagram
+                )
+                future = self.acks.get(client_sequence)
+                if future is not None and not future.done():
+                    future.set_result(None)
+                # 自分のメッセージの連番は届かないので欠落として扱わない
+                delivered = self.receiver.skip(room_sequence)
+            else:
+                delivered = self.receiver.receive(datagram)
+            for kind, session_id, message in delivered:
+                if kind == packet.KIND_FRAGMENT:
+                    message = self.reassembler.add(session_id, message)
+                    if message is None:
+                        continue
+                    kind = packet.KIND_DATA
+                self.__emit(kind, session_id, message)
+        if not self.closed:
+            self.__request_missing()
+
+    def __emit(self, kind, session_id, message):
+        """イベントを受信キューに入れる(自分の退出・部屋の終了ならセッションを閉じる)"""
+        event = Event(
+            EVENT_TYPES.get(kind, MESSAGE),
+            self.room_name,
+            session_id,
+            bytes(message).decode("utf-8", "replace"),
+        )
+        self.events.put_nowait(event)
+        if event.type == CLOSED or (event.type == LEFT and session_id == self.session_id):
+            self.close()
+
+    def __on_nack_timer(self):
+        self.nack_timer = None
+        if not self.closed:
+            self.__request_missing()
+
+    def __request_missing(self):
+        """欠落があれば再送要求を送り、埋まるまでnack_intervalごとに送り直す"""
+        ranges = self.receiver.missing_ranges()
+        if ranges:
+            self.transport.sendto(
+                packet.pack_nack(self.session_id, ranges, self.mac_key), self.udp_address
+            )
+        if self.receiver.expected is not None and self.receiver.expected <= self.receiver.latest:
+            if self.nack_timer is None:
+                self.nack_timer = asyncio.get_running_loop().call_later(
+                    self.receiver.nack_interval, self.__on_nack_timer
+                )
+
+    async def send(self, text):
+        """メッセージを送信し、サーバーが受け付けるまで再送する
+
+        :param text: メッセージ
+        """
+        async with self.send_lock:
+            if self.closed:
+                raise ConnectionError("session is closed")
+            encoded_text = text.encode("utf-8")
+            if len(encoded_text) <= packet.FRAGMENT_SIZE:
+                await self.__send_reliable(*packet.compress_message(encoded_text))
+                return
+            # サーバーは展開後の長さを制限するので、断片に分けるかは圧縮前の長さで決める。
+            # 断片は圧縮せずに1つずつ送る
+            self.message_id += 1
+            for fragment_data in packet.pack_fragments(encoded_text, self.message_id):
+                await self.__send_reliable(fragment_data, packet.FLAG_FRAGMENT)
+
+    async def __send_reliable(self, message, flags):
+        """ACKが届くまで再送する(send_lockを保持して呼ぶ)
+
+        :param message: エンコード済みのメッセージまたは断片
+        :param flags: フラグ
+        """
+        self.client_sequence += 1
+        client_sequence = self.client_sequence
+        datagram = packet.pack_reliable(
+            self.session_id, client_sequence, message, self.mac_key, flags
+        )
+        future = self.acks[client_sequence] = asyncio.get_running_loop().create_future()
+        try:
+            for _ in range(self.client.max_retries):
+                self.transport.sendto(datagram, self.udp_address)
+                try:
+                    await asyncio.wait_for(asyncio.shield(future), self.client.ack_timeout)
+                    return
+                except asyncio.TimeoutError:
+                    continue
+        finally:
+            del self.acks[client_sequence]
+        raise TimeoutError(f"message {client_sequence} was not acknowledged")
+
+    async def leave(self):
+        """チャットルームから退出する(ホストの場合は部屋を終了する)"""
+        if not self.closed:
+            await self.client.request(
+                LEAVE_ROOM,
+                self.room_name,
+                json.dumps({"token": self.token}).encode("utf-8"),
+            )
+        self.close()
+
+    def close(self):
+        """UDPソケットを閉じ、イベントの反復を終える"""
+        if self.closed:
+            return
+        self.closed = True
+        if self.nack_timer is not None:
+            self.nack_timer.cancel()
+        self.transport.close()
+        self.events.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self.events.get()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+
+class ChatClient:
+    """asyncioで使うヘッドレスのクライアント
+
+    部屋の作成・参加・退出は1本のコントロールチャネルでパイプライン化して送り、
+    参加した部屋ごとにSessionを返す。1プロセスで多数のセッションを扱える。
+    """
+
+    # 状態コード
+    REQUEST_OF_RESPONSE = 1
+    REQUEST_COMPLETION = 2
+
+    def __init__(
+        self,
+        tcp_address=("127.0.0.1", 9002),
+        udp_address=("127.0.0.1", 9003),
+        local_host="127.0.0.1",
+        ack_timeout=0.5,
+        max_retries=10,
+        nack_interval=0.2,
+        timeout=5.0,
+    ):
+        """
+        :param tcp_address: サーバーのTCPアドレス
+        :param udp_address: サーバーのUDPアドレス(入室レスポンスで送信先が通知されなければ使う)
+        :param local_host: セッションのUDPソケットをバインドするアドレス(サーバーから届くこと)
+        :param ack_timeout: 送信したメッセージのACKを待つ時間(秒)
+        :param max_retries: ACKが届かない場合に送り直す回数
+        :param nack_interval: 欠落の再送要求を送り直す間隔(秒)
+        :param timeout: 接続・レスポンスのタイムアウト(秒)
+        """
+        self.tcp_address = tcp_address
+        self.udp_address = udp_address
+        self.local_host = local_host
+        self.ack_timeout = ack_timeout
+        self.max_retries = max_retries
+        self.nack_interval = nack_interval
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.request_ids = itertools.count(1)
+        # レスポンス待ち(リクエストID -> Future)
+        self.responses = {}
+        self.reader_task = None
+
+    async def connect(self):
+        """コントロールチャネルを開く"""
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(*self.tcp_address), self.timeout
+        )
+        self.writer.write(tcrp.pack_header(0, CONTROL_CHANNEL, 0, 0))
+        header = await asyncio.wait_for(
+            self.reader.readexactly(tcrp.HEADER_BYTE_SIZE), self.timeout
+        )
+        _, operation, state, payload_size = tcrp.unpack_header(header)
+        payload = await self.reader.readexactly(payload_size)
+        if operation != CONTROL_CHANNEL or state != self.REQUEST_OF_RESPONSE:
+            self.writer.close()
+            raise ConnectionError(payload.decode("utf-8", "replace"))
+        self.reader_task = asyncio.create_task(self.__read_responses())
+
+    async def __read_responses(self):
+        """レスポンスを受信し、リクエストIDに対応する待ち手に渡す"""
+        error = ConnectionError("control channel closed")
+        try:
+            while True:
+                request_id, length = control.unpack_frame_header(
+                    await self.reader.readexactly(control.FRAME_HEADER.size)
+                )
+                message = await self.reader.readexactly(length)
+                future = self.responses.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result(control.split_responses(message))
+        except (asyncio.IncompleteReadError, OSError, ValueError) as e:
+            error = ConnectionError(f"control channel closed: {e!r}")
+        finally:
+            for future in self.responses.values():
+                if not future.done():
+                    future.set_exception(error)
+            self.responses.clear()
+
+    async def request(self, operation, room_name, payload):
+        """コントロールチャネルでリクエストを送り、レスポンスを待つ
+
+        複数のタスクから同時に呼べる(レスポンスを待たずに次のリクエストを送る)。
+
+        :param operation: アクション番号
+        :param room_name: チャットルーム名
+        :param payload: OperationPayload(byte)
+        :return: [(アクション番号, 状態コード, ペイロード)]
+        """
+        if self.reader_task is None or self.reader_task.done():
+            raise ConnectionError("control channel is not connected")
+        request_id = next(self.request_ids)
+        future = self.responses[request_id] = asyncio.get_running_loop().create_future()
+        encoded_room_name = room_name.encode("utf-8")
+        header = tcrp.pack_header(len(encoded_room_name), operation, 0, len(payload))
+        try:
+            self.writer.write(control.pack_frame(request_id, header + encoded_room_name + payload))
+            await self.writer.drain()
+            return await asyncio.wait_for(future, self.timeout)
+        finally:
+            # タイムアウトした場合も待ち手を残さない
+            self.responses.pop(request_id, None)
+
+    async def create_room(self, room_name, user_name, history_count=0):
+        """チャットルームを作成して参加する
+
+        :return: Session
+        """
+        return await self.__enter_room(CREATE_ROOM, room_name, user_name, history_count)
+
+    async def join_room(self, room_name, user_name, history_count=0):
+        """チャットルームに参加する
+
+        :param history_count: 入室と同時に取得する履歴の件数
+        :return: Session
+        """
+        return await self.__enter_room(JOIN_ROOM, room_name, user_name, history_count)
+
+    async def __enter_room(self, operation, room_name, user_name, history_count):
+        """UDPソケットを開いてから入室リクエストを送る
+
+        :return: Session
+        """
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.create_datagram_endpoint(
+            SessionProtocol, local_addr=(self.local_host, 0)
+        )
+        try:
+            responses = await self.request(
+                operation,
+                room_name,
+                handshake.pack_join_request(
+                    user_name,
+                    transport.get_extra_info("sockname"),
+                    history_count,
+                    reliable=True,
+                    compress=True,
+                    udp_address=True,
+                    fragment=True,
+                ),
+            )
+            _, state, payload = responses[0]
+            response = handshake.unpack_join_response(payload, udp_address=True)
+            if state != self.REQUEST_COMPLETION or response["token"] is None:
+                raise RuntimeError(response["message"])
+        except BaseException:
+            transport.close()
+            raise
+        history_messages = [
+            frame.decode("utf-8", "replace")
+            for operation, _, payload in responses[1:]
+            if operation == FETCH_HISTORY
+            for frame in history.unpack_frames(payload)
+        ]
+        session = Session(self, room_name, user_name, transport, response, history_messages)
+        protocol.session = session
+        return session
+
+    async def list_rooms(self, prefix="", contains="", after=None, limit=100):
+        """チャットルームの一覧を取得する
+
+        :return: {"rooms": [{"room_name", "users"}], "next": 次のページのafter}
+        """
+        responses = await self.request(
+            LIST_ROOMS,
+            "",
+            json.dumps(
+                {"prefix": prefix, "contains": contains, "after": after, "limit": limit}
+            ).encode("utf-8"),
+        )
+        return json.loads(responses[0][2].decode("utf-8"))
+
+    async def close(self):
+        """コントロールチャネルを閉じる(セッションは閉じない)"""
+        if self.writer is not None:
+            self.writer.close()
+            await self.reader_task
+
+
+async def connect(tcp_address=("127.0.0.1", 9002), udp_address=("127.0.0.1", 9003), **kwargs):
+    """サーバーに接続したChatClientを作成する
+
+    :param tcp_address: サーバーのTCPアドレス
+    :param udp_address: サーバーのUDPアドレス
+    :return: ChatClient
+    """
+    client = ChatClient(tcp_address, udp_address, **kwargs)
+    await client.connect()
+    return client
@@ -0,0 +1,229 @@
+import asyncio
+import logging
+import time
+
+import control
+import server
+import tcrp
+
+logger = logging.getLogger("chat")
+
+
+class RelayProtocol(asyncio.DatagramProtocol):
+    """UDPメッセージを中継するプロトコル"""
+
+    def __init__(self, chat_server):
+        self.chat_server = chat_server
+
+    def datagram_received(self, data, addr):
+        """データグラム受信時にイベントループ上で処理する
+
+        :param data: 受信データ
+        :param addr: 送信元アドレス
+        """
+        self.chat_server.receive_datagram(data, addr)
+
+    def error_received(self, exc):
+        logger.warning("UDP Error: %s", exc)
+
+
+class AsyncServer(server.Server):
+    """TCRPとUDP中継を1つのイベントループで処理するサーバー
+
+    データグラムごとにスレッドを生成せず、TCP/UDPともに同じイベントループで処理する。
+    TCRPとUDPのワイヤーフォーマットはServerと同一。
+    """
+
+    def __init__(self, **kwargs):
+        if kwargs.get("fanout_workers", 0) > 0:
+            # トランスポートはスレッドセーフでなく、送信ワーカーを待つとイベントループが止まるため、
+            # 送信はイベントループのスレッドで行う
+            logger.warning("fanout_workers is ignored in asyncio mode")
+            kwargs["fanout_workers"] = 0
+        super().__init__(**kwargs)
+        self.udp_transport = None
+        # 受信キューを1回の呼び出しで処理する最大件数(TCP処理などを待たせない)
+        self.INBOUND_BATCH_SIZE = 64
+        self.drain_scheduled = False
+        self.teardown_scheduled = False
+
+    def start(self):
+        """サーバーを起動する"""
+        logger.info("Server started Port: %d (asyncio)", self.tcp_address[1])
+        self.recover_rooms()
+        self.start_metrics()
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.tcp_socket.close()
+            self.udp_socket.close()
+            self.stop_metrics()
+            self.close_message_log()
+            logger.info("Server Closed")
+
+    async def serve(self):
+        """TCP/UDPのハンドラーをイベントループに登録して待機する"""
+        loop = asyncio.get_running_loop()
+        self.udp_transport, _ = await loop.create_datagram_endpoint(
+            lambda: RelayProtocol(self), sock=self.udp_socket
+        )
+        # ソケットがノンブロッキングになるため、送信バッファが一杯のときはトランスポートに任せる
+        self.fanout.on_blocked = self.udp_transport.sendto
+        tcp_server = await asyncio.start_server(
+            self.handle_tcp_conn, sock=self.tcp_socket, backlog=self.listen_backlog
+        )
+        expiry_task = asyncio.create_task(self.expire_idle_sessions())
+        try:
+            async with tcp_server:
+                await tcp_server.serve_forever()
+        finally:
+            expiry_task.cancel()
+            self.udp_transport.close()
+
+    def receive_datagram(self, data, address):
+        """レート制限を確認してから、そのまま処理するか受信キューに入れる
+
+        :param data: 受信データ
+        :param address: 送信元アドレス
+        """
+        if not self.admit(data, address):
+            return
+        if self.inbound_queue is None:
+            self.process_datagram(data, address)
+            return
+        if not self.inbound_queue.put((data, address)):
+            self.metrics.drops.inc(label="queue_full")
+        if not self.drain_scheduled:
+            self.drain_scheduled = True
+            asyncio.get_running_loop().call_soon(self.drain_inbound)
+
+    def drain_inbound(self):
+        """受信キューのデータグラムを一定件数ずつ中継する"""
+        get_nowait = self.inbound_queue.get_nowait
+        for _ in range(self.INBOUND_BATCH_SIZE):
+            item = get_nowait()
+            if item is None:
+                self.drain_scheduled = False
+                return
+            self.process_datagram(*item)
+        # 残りは次のイテレーションで処理する
+        asyncio.get_running_loop().call_soon(self.drain_inbound)
+
+    def schedule_flush(self, room, batch_id):
+        """送信待ちをまとめる時間が過ぎたらイベントループ上で送信する
+
+        :param room: チャットルーム
+        :param batch_id: Coalescer.addが返した番号
+        """
+        asyncio.get_running_loop().call_later(
+            self.coalescer.window, self.coalescer.flush_room, room, batch_id
+        )
+
+    def schedule_teardown(self):
+        """終了した部屋の後始末をイベントループ上で一定人数ずつ行う"""
+        if not self.teardown_scheduled:
+            self.teardown_scheduled = True
+            asyncio.get_running_loop().call_soon(self.drain_teardown)
+
+    def drain_teardown(self):
+        """後始末を一定人数だけ進め、残りは次のイテレーションで処理する"""
+        if self.teardown.step():
+            asyncio.get_running_loop().call_soon(self.drain_teardown)
+        else:
+            self.teardown_scheduled = False
+
+    async def expire_idle_sessions(self):
+        """一定間隔でアイドルセッションを退出させる"""
+        while True:
+            await asyncio.sleep(self.idle_timer.tick)
+            try:
+                self.expire_sessions()
+            except Exception as e:
+                logger.error("Server Error4: %s", e)
+
+    async def handle_tcp_conn(self, reader, writer):
+        """TCP接続を処理する
+
+        :param reader: StreamReader
+        :param writer: StreamWriter
+        """
+        accepted_at = time.perf_counter()
+        try:
+            header, body = await asyncio.wait_for(
+                self.read_request(reader), self.read_timeout
+            )
+            if tcrp.unpack_header(header)[1] == self.CONTROL_CHANNEL:
+                await self.serve_channel(reader, writer)
+                return
+            writer.write(await self.process_tcrp_request(header, body))
+            await asyncio.wait_for(writer.drain(), self.read_timeout)
+            self.metrics.handshake_seconds.observe(time.perf_counter() - accepted_at)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, OSError, ValueError) as e:
+            logger.warning("Server Error1: %r", e)
+        finally:
+            writer.close()
+
+    async def serve_channel(self, reader, writer):
+        """コントロールチャネルのリクエストを順番に処理する
+
+        レスポンスを待たずに送られた(パイプライン化された)リクエストも、受信した順に処理して返す。
+
+        :param reader: StreamReader
+        :param writer: StreamWriter
+        """
+        if not self.channel_slots.acquire(blocking=False):
+            writer.write(self.build_state_res("", self.CONTROL_CHANNEL, self.ERROR_RESPONSE))
+            await asyncio.wait_for(writer.drain(), self.read_timeout)
+            return
+        try:
+            writer.write(
+                self.build_state_res("", self.CONTROL_CHANNEL, self.REQUEST_OF_RESPPONSE)
+            )
+            while True:
+                try:
+                    frame_header = await asyncio.wait_for(
+                        reader.readexactly(control.FRAME_HEADER.size), self.channel_idle_timeout
+                    )
+                except asyncio.IncompleteReadError as e:
+                    if e.partial:
+                        raise
+                    # フレームの境界でクライアントが切断した
+                    return
+                request_id, length = control.unpack_frame_header(frame_header)
+                message = await asyncio.wait_for(reader.readexactly(length), self.read_timeout)
+                header, body = control.split_request(message)
+                response = await self.process_tcrp_request(header, body)
+                writer.write(control.pack_frame(request_id, response))
+                await asyncio.wait_for(writer.drain(), self.read_timeout)
+        finally:
+            self.channel_slots.release()
+
+    async def process_tcrp_request(self, header, body):
+        """TCRPリクエストを処理してレスポンスを返す
+
+        :param header: リクエストヘッダー
+        :param body: リクエストボディ
+        :return: レスポンス
+        """
+        return self.handle_tcrp_request(header, body)
+
+    async def read_request(self, reader):
+        """TCRPリクエストをヘッダーとボディに分けて受信する
+
+        :param reader: StreamReader
+        :return: (ヘッダー, ボディ)
+        """
+        header = await reader.readexactly(tcrp.HEADER_BYTE_SIZE)
+        room_name_size, _, _, payload_size = tcrp.unpack_header(header)
+        body_size = room_name_size + payload_size
+        if body_size > tcrp.MAX_BODY_BYTE_SIZE:
+            raise ValueError(f"request body too large: {body_size} bytes")
+        return header, await reader.readexactly(body_size)
+
+    def send_datagram(self, data, address):
+        """UDPでデータを送信する
+
+        :param data: 送信データ(byte)
+        :param address: 送信先アドレス
+        """
+        self.udp_transport.sendto(data, address)
@@ -0,0 +1,140 @@
+import collections
+import threading
+import time
+
+# 受信キューが一杯のときの方針
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+
+
+class TokenBucket:
+    """トークンバケット(1件ごとに1トークン消費する)
+
+    ロックは取らない(同時に呼ばれるとまれに多めに通すことがある)。
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated_at", "clock")
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        """
+        :param rate: 1秒あたりに補充するトークン数
+        :param burst: バケットの容量(連続して通せる件数)
+        :param clock: 現在時刻を返す関数
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.clock = clock
+        self.updated_at = clock()
+
+    def allow(self):
+        """トークンがあれば1つ消費する
+
+        :return: 通してよいか
+        """
+        now = self.clock()
+        tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if tokens < 1:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - 1
+        return True
+
+
+class RateLimiter:
+    """キーごとのトークンバケット
+
+    キー数がmax_keysに達したら最も古く作成したバケットから捨てる。
+    """
+
+    def __init__(self, rate, burst, max_keys=65536, clock=time.monotonic):
+        """
+        :param rate: キーごとの1秒あたりの件数
+        :param burst: キーごとのバースト件数
+        :param max_keys: 保持するバケット数の上限
+        :param clock: 現在時刻を返す関数
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.clock = clock
+        self.buckets = {}
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def allow(self, key):
+        """キーのバケットからトークンを1つ消費する
+
+        :param key: キー
+        :return: 通してよいか
+        """
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_keys:
+                self.buckets.pop(next(iter(self.buckets)), None)
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst, self.clock)
+        return bucket.allow()
+
+    def forget(self, key):
+        """キーのバケットを破棄する
+
+        :param key: キー
+        """
+        self.buckets.pop(key, None)
+
+
+class InboundQueue:
+    """受信してから中継するまでの上限付きキュー"""
+
+    def __init__(self, maxsize, policy=DROP_OLDEST):
+        """
+        :param maxsize: キューの上限
+        :param policy: 一杯のときの方針(drop-oldest: 最も古いものを捨てる, drop-newest: 新しいものを捨てる)
+        """
+        if policy not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError(f"unknown queue policy: {policy}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.items = collections.deque()
+        self.ready = threading.Condition(threading.Lock())
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, item):
+        """キューに追加する(ブロックしない)
+
+        :param item: 追加する要素
+        :return: 何も捨てずに追加できたか(Falseなら1件捨てた)
+        """
+        with self.ready:
+            if len(self.items) < self.maxsize:
+                self.items.append(item)
+                self.ready.notify()
+                return True
+            if self.policy == DROP_OLDEST:
+                self.items.popleft()
+                self.items.append(item)
+            return False
+
+    def get(self):
+        """要素を取り出す(空なら追加されるまで待つ)
+
+        :return: 要素
+        """
+        with self.ready:
+            while not self.items:
+                self.ready.wait()
+            return self.items.popleft()
+
+    def get_nowait(self):
+        """要素を取り出す(ブロックしない)
+
+        :return: 要素(空ならNone)
+        """
+        try:
+            return self.items.popleft()
+        except IndexError:
+            return None
@@ -0,0 +1,1457 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import random
+import selectors
+import socket
+import struct
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import async_client
+import chat_room
+import fanout
+import handshake
+import logger as log_config
+import packet
+import reliable
+import room_registry
+import server
+import tcrp
+
+CREATE_ROOM = 1
+JOIN_ROOM = 2
+REQUEST_COMPLETION = 2
+
+
+def run_server(mode, tcp_address, udp_address, workers=1, server_kwargs=None):
+    """ベンチマーク用サーバーを起動する(子プロセスで実行)
+
+    :param mode: 起動モード
+    :param tcp_address: TCPアドレス
+    :param udp_address: UDPアドレス
+    :param workers: ワーカープロセス数
+    :param server_kwargs: サーバーに渡すそのほかの設定
+    """
+    server.run(
+        mode,
+        workers=workers,
+        log_level="off",
+        tcp_address=tcp_address,
+        udp_address=udp_address,
+        **(server_kwargs or {}),
+    )
+
+
+def start_server(mode, tcp_port, udp_port, workers=1, **server_kwargs):
+    """サーバーを子プロセスで起動し、TCP接続できるまで待つ
+
+    :return: サーバープロセス
+    """
+    tcp_address = ("127.0.0.1", tcp_port)
+    process = multiprocessing.Process(
+        target=run_server,
+        args=(mode, tcp_address, ("127.0.0.1", udp_port), workers, server_kwargs),
+    )
+    process.start()
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(tcp_address, timeout=0.1).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.terminate()
+    raise RuntimeError("server did not start")
+
+
+def encode_join_request(
+    operation,
+    room_name,
+    user_name,
+    user_address,
+    binary=False,
+    reliable_mode=False,
+    compress=False,
+):
+    """入室リクエスト(ヘッダー + ボディ)を作成する
+
+    :param binary: バイナリ形式(handshake.VERSION)で作成するか
+    :param reliable_mode: 信頼モードで参加するか
+    :param compress: 圧縮データグラムを受け取るか
+    :return: リクエスト
+    """
+    encoded_room_name = room_name.encode("utf-8")
+    if binary:
+        payload = handshake.pack_join_request(
+            user_name, user_address, reliable=reliable_mode, compress=compress
+        )
+    else:
+        payload = json.dumps(
+            {
+                "user_name": user_name,
+                "user_address": user_address,
+                "reliable": reliable_mode,
+                "compress": compress,
+            }
+        ).encode("utf-8")
+    header = tcrp.pack_header(len(encoded_room_name), operation, 0, len(payload))
+    return header + encoded_room_name + payload
+
+
+def decode_join_response(payload):
+    """入室レスポンスのペイロードを辞書に変換する(バイナリ/JSON)"""
+    if handshake.is_binary(payload):
+        return handshake.unpack_join_response(payload)
+    return json.loads(payload.decode("utf-8"))
+
+
+def request_room(
+    tcp_address,
+    operation,
+    room_name,
+    user_name,
+    user_address,
+    binary=False,
+    reliable_mode=False,
+    compress=False,
+):
+    """TCRPで部屋作成・参加を行う
+
+    :param binary: バイナリ形式のハンドシェイクを使うか
+    :param reliable_mode: 信頼モードで参加するか
+    :param compress: 圧縮データグラムを受け取るか
+    :return: 完了レスポンスのペイロード(token, session_idなど)
+    """
+    request = encode_join_request(
+        operation, room_name, user_name, user_address, binary, reliable_mode, compress
+    )
+    with socket.create_connection(tcp_address) as conn:
+        conn.sendall(request)
+        _, _, state, payload_size = tcrp.unpack_header(
+            tcrp.recv_exactly(conn, tcrp.HEADER_BYTE_SIZE)
+        )
+        response = decode_join_response(tcrp.recv_exactly(conn, payload_size))
+    if state != REQUEST_COMPLETION:
+        raise RuntimeError(response["message"])
+    return response
+
+
+def build_datagram(room_name, session, message, compact=False):
+    """User.__generate_requestと同じ形式のデータグラムを作成する
+
+    :param session: 完了レスポンスのペイロード
+    :param compact: コンパクト形式(セッションID)で作成するか
+    """
+    if compact:
+        return packet.pack_compact(
+            session["session_id"], message.encode("utf-8"), key=packet.session_key(session["token"])
+        )
+    return packet.pack_legacy(
+        room_name.encode("utf-8"), session["token"].encode("utf-8"), message.encode("utf-8")
+    )
+
+
+def open_udp_socket():
+    """受信バッファを大きくしたUDPソケットを作成する"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    sock.bind(("127.0.0.1", 0))
+    return sock
+
+
+def collect(sockets, expected, idle_timeout=1.0, progress=None):
+    """複数ソケットから受信したデータグラム数を数える
+
+    :param progress: 受信数を通知するコールバック
+    :return: (受信数, 最後に受信した時刻)
+    """
+    selector = selectors.DefaultSelector()
+    for sock in sockets:
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ)
+    received = 0
+    last_received_at = time.perf_counter()
+    while received < expected:
+        events = selector.select(idle_timeout)
+        if not events:
+            break
+        for key, _ in events:
+            while True:
+                try:
+                    key.fileobj.recv(4096)
+                except BlockingIOError:
+                    break
+                received += 1
+        last_received_at = time.perf_counter()
+        if progress is not None:
+            progress(received)
+    selector.close()
+    return received, last_received_at
+
+
+def bench_relay(mode, users, messages, port, window=64, compact=False, rooms=1, workers=1):
+    """中継スループット(messages/sec)を測定する
+
+    未配送のメッセージがwindow件を超えないように送信し、サーバーが処理できる速度を測る。
+    roomsが2以上の場合は各部屋の先頭ユーザーが順番に送信する。
+
+    :return: 測定結果
+    """
+    tcp_address = ("127.0.0.1", port)
+    process = start_server(mode, port, port + 1, workers)
+    udp_address = ("127.0.0.1", port + 1)
+    try:
+        room_sockets = []
+        room_sessions = []
+        for room_index in range(rooms):
+            room_name = f"bench{room_index}"
+            sockets = [open_udp_socket() for _ in range(users)]
+            room_sockets.append(sockets)
+            room_sessions.append(
+                [
+                    request_room(
+                        tcp_address,
+                        CREATE_ROOM if i == 0 else JOIN_ROOM,
+                        room_name,
+                        f"user{i}",
+                        sock.getsockname(),
+                    )
+                    for i, sock in enumerate(sockets)
+                ]
+            )
+        datagrams = [
+            (
+                room_sockets[i % rooms][0],
+                build_datagram(f"bench{i % rooms}", room_sessions[i % rooms][0], f"message {i}", compact),
+            )
+            for i in range(messages)
+        ]
+        receivers = [sock for sockets in room_sockets for sock in sockets[1:]]
+        expected = messages * (users - 1)
+        delivered = threading.Condition()
+        state = {"received": 0}
+
+        def on_progress(received):
+            with delivered:
+                state["received"] = received
+                delivered.notify()
+
+        def send_all():
+            for sent, (sender, datagram) in enumerate(datagrams):
+                with delivered:
+                    delivered.wait_for(
+                        lambda: sent - state["received"] // (users - 1) < window, timeout=0.05
+                    )
+                sender.sendto(datagram, udp_address)
+
+        started_at = time.perf_counter()
+        threading.Thread(target=send_all, daemon=True).start()
+        received, finished_at = collect(receivers, expected, progress=on_progress)
+        elapsed = finished_at - started_at
+        for sockets in room_sockets:
+            for sock in sockets:
+                sock.close()
+    finally:
+        process.terminate()
+        process.join()
+
+    return {
+        "mode": mode,
+        "workers": workers,
+        "protocol": "compact" if compact else "legacy",
+        "rooms": rooms,
+        "users": users,
+        "window": window,
+        "messages": messages,
+        "delivered": received,
+        "loss": 1 - received / expected,
+        "elapsed_sec": elapsed,
+        "messages_per_sec": received / (users - 1) / elapsed,
+        "deliveries_per_sec": received / elapsed,
+    }
+
+
+def bench_coalesce(mode, windows, senders, members, rate, duration, port):
+    """まとめて送る時間ごとに、配送数・受信データグラム数・遅延を測定する
+
+    senders人がrate件/秒(合計)で送信し、members人が受信する。
+    メッセージには送信時刻を入れ、受信側で結合データグラムを分割して遅延を求める。
+
+    :param windows: まとめる時間(秒)のリスト(0はまとめない)
+    :param rate: 1秒あたりの送信メッセージ数(全送信者の合計)
+    :param duration: 送信する時間(秒)
+    :return: 測定結果のリスト
+    """
+    results = []
+    for i, window in enumerate(windows):
+        tcp_address = ("127.0.0.1", port + i * 2)
+        udp_address = ("127.0.0.1", port + i * 2 + 1)
+        process = start_server(
+            mode, tcp_address[1], udp_address[1], coalesce_window=window
+        )
+        try:
+            sockets = [open_udp_socket() for _ in range(senders + members)]
+            sessions = [
+                request_room(
+                    tcp_address,
+                    CREATE_ROOM if j == 0 else JOIN_ROOM,
+                    "coalesce",
+                    f"user{j}",
+                    sock.getsockname(),
+                )
+                for j, sock in enumerate(sockets)
+            ]
+            messages = int(rate * duration)
+            # 送信者は自分のメッセージを受け取らないので、受信者だけで数える
+            receivers = sockets[senders:]
+            expected = messages * members
+            latencies = []
+            state = {"datagrams": 0}
+
+            def send_all():
+                started_at = time.perf_counter()
+                for n in range(messages):
+                    delay = started_at + n / rate - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    j = n % senders
+                    sockets[j].sendto(
+                        packet.pack_compact(
+                            sessions[j]["session_id"], repr(time.perf_counter()).encode()
+                        ),
+                        udp_address,
+                    )
+
+            selector = selectors.DefaultSelector()
+            for sock in receivers:
+                sock.setblocking(False)
+                selector.register(sock, selectors.EVENT_READ)
+            started_at = time.perf_counter()
+            threading.Thread(target=send_all, daemon=True).start()
+            while len(latencies) < expected:
+                events = selector.select(1.0)
+                if not events:
+                    break
+                for key, _ in events:
+                    while True:
+                        try:
+                            data = key.fileobj.recv(65536)
+                        except BlockingIOError:
+                            break
+                        received_at = time.perf_counter()
+                        state["datagrams"] += 1
+                        if data[0] == packet.COMPACT_MARKER:
+                            frames = packet.unpack_batch(data)
+                        else:
+                            frames = [data]
+                        for frame in frames:
+                            sent_at = float(bytes(frame).split(b": ", 1)[1])
+                            latencies.append(received_at - sent_at)
+            elapsed = time.perf_counter() - started_at
+            selector.close()
+            for sock in sockets:
+                sock.close()
+        finally:
+            process.terminate()
+            process.join()
+
+        latencies.sort()
+        results.append(
+            {
+                "mode": mode,
+                "coalesce_window_ms": window * 1000,
+                "senders": senders,
+                "members": members,
+                "offered_messages_per_sec": rate,
+                "delivered": len(latencies),
+                "loss": 1 - len(latencies) / expected,
+                "deliveries_per_sec": len(latencies) / elapsed,
+                "datagrams_received": state["datagrams"],
+                "messages_per_datagram": len(latencies) / max(state["datagrams"], 1),
+                "p50_ms": latencies[len(latencies) // 2] * 1000 if latencies else None,
+                "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000 if latencies else None,
+            }
+        )
+    return results
+
+
+def bench_bots(mode, sessions, rooms, messages, port):
+    """1プロセス・1スレッドのasync_clientで多数のセッションを動かす
+
+    sessions個のセッションをrooms部屋に分けて参加させ、各セッションがmessages件送信する。
+    全イベントを受信し終えるまでの時間と、最後にホストが退出して全セッションが閉じるまでを測る。
+
+    :return: 測定結果
+    """
+    process = start_server(mode, port, port + 1)
+
+    async def run():
+        client = await async_client.connect(("127.0.0.1", port), ("127.0.0.1", port + 1))
+        started_at = time.perf_counter()
+        hosts = await asyncio.gather(
+            *(client.create_room(f"bots{r}", "host") for r in range(rooms))
+        )
+        members = await asyncio.gather(
+            *(
+                client.join_room(f"bots{i % rooms}", f"bot{i}")
+                for i in range(sessions - rooms)
+            )
+        )
+        joined_at = time.perf_counter()
+        all_sessions = list(hosts) + list(members)
+        counts = {MESSAGE: 0, LEFT: 0, CLOSED: 0}
+
+        async def consume(session):
+            async for event in session:
+                counts[event.type] += 1
+
+        async def chat(session):
+            for n in range(messages):
+                await session.send(f"{session.user_name} {n}")
+
+        consumers = [asyncio.create_task(consume(session)) for session in all_sessions]
+        await asyncio.gather(*(chat(session) for session in all_sessions))
+        sent_at = time.perf_counter()
+        per_room = sessions // rooms
+        expected = messages * sessions * (per_room - 1)
+        while counts[MESSAGE] < expected and time.perf_counter() - sent_at < 10:
+            await asyncio.sleep(0.01)
+        received_at = time.perf_counter()
+        await asyncio.gather(*(host.leave() for host in hosts))
+        await asyncio.wait_for(asyncio.gather(*consumers), 10)
+        await client.close()
+        return {
+            "mode": mode,
+            "sessions": sessions,
+            "rooms": rooms,
+            "messages_per_session": messages,
+            "join_sec": joined_at - started_at,
+            "joins_per_sec": sessions / (joined_at - started_at),
+            "sends_per_sec": messages * sessions / (sent_at - joined_at),
+            "events_expected": expected,
+            "message_events": counts[MESSAGE],
+            "deliveries_per_sec": counts[MESSAGE] / (received_at - joined_at),
+            "closed_events": counts[CLOSED],
+        }
+
+    MESSAGE, LEFT, CLOSED = async_client.MESSAGE, async_client.LEFT, async_client.CLOSED
+    try:
+        return asyncio.run(run())
+    finally:
+        process.terminate()
+        process.join()
+
+
+def bench_loss(mode, messages, loss, port, ack_timeout=0.02, seed=1):
+    """パケットロスを模擬した状態で、通常モードと信頼モードの配送率を比較する
+
+    送信者は信頼モードで参加し、上りのデータグラムをlossの確率で捨ててからACKを待って再送する。
+    受信者は通常モードと信頼モードの2人で、どちらも下りのデータグラムをlossの確率で捨てる。
+
+    :param messages: 送信メッセージ数
+    :param loss: 模擬するロス率(0〜1)
+    :param ack_timeout: 送信者がACKを待つ時間(秒)
+    :return: 測定結果
+    """
+    tcp_address = ("127.0.0.1", port)
+    udp_address = ("127.0.0.1", port + 1)
+    process = start_server(mode, port, port + 1)
+    rng = random.Random(seed)
+    try:
+        sender, plain, reliable_receiver = (open_udp_socket() for _ in range(3))
+        session = request_room(
+            tcp_address, CREATE_ROOM, "loss", "sender", sender.getsockname(), True, True
+        )
+        request_room(tcp_address, JOIN_ROOM, "loss", "plain", plain.getsockname(), True)
+        receiver_session = request_room(
+            tcp_address, JOIN_ROOM, "loss", "reliable", reliable_receiver.getsockname(), True, True
+        )
+        state = {"retries": 0, "nacks": 0, "plain": 0, "reliable": 0}
+
+        def send_all():
+            sender.settimeout(ack_timeout)
+            for client_sequence in range(1, messages + 1):
+                datagram = packet.pack_reliable(
+                    session["session_id"], client_sequence, f"message {client_sequence}".encode()
+                )
+                while True:
+                    if rng.random() >= loss:
+                        sender.sendto(datagram, udp_address)
+                    try:
+                        while True:
+                            data = sender.recv(4096)
+                            if rng.random() < loss:
+                                continue
+                            _, kind, sequence, _ = packet.SEQUENCED_HEADER.unpack_from(data)
+                            if kind == packet.KIND_ACK and sequence == client_sequence:
+                                break
+                        break
+                    except socket.timeout:
+                        state["retries"] += 1
+
+        def receive_plain():
+            plain.settimeout(1.0)
+            with contextlib.suppress(socket.timeout):
+                while True:
+                    plain.recv(4096)
+                    if rng.random() >= loss:
+                        state["plain"] += 1
+
+        def receive_reliable():
+            receiver = reliable.ReliableReceiver(nack_interval=0.05)
+            receiver.start(receiver_session["sequence"])
+            reliable_receiver.settimeout(0.05)
+            idle_since = time.monotonic()
+            while state["reliable"] < messages and time.monotonic() - idle_since < 5.0:
+                try:
+                    data = reliable_receiver.recv(4096)
+                    if rng.random() >= loss:
+                        delivered = receiver.receive(data)
+                        state["reliable"] += len(delivered)
+                        if delivered:
+                            idle_since = time.monotonic()
+                except socket.timeout:
+                    pass
+                ranges = receiver.missing_ranges()
+                if ranges:
+                    state["nacks"] += 1
+                    reliable_receiver.sendto(
+                        packet.pack_nack(receiver_session["session_id"], ranges), udp_address
+                    )
+
+        started_at = time.perf_counter()
+        threads = [
+            threading.Thread(target=target, daemon=True)
+            for target in (send_all, receive_plain, receive_reliable)
+        ]
+        for thread in threads:
+            thread.start()
+        threads[0].join()
+        sent_at = time.perf_counter()
+        threads[2].join()
+        elapsed = time.perf_counter() - started_at
+        threads[1].join()
+        for sock in (sender, plain, reliable_receiver):
+            sock.close()
+    finally:
+        process.terminate()
+        process.join()
+
+    return {
+        "mode": mode,
+        "messages": messages,
+        "simulated_loss": loss,
+        "plain_delivered": state["plain"],
+        "reliable_delivered": state["reliable"],
+        "sender_retries": state["retries"],
+        "nacks_sent": state["nacks"],
+        "send_sec": sent_at - started_at,
+        "elapsed_sec": elapsed,
+    }
+
+
+def bench_handshake(mode, joins, concurrency, stalled, port, binary=False):
+    """停滞クライアントがいる状態での入室ハンドシェイク処理数(joins/sec)を測定する
+
+    :param stalled: 接続したまま何も送らないクライアント数
+    :param binary: バイナリ形式のハンドシェイクを使うか
+    :return: 測定結果
+    """
+    tcp_address = ("127.0.0.1", port)
+    process = start_server(mode, port, port + 1)
+    try:
+        stalled_conns = [socket.create_connection(tcp_address) for _ in range(stalled)]
+        request_room(tcp_address, CREATE_ROOM, "bench", "host", ("127.0.0.1", 1))
+        latencies = []
+
+        def join(i):
+            started_at = time.perf_counter()
+            request_room(
+                tcp_address, JOIN_ROOM, "bench", f"user{i}", ("127.0.0.1", 1), binary
+            )
+            latencies.append(time.perf_counter() - started_at)
+
+        started_at = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(join, range(joins)))
+        elapsed = time.perf_counter() - started_at
+        for conn in stalled_conns:
+            conn.close()
+    finally:
+        process.terminate()
+        process.join()
+
+    latencies.sort()
+    return {
+        "mode": mode,
+        "protocol": "binary" if binary else "json",
+        "joins": joins,
+        "concurrency": concurrency,
+        "stalled_clients": stalled,
+        "elapsed_sec": elapsed,
+        "joins_per_sec": joins / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+    }
+
+
+def bench_handshake_codec(handshakes):
+    """JSONとバイナリ形式の入室ハンドシェイクを、ソケットを使わずに処理できる数を比較する
+
+    クライアント側のエンコード、Server.handle_tcrp_request、レスポンスのデコード、退出までを1回とする。
+
+    :param handshakes: 形式ごとの回数
+    :return: 測定結果
+    """
+    chat_server = server.Server(
+        tcp_address=("127.0.0.1", 0), udp_address=("127.0.0.1", 0)
+    )
+    user_address = ("127.0.0.1", 1)
+    chat_server.handle_room("bench", user_address, "host", CREATE_ROOM)
+    room = chat_server.rooms["bench"]
+    results = []
+    for binary in (False, True):
+        request_bytes = len(
+            encode_join_request(JOIN_ROOM, "bench", "user0", user_address, binary)
+        )
+        started_at = time.perf_counter()
+        for i in range(handshakes):
+            request = encode_join_request(JOIN_ROOM, "bench", f"user{i}", user_address, binary)
+            header = request[: tcrp.HEADER_BYTE_SIZE]
+            response = chat_server.handle_tcrp_request(header, request[tcrp.HEADER_BYTE_SIZE :])
+            session = decode_join_response(response[tcrp.HEADER_BYTE_SIZE :])
+            chat_server.leave_room(room, room.get_member(session["token"].encode("utf-8")))
+        elapsed = time.perf_counter() - started_at
+        results.append(
+            {
+                "protocol": "binary" if binary else "json",
+                "handshakes": handshakes,
+                "request_bytes": request_bytes,
+                "response_bytes": len(response),
+                "elapsed_sec": elapsed,
+                "handshakes_per_sec": handshakes / elapsed,
+            }
+        )
+    chat_server.tcp_socket.close()
+    chat_server.udp_socket.close()
+    return results
+
+
+def bench_directory(room_count, repeat):
+    """部屋数が多いときの部屋一覧(1ページ)の取得時間を測定する
+
+    全部屋をコピーしてソートする方式と、ソート済みインデックス(RoomRegistry.search)を比較する。
+
+    :param room_count: 部屋数
+    :param repeat: 測定回数
+    :return: 測定結果
+    """
+    registry = room_registry.RoomRegistry()
+    started_at = time.perf_counter()
+    for i in range(room_count):
+        name = f"room{i}"
+        registry.create(name, lambda name=name: chat_room.ChatRoom(name))
+    build_sec = time.perf_counter() - started_at
+
+    def full_copy():
+        rooms = sorted(registry.rooms(), key=lambda room: room.name)
+        return [room for room in rooms if room.name.startswith("room9")][:100]
+
+    searches = {
+        "copy_and_sort": full_copy,
+        "index_first_page": lambda: registry.search(limit=100),
+        "index_prefix": lambda: registry.search(prefix="room9", limit=100),
+        "index_substring": lambda: registry.search(contains="999", limit=100),
+    }
+    results = []
+    for name, search in searches.items():
+        timings = []
+        for _ in range(repeat):
+            started_at = time.perf_counter()
+            search()
+            timings.append(time.perf_counter() - started_at)
+        timings.sort()
+        results.append(
+            {
+                "rooms": room_count,
+                "method": name,
+                "insert_all_sec": build_sec,
+                "p50_ms": timings[len(timings) // 2] * 1000,
+                "p99_ms": timings[int(len(timings) * 0.99)] * 1000,
+            }
+        )
+    return results
+
+
+def bench_fanout(room_sizes, repeat, workers):
+    """部屋の人数ごとのブロードキャスト1回あたりの所要時間を測定する
+
+    送信先ごとにエンコード・タプル変換する従来方式と、Fanout(逐次・並行)を比較する。
+
+    :return: 測定結果
+    """
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sender.bind(("127.0.0.1", 0))
+    message = "user0: " + "x" * 64
+    results = []
+    for room_size in room_sizes:
+        receivers = [open_udp_socket() for _ in range(room_size)]
+        # JSONから復元した状態(リスト)のアドレス
+        stored_addresses = [list(sock.getsockname()) for sock in receivers]
+        addresses = tuple(tuple(address) for address in stored_addresses)
+
+        def per_recipient():
+            for address in stored_addresses:
+                sender.sendto(message.encode("utf-8"), tuple(address))
+
+        engines = {
+            "per_recipient": per_recipient,
+            "fanout": lambda engine=fanout.Fanout(sender): engine.broadcast(
+                message.encode("utf-8"), addresses
+            ),
+            f"fanout_workers{workers}": lambda engine=fanout.Fanout(
+                sender, workers=workers, parallel_threshold=0
+            ): engine.broadcast(message.encode("utf-8"), addresses),
+        }
+        for name, broadcast in engines.items():
+            timings = []
+            for _ in range(repeat):
+                started_at = time.perf_counter()
+                broadcast()
+                timings.append(time.perf_counter() - started_at)
+            timings.sort()
+            results.append(
+                {
+                    "room_size": room_size,
+                    "engine": name,
+                    "p50_ms": timings[len(timings) // 2] * 1000,
+                    "p99_ms": timings[int(len(timings) * 0.99)] * 1000,
+                }
+            )
+        for sock in receivers:
+            sock.close()
+    sender.close()
+    return results
+
+
+def flood(udp_address, session_id, rate, duration):
+    """偽造したデータグラムを送り続ける(子プロセスで実行)
+
+    正規の送信者のセッションIDに不正なMACを付けたものと、存在しないセッションIDのものを交互に送る。
+
+    :param session_id: なりすますセッションID
+    :param rate: 1秒あたりの送信数
+    :param duration: 送信する時間(秒)
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    forged_key = os.urandom(32)
+    datagrams = [
+        packet.pack_compact(session_id, b"forged", key=forged_key),
+        packet.pack_compact(session_id + 1_000_000, b"forged", key=forged_key),
+    ]
+    # 1ミリ秒ごとにまとめて送る
+    burst = max(1, rate // 1000 // len(datagrams))
+    started_at = time.monotonic()
+    sent = 0
+    while time.monotonic() < started_at + duration:
+        for _ in range(burst):
+            for datagram in datagrams:
+                with contextlib.suppress(OSError):
+                    sock.sendto(datagram, udp_address)
+        sent += burst * len(datagrams)
+        delay = started_at + sent / rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def bench_mac(mode, users, messages, port, flood_rate, window=64, packets=100000):
+    """MACの確認にかかる時間と、偽造データグラムを大量に受けているときの中継スループットを測定する
+
+    前半はServer.admitをソケットなしで呼び、1パケットあたりの確認時間を測る。
+    後半は正規の送信者が中継するあいだ、別プロセスから偽造データグラムを送り続ける。
+
+    :param flood_rate: 1秒あたりの偽造データグラムの数
+    :param packets: 確認時間を測るパケット数
+    :return: 測定結果のリスト
+    """
+    results = []
+    for require_mac in (False, True):
+        chat_server = server.Server(
+            tcp_address=("127.0.0.1", 0), udp_address=("127.0.0.1", 0), require_mac=require_mac
+        )
+        address = ("127.0.0.1", 1)
+        member = chat_server.handle_room("mac", address, "host", CREATE_ROOM)
+        session = {"token": member.token, "session_id": member.session_id}
+        cases = {
+            "valid": build_datagram("mac", session, "x" * 100, compact=True),
+            "forged": packet.pack_compact(member.session_id, b"x" * 100, key=os.urandom(32)),
+            "unsigned": packet.pack_compact(member.session_id, b"x" * 100),
+        }
+        for name, datagram in cases.items():
+            view = memoryview(datagram)
+            started_at = time.perf_counter()
+            for _ in range(packets):
+                admitted = chat_server.admit(view, address)
+            elapsed = time.perf_counter() - started_at
+            results.append(
+                {
+                    "require_mac": require_mac,
+                    "datagram": name,
+                    "admitted": admitted,
+                    "us_per_packet": elapsed / packets * 1e6,
+                }
+            )
+        chat_server.tcp_socket.close()
+        chat_server.udp_socket.close()
+
+    tcp_address = ("127.0.0.1", port)
+    udp_address = ("127.0.0.1", port + 1)
+    for flooded in (False, True):
+        process = start_server(mode, port, port + 1, require_mac=True)
+        try:
+            sockets = [open_udp_socket() for _ in range(users)]
+            sessions = [
+                request_room(
+                    tcp_address,
+                    CREATE_ROOM if i == 0 else JOIN_ROOM,
+                    "mac",
+                    f"user{i}",
+                    sock.getsockname(),
+                )
+                for i, sock in enumerate(sockets)
+            ]
+            datagrams = [
+                build_datagram("mac", sessions[0], f"message {i}", compact=True)
+                for i in range(messages)
+            ]
+            flooder = None
+            if flooded:
+                flooder = multiprocessing.Process(
+                    target=flood,
+                    args=(udp_address, sessions[0]["session_id"], flood_rate, 60),
+                )
+                flooder.start()
+                time.sleep(0.2)
+            receivers = sockets[1:]
+            expected = messages * (users - 1)
+            state = {"received": 0}
+            delivered = threading.Condition()
+
+            def on_progress(received):
+                with delivered:
+                    state["received"] = received
+                    delivered.notify()
+
+            def send_all():
+                for sent, datagram in enumerate(datagrams):
+                    with delivered:
+                        delivered.wait_for(
+                            lambda: sent - state["received"] // (users - 1) < window,
+                            timeout=0.05,
+                        )
+                    sockets[0].sendto(datagram, udp_address)
+
+            started_at = time.perf_counter()
+            threading.Thread(target=send_all, daemon=True).start()
+            received, finished_at = collect(receivers, expected, progress=on_progress)
+            elapsed = finished_at - started_at
+            if flooder is not None:
+                flooder.terminate()
+                flooder.join()
+            for sock in sockets:
+                sock.close()
+        finally:
+            process.terminate()
+            process.join()
+        results.append(
+            {
+                "mode": mode,
+                "flood_rate": flood_rate if flooded else 0,
+                "users": users,
+                "messages": messages,
+                "delivered": received,
+                "messages_per_sec": received / (users - 1) / elapsed,
+            }
+        )
+    return results
+
+
+# 圧縮の測定に使う文(貼り付けられた長文に近くなるよう、ランダムに並べる)
+SAMPLE_SENTENCES = (
+    "明日の会議は10時からに変更になりました。資料は共有フォルダに置いてあります。",
+    "ありがとうございます。確認してから返信します。",
+    "ログを貼ります。エラーが出るのは接続直後だけのようです。",
+    "Traceback (most recent call last):\n  File \"server.py\", line 120, in handle_datagram\n",
+    "    raise ValueError(\"truncated batch\")\nValueError: truncated batch\n",
+    "def relay(self, room, sender, message):\n    return self.send(room, message)\n",
+    "I pushed the fix to the branch, please take a look when you have time. ",
+    "https://www.example.com/docs/getting-started?lang=ja#install ",
+    "The build failed again on the integration step, retrying with more memory. ",
+)
+
+
+def sample_text(size, rng):
+    """sizeバイト程度の貼り付け風のテキストを作成する
+
+    :param rng: random.Random
+    :return: テキスト
+    """
+    parts = []
+    length = 0
+    while length < size:
+        part = f"{rng.choice(SAMPLE_SENTENCES)}[{rng.randrange(100000)}] "
+        parts.append(part)
+        length += len(part.encode("utf-8"))
+    return "".join(parts).encode("utf-8")[:size].decode("utf-8", "ignore")
+
+
+def bench_compress(users, messages, sizes, seed=1):
+    """圧縮の有無で中継1回あたりの送信バイト数とzlibの処理時間を比較する
+
+    送信者は大きなメッセージを圧縮して送り、サーバーは展開して1回だけ圧縮し直して全員に送る。
+
+    :param sizes: メッセージのバイト数のリスト
+    :return: 測定結果のリスト
+    """
+    results = []
+    for size in sizes:
+        for compress in (False, True):
+            rng = random.Random(seed)
+            chat_server = server.Server(
+                tcp_address=("127.0.0.1", 0), udp_address=("127.0.0.1", 0)
+            )
+            udp_address = chat_server.udp_socket.getsockname()
+            receivers = [open_udp_socket() for _ in range(users)]
+            host = chat_server.handle_room(
+                "bench", receivers[0].getsockname(), "user0", CREATE_ROOM, compress=compress
+            )
+            for i, sock in enumerate(receivers[1:], start=1):
+                chat_server.handle_room(
+                    "bench", sock.getsockname(), f"user{i}", JOIN_ROOM, compress=compress
+                )
+            for sock in receivers:
+                sock.setblocking(False)
+            key = packet.session_key(host.token)
+            buffer = bytearray(chat_server.RECV_BUFFER_SIZE)
+            view = memoryview(buffer)
+            state = {"raw_bytes": 0, "uplink_bytes": 0, "downlink_bytes": 0, "relay_sec": 0.0}
+            for _ in range(messages):
+                message = sample_text(size, rng).encode("utf-8")
+                flags = 0
+                if compress:
+                    message, flags = packet.compress_message(message)
+                datagram = packet.pack_compact(host.session_id, message, flags, key)
+                state["uplink_bytes"] += len(datagram)
+                receivers[0].sendto(datagram, udp_address)
+                received, address = chat_server.udp_socket.recvfrom_into(buffer)
+                started_at = time.perf_counter()
+                chat_server.handle_datagram(view[:received], address)
+                state["relay_sec"] += time.perf_counter() - started_at
+                for sock in receivers[1:]:
+                    with contextlib.suppress(BlockingIOError):
+                        while True:
+                            data = sock.recv(65536)
+                            state["downlink_bytes"] += len(data)
+                            state["raw_bytes"] += sum(
+                                len(frame) for frame in packet.split_datagrams(data)
+                            )
+            results.append(
+                {
+                    "size": size,
+                    "compress": compress,
+                    "users": users,
+                    "messages": messages,
+                    "uplink_bytes_per_message": state["uplink_bytes"] / messages,
+                    "downlink_bytes_per_message": state["downlink_bytes"] / messages,
+                    "compression_ratio": state["downlink_bytes"] / max(state["raw_bytes"], 1),
+                    "saved_bytes": chat_server.compression_saved.value(),
+                    "compress_us_per_message": (
+                        chat_server.compression_seconds.value("compress") / messages * 1e6
+                    ),
+                    "decompress_us_per_message": (
+                        chat_server.compression_seconds.value("decompress") / messages * 1e6
+                    ),
+                    "relay_us_per_message": state["relay_sec"] / messages * 1e6,
+                }
+            )
+            for sock in receivers:
+                sock.close()
+            chat_server.tcp_socket.close()
+            chat_server.udp_socket.close()
+    return results
+
+
+def bench_teardown(room_sizes, handoff_repeat=100):
+    """ホスト退出時に中継処理を止める時間と、後始末にかかる時間を部屋の人数ごとに測定する
+
+    leave_roomは部屋を切り離すまでを行い、通知とセッションの破棄はTeardown.stepで行う。
+    ホストの引き継ぎありの場合は、部屋が残り続けることとleave_roomの時間を測る。
+
+    :param room_sizes: 部屋の人数のリスト
+    :param handoff_repeat: 引き継ぎを繰り返す回数
+    :return: 測定結果のリスト
+    """
+    results = []
+    receiver = open_udp_socket()
+    receiver.setblocking(False)
+    address = receiver.getsockname()
+
+    def drain():
+        with contextlib.suppress(BlockingIOError):
+            while True:
+                receiver.recv(65536)
+
+    for size in room_sizes:
+        for host_handoff in (False, True):
+            chat_server = server.Server(
+                tcp_address=("127.0.0.1", 0),
+                udp_address=("127.0.0.1", 0),
+                host_handoff=host_handoff,
+            )
+            host = chat_server.handle_room("bench", address, "host", CREATE_ROOM)
+            for i in range(1, size):
+                chat_server.handle_room("bench", address, f"user{i}", JOIN_ROOM, reliable_mode=i % 2 == 0)
+            room = chat_server.rooms["bench"]
+            result = {"room_size": size, "host_handoff": host_handoff}
+            if host_handoff:
+                started_at = time.perf_counter()
+                for _ in range(min(handoff_repeat, size - 1)):
+                    host = room.get_member(room.host_token.encode("utf-8"))
+                    chat_server.leave_room(room, host)
+                    drain()
+                elapsed = time.perf_counter() - started_at
+                result.update(
+                    {
+                        "handoffs": min(handoff_repeat, size - 1),
+                        "leave_room_ms": elapsed / min(handoff_repeat, size - 1) * 1000,
+                        "room_open": chat_server.rooms.get("bench") is room,
+                        "members_left": len(room.snapshot()),
+                    }
+                )
+            else:
+                started_at = time.perf_counter()
+                chat_server.leave_room(room, host)
+                detached_at = time.perf_counter()
+                steps = []
+                while True:
+                    step_started_at = time.perf_counter()
+                    remaining = chat_server.teardown.step()
+                    steps.append(time.perf_counter() - step_started_at)
+                    drain()
+                    if not remaining:
+                        break
+                result.update(
+                    {
+                        "leave_room_ms": (detached_at - started_at) * 1000,
+                        "teardown_steps": len(steps),
+                        "max_step_ms": max(steps) * 1000,
+                        "teardown_total_ms": sum(steps) * 1000,
+                        "sessions_left": len(chat_server.sessions),
+                    }
+                )
+            results.append(result)
+            chat_server.tcp_socket.close()
+            chat_server.udp_socket.close()
+    receiver.close()
+    return results
+
+
+def bench_alloc(users, messages):
+    """tracemallocで中継1回あたりに確保されるメモリ量を測定する
+
+    ベースラインと同じ処理(スライス・デコード・送信先ごとのエンコード)と、
+    recvfrom_into + memoryviewで解析するServer.handle_datagramを比較する。
+
+    :return: 測定結果
+    """
+    chat_server = server.Server(
+        tcp_address=("127.0.0.1", 0), udp_address=("127.0.0.1", 0)
+    )
+    udp_address = chat_server.udp_socket.getsockname()
+    receivers = [open_udp_socket() for _ in range(users)]
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        host = chat_server.handle_room(
+            "bench", receivers[0].getsockname(), "user0", CREATE_ROOM
+        )
+        for i, sock in enumerate(receivers[1:], start=1):
+            chat_server.handle_room("bench", sock.getsockname(), f"user{i}", JOIN_ROOM)
+    room = chat_server.rooms["bench"]
+    session = {"token": host.token, "session_id": host.session_id}
+    datagram = build_datagram("bench", session, "x" * 100)
+    compact_datagram = build_datagram("bench", session, "x" * 100, compact=True)
+
+    def baseline_relay():
+        data, _ = chat_server.udp_socket.recvfrom(4096)
+        room_name_size, token_size = struct.unpack_from("!B B", data[:2])
+        room_name = data[2 : 2 + room_name_size].decode("utf-8")
+        token = data[2 + room_name_size : 2 + room_name_size + token_size].decode("utf-8")
+        message = data[2 + room_name_size + token_size :]
+        sender_name = room.get_member(token.encode("utf-8")).user_name
+        print(f"{room_name}: {sender_name}が'{message.decode('utf-8')}'を送信しました")
+        message = f"{sender_name}: {message.decode('utf-8')}"
+        for member in room.snapshot().values():
+            if member.token != token:
+                chat_server.udp_socket.sendto(message.encode("utf-8"), tuple(list(member.address)))
+
+    buffer = bytearray(chat_server.RECV_BUFFER_SIZE)
+    view = memoryview(buffer)
+
+    def zero_copy_relay():
+        size, address = chat_server.udp_socket.recvfrom_into(buffer)
+        chat_server.handle_datagram(view[:size], address)
+
+    results = []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        paths = (
+            ("baseline", baseline_relay, datagram),
+            ("zero_copy", zero_copy_relay, datagram),
+            ("zero_copy_compact", zero_copy_relay, compact_datagram),
+        )
+        for name, relay, request in paths:
+            peaks = []
+            tracemalloc.start()
+            for _ in range(messages):
+                receivers[0].sendto(request, udp_address)
+                before, _ = tracemalloc.get_traced_memory()
+                tracemalloc.reset_peak()
+                relay()
+                _, peak = tracemalloc.get_traced_memory()
+                peaks.append(peak - before)
+            tracemalloc.stop()
+            for sock in receivers:
+                sock.setblocking(False)
+                with contextlib.suppress(BlockingIOError):
+                    while True:
+                        sock.recv(4096)
+            results.append(
+                {
+                    "path": name,
+                    "users": users,
+                    "messages": messages,
+                    "mean_peak_bytes_per_message": sum(peaks) / len(peaks),
+                }
+            )
+
+    for sock in receivers:
+        sock.close()
+    chat_server.tcp_socket.close()
+    chat_server.udp_socket.close()
+    return results
+
+
+def run_coordinator(address):
+    """ベンチマーク用のクラスターのコーディネーターを起動する(子プロセスで実行)
+
+    :param address: 待ち受けるアドレス
+    """
+    import cluster
+
+    log_config.setup_logging("off")
+    cluster.Coordinator(address).start()
+
+
+def bench_cluster(node_counts, rooms, members, messages, port):
+    """ローカルホストの複数プロセスでクラスターを組み、部屋の分散と中継の配送を測る
+
+    コーディネーターとノード数分のサーバープロセスを起動し、すべての入室をノード0へ送る。
+    担当外の部屋の入室はノード0が担当ノードへ中継し、クライアントは入室レスポンスで通知された
+    担当ノードのUDPアドレスへ直接メッセージを送る。
+
+    :param node_counts: ノード数のリスト
+    :param rooms: 部屋数
+    :param members: 1部屋の参加者数(ホストを含む)
+    :param messages: 1人あたりの送信メッセージ数
+    :return: 測定結果のリスト
+    """
+    import cluster
+
+    results = []
+    for n, node_count in enumerate(node_counts):
+        base = port + n * 100
+        coordinator_address = ("127.0.0.1", base)
+        coordinator = multiprocessing.Process(target=run_coordinator, args=(coordinator_address,))
+        coordinator.start()
+        processes = [coordinator]
+        try:
+            deadline = time.monotonic() + 5
+            while True:
+                try:
+                    socket.create_connection(coordinator_address, timeout=0.1).close()
+                    break
+                except OSError:
+                    if time.monotonic() > deadline:
+                        raise RuntimeError("coordinator did not start")
+                    time.sleep(0.05)
+            for i in range(node_count):
+                processes.append(
+                    start_server(
+                        "async",
+                        base + 1 + i * 2,
+                        base + 2 + i * 2,
+                        coordinator=coordinator_address,
+                        node_id=f"node{i}",
+                    )
+                )
+            # 全ノードが互いのノード一覧を取得し直すまで待つ
+            time.sleep(1.5)
+            nodes = cluster.request_coordinator(coordinator_address, {"op": "nodes"})["nodes"]
+            results.append(
+                asyncio.run(bench_cluster_rooms(node_count, nodes, rooms, members, messages, base))
+            )
+        finally:
+            for process in processes:
+                process.terminate()
+                process.join()
+    return results
+
+
+async def bench_cluster_rooms(node_count, nodes, rooms, members, messages, port):
+    """bench_clusterで起動したクラスターに部屋を作り、メッセージを送る
+
+    :param node_count: ノード数
+    :param nodes: コーディネーターが返したノード一覧
+    :param port: コーディネーターのポート番号(ノード0のTCPポートは+1)
+    :return: 測定結果
+    """
+    client = await async_client.connect(("127.0.0.1", port + 1), ("127.0.0.1", port + 2))
+    started_at = time.perf_counter()
+    hosts = await asyncio.gather(
+        *(client.create_room(f"cluster{r}", "host") for r in range(rooms))
+    )
+    guests = await asyncio.gather(
+        *(
+            client.join_room(f"cluster{i % rooms}", f"guest{i}")
+            for i in range(rooms * (members - 1))
+        )
+    )
+    joined_at = time.perf_counter()
+    sessions = list(hosts) + list(guests)
+    # 入室レスポンスで通知されたUDPアドレスから担当ノードを数える
+    node_of_udp = {tuple(node["udp_address"]): node["node_id"] for node in nodes}
+    rooms_per_node = {node["node_id"]: 0 for node in nodes}
+    for host in hosts:
+        rooms_per_node[node_of_udp[host.udp_address]] += 1
+    listed = await client.list_rooms(prefix="cluster", limit=rooms)
+    delivered = 0
+
+    async def consume(session):
+        nonlocal delivered
+        async for event in session:
+            if event.type == async_client.MESSAGE:
+                delivered += 1
+
+    async def chat(session):
+        for m in range(messages):
+            await session.send(f"{session.user_name} {m}")
+
+    consumers = [asyncio.create_task(consume(session)) for session in sessions]
+    sent_started_at = time.perf_counter()
+    await asyncio.gather(*(chat(session) for session in sessions))
+    expected = len(sessions) * messages * (members - 1)
+    while delivered < expected and time.perf_counter() - sent_started_at < 10:
+        await asyncio.sleep(0.01)
+    received_at = time.perf_counter()
+    await asyncio.gather(*(host.leave() for host in hosts))
+    await asyncio.wait_for(asyncio.gather(*consumers), 10)
+    await client.close()
+    return {
+        "nodes": node_count,
+        "rooms": rooms,
+        "members_per_room": members,
+        "rooms_per_node": rooms_per_node,
+        "listed_rooms": len(listed["rooms"]),
+        "joins_per_sec": len(sessions) / (joined_at - started_at),
+        "events_expected": expected,
+        "message_events": delivered,
+        "deliveries_per_sec": delivered / (received_at - sent_started_at),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="stage2 server benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    relay = subparsers.add_parser("relay", help="threaded vs asyncio relay throughput")
+    relay.add_argument("--modes", nargs="+", default=["threaded", "async"])
+    relay.add_argument("--users", type=int, default=10)
+    relay.add_argument("--messages", type=int, default=5000)
+    relay.add_argument("--window", type=int, default=64)
+    relay.add_argument("--compact", action="store_true", help="send session-id datagrams")
+    relay.add_argument("--port", type=int, default=19002)
+
+    handshake_parser = subparsers.add_parser(
+        "handshake", help="join requests/sec with stalled clients"
+    )
+    handshake_parser.add_argument("--modes", nargs="+", default=["threaded", "async"])
+    handshake_parser.add_argument("--joins", type=int, default=1000)
+    handshake_parser.add_argument("--concurrency", type=int, default=16)
+    handshake_parser.add_argument("--stalled", type=int, default=4)
+    handshake_parser.add_argument("--port", type=int, default=19102)
+    handshake_parser.add_argument(
+        "--binary", action="store_true", help="use the binary handshake payload"
+    )
+
+    codec = subparsers.add_parser("codec", help="in-process JSON vs binary handshakes/sec")
+    codec.add_argument("--handshakes", type=int, default=20000)
+
+    fanout_parser = subparsers.add_parser("fanout", help="broadcast latency by room size")
+    fanout_parser.add_argument("--room-sizes", nargs="+", type=int, default=[10, 100, 1000])
+    fanout_parser.add_argument("--repeat", type=int, default=200)
+    fanout_parser.add_argument("--workers", type=int, default=4)
+
+    scaling = subparsers.add_parser("workers", help="messages/sec by SO_REUSEPORT worker count")
+    scaling.add_argument("--workers", nargs="+", type=int, default=[1, 2, 4])
+    scaling.add_argument("--rooms", type=int, default=16)
+    scaling.add_argument("--users", type=int, default=5)
+    scaling.add_argument("--messages", type=int, default=20000)
+    scaling.add_argument("--window", type=int, default=256)
+    scaling.add_argument("--port", type=int, default=19202)
+
+    coalesce_parser = subparsers.add_parser(
+        "coalesce", help="latency/throughput by message coalescing window"
+    )
+    coalesce_parser.add_argument("--mode", choices=["threaded", "async"], default="async")
+    coalesce_parser.add_argument(
+        "--windows", nargs="+", type=float, default=[0, 0.001, 0.002, 0.005]
+    )
+    coalesce_parser.add_argument("--senders", type=int, default=10)
+    coalesce_parser.add_argument("--members", type=int, default=50)
+    coalesce_parser.add_argument("--rate", type=float, default=2000)
+    coalesce_parser.add_argument("--duration", type=float, default=3.0)
+    coalesce_parser.add_argument("--port", type=int, default=19402)
+
+    bots = subparsers.add_parser("bots", help="many async_client sessions in one thread")
+    bots.add_argument("--modes", nargs="+", default=["threaded", "async"])
+    bots.add_argument("--sessions", type=int, default=1000)
+    bots.add_argument("--rooms", type=int, default=100)
+    bots.add_argument("--messages", type=int, default=5)
+    bots.add_argument("--port", type=int, default=19502)
+
+    loss_parser = subparsers.add_parser(
+        "loss", help="delivery with simulated packet loss, plain vs reliable mode"
+    )
+    loss_parser.add_argument("--modes", nargs="+", default=["threaded", "async"])
+    loss_parser.add_argument("--messages", type=int, default=2000)
+    loss_parser.add_argument("--loss", type=float, default=0.1)
+    loss_parser.add_argument("--port", type=int, default=19302)
+
+    directory = subparsers.add_parser("directory", help="room listing latency by room count")
+    directory.add_argument("--rooms", type=int, default=100000)
+    directory.add_argument("--repeat", type=int, default=20)
+
+    mac = subparsers.add_parser("mac", help="per-packet MAC cost and relay rate under a forged flood")
+    mac.add_argument("--mode", choices=["threaded", "async"], default="async")
+    mac.add_argument("--users", type=int, default=10)
+    mac.add_argument("--messages", type=int, default=2000)
+    mac.add_argument("--packets", type=int, default=100000)
+    mac.add_argument("--flood-rate", type=int, default=20000)
+    mac.add_argument("--port", type=int, default=19702)
+
+    compress_parser = subparsers.add_parser(
+        "compress", help="outbound bytes and zlib time per relayed message"
+    )
+    compress_parser.add_argument("--users", type=int, default=50)
+    compress_parser.add_argument("--messages", type=int, default=200)
+    compress_parser.add_argument("--sizes", type=int, nargs="+", default=[128, 512, 2000, 4000])
+
+    teardown_parser = subparsers.add_parser(
+        "teardown", help="relay-thread time when a host leaves, with and without handoff"
+    )
+    teardown_parser.add_argument("--room-sizes", type=int, nargs="+", default=[10, 100, 1000])
+
+    alloc = subparsers.add_parser("alloc", help="tracemalloc bytes allocated per relayed message")
+    alloc.add_argument("--users", type=int, default=10)
+    alloc.add_argument("--messages", type=int, default=1000)
+
+    cluster_parser = subparsers.add_parser(
+        "cluster", help="rooms sharded across node processes on localhost"
+    )
+    cluster_parser.add_argument("--nodes", type=int, nargs="+", default=[1, 2, 4])
+    cluster_parser.add_argument("--rooms", type=int, default=60)
+    cluster_parser.add_argument("--members", type=int, default=4)
+    cluster_parser.add_argument("--messages", type=int, default=5)
+    cluster_parser.add_argument("--port", type=int, default=19900)
+
+    args = parser.parse_args()
+    if args.command == "relay":
+        results = [
+            bench_relay(
+                mode, args.users, args.messages, args.port + i * 2, args.window, args.compact
+            )
+            for i, mode in enumerate(args.modes)
+        ]
+    elif args.command == "handshake":
+        results = [
+            bench_handshake(
+                mode, args.joins, args.concurrency, args.stalled, args.port + i * 2, args.binary
+            )
+            for i, mode in enumerate(args.modes)
+        ]
+    elif args.command == "codec":
+        results = bench_handshake_codec(args.handshakes)
+    elif args.command == "fanout":
+        results = bench_fanout(args.room_sizes, args.repeat, args.workers)
+    elif args.command == "workers":
+        results = [
+            bench_relay(
+                "async",
+                args.users,
+                args.messages,
+                args.port + i * 2,
+                args.window,
+                compact=True,
+                rooms=args.rooms,
+                workers=worker_count,
+            )
+            for i, worker_count in enumerate(args.workers)
+        ]
+    elif args.command == "coalesce":
+        results = bench_coalesce(
+            args.mode,
+            args.windows,
+            args.senders,
+            args.members,
+            args.rate,
+            args.duration,
+            args.port,
+        )
+    elif args.command == "bots":
+        results = [
+            bench_bots(mode, args.sessions, args.rooms, args.messages, args.port + i * 2)
+            for i, mode in enumerate(args.modes)
+        ]
+    elif args.command == "loss":
+        results = [
+            bench_loss(mode, args.messages, args.loss, args.port + i * 2)
+            for i, mode in enumerate(args.modes)
+        ]
+    elif args.command == "directory":
+        results = bench_directory(args.rooms, args.repeat)
+    elif args.command == "mac":
+        results = bench_mac(
+            args.mode,
+            args.users,
+            args.messages,
+            args.port,
+            args.flood_rate,
+            packets=args.packets,
+        )
+    elif args.command == "compress":
+        results = bench_compress(args.users, args.messages, args.sizes)
+    elif args.command == "teardown":
+        results = bench_teardown(args.room_sizes)
+    elif args.command == "alloc":
+        results = bench_alloc(args.users, args.messages)
+    elif args.command == "cluster":
+        results = bench_cluster(args.nodes, args.rooms, args.members, args.messages, args.port)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
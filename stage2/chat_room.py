@@ -1,50 +1,247 @@
+import logging
 import secrets
+import threading
+
+import history
+import packet
+import reliable
+
+logger = logging.getLogger("chat")
+
+
+class Member:
+    """チャットルームの参加者"""
+
+    __slots__ = (
+        "token",
+        "session_id",
+        "room",
+        "address",
+        "user_name",
+        "name_prefix",
+        "reliable",
+        "compress",
+        "fragment",
+        "last_client_sequence",
+        "last_room_sequence",
+        "first_sequence",
+        "mac_key",
+    )
+
+    def __init__(
+        self,
+        token,
+        session_id,
+        room,
+        address,
+        user_name,
+        reliable=False,
+        compress=False,
+        fragment=False,
+    ):
+        self.token = token
+        self.session_id = session_id
+        self.room = room
+        self.address = address
+        self.user_name = user_name
+        # データグラムのMACを確認するセッション鍵(トークンから導出する)
+        self.mac_key = packet.session_key(token)
+        # 中継時にメッセージの前に付ける"ユーザー名: "(エンコード済み)
+        self.name_prefix = f"{user_name}: ".encode("utf-8")
+        # 信頼モード(連番つきで配送し、欠落は再送要求に応じて再送する)
+        self.reliable = reliable
+        # 大きなメッセージを圧縮データグラムで受け取るか
+        self.compress = compress
+        # 大きなメッセージを断片のまま受け取れるか(受け取れない参加者には断片を送らない)
+        self.fragment = fragment
+        # 最後に受け付けた上りメッセージの連番(再送された重複を捨てる)
+        self.last_client_sequence = 0
+        # 最後に中継したメッセージに割り当てた部屋の連番(ACKで通知し、送信者はその連番を欠落としない)
+        self.last_room_sequence = 0
+        # 信頼モードで最初に受信する部屋の連番(参加と同時に決める)
+        self.first_sequence = 0
+
 
 class ChatRoom:
+    MAX_USERS = 1000
 
-    def __init__(self, room_name):
+    def __init__(self, room_name, message_history=None, rate_limit=None, resend_window=None):
         self.name = room_name
         self.host_token = ""
-        self.users = {}
-        self.token_to_addrs = {}
-        self.token_to_user_name = {}
-        self.messages = []
+        # 参加者(トークン(byte) -> Member)
+        # 変更時は新しい辞書に差し替える(コピーオンライト)ため、読み取り側はロック不要
+        self.members = {}
+        # 送信先アドレス(タプルに変換済み)。membersと同じくコピーオンライト
+        # 信頼モードの参加者はreliable_addressesに分け、連番つきのデータグラムを送る
+        # 圧縮して送る場合は(圧縮を受け取る参加者, それ以外)に分けたものを使う
+        self.addresses = ()
+        self.reliable_addresses = ()
+        self.split_addresses = ((), ())
+        self.split_reliable_addresses = ((), ())
+        # 断片を受け取れる、信頼モードでない参加者のアドレス(圧縮の有無で分けたもの)
+        self.fragment_addresses = ()
+        self.split_fragment_addresses = ((), ())
+        self.closed = False
+        self.lock = threading.Lock()
+        # 直近メッセージのリングバッファ
+        self.history = message_history if message_history is not None else history.MessageHistory()
+        # 部屋全体の送信レート制限(TokenBucket、Noneなら制限しない)
+        self.rate_limit = rate_limit
+        # 信頼モードの連番の割り当てと再送用の直近データグラム
+        self.resend_window = resend_window if resend_window is not None else reliable.ResendWindow()
 
     def generate_token(self):
         """トークンを生成する
-        
+
         :return: トークン
         """
         return secrets.token_hex(16)
-    
-    def add_user(self, token, user_address, user_name):
+
+    def snapshot(self):
+        """参加者のスナップショットを取得する
+
+        返す辞書は以後変更されないので、ブロードキャスト中に入退室があっても安全に走査できる。
+
+        :return: 参加者(トークン(byte) -> Member)
+        """
+        return self.members
+
+    def get_member(self, token):
+        """トークンに対応する参加者を取得する
+
+        :param token: トークン(byte)
+        :return: 参加者(存在しない場合はNone)
+        """
+        return self.members.get(token)
+
+    def add_user(
+        self,
+        token,
+        user_address,
+        user_name,
+        session_id=None,
+        reliable=False,
+        compress=False,
+        fragment=False,
+    ):
         """チャットルームにユーザー追加
-        
-        :return: 成否
+
+        :param session_id: サーバーが割り当てたセッションID
+        :param reliable: 信頼モードで参加するか
+        :param compress: 圧縮データグラムを受け取るか
+        :param fragment: 断片を受け取れるか
+        :return: 追加した参加者(失敗時はNone)
         """
-        MAX_USERS = 1000
-        if len(self.token_to_addrs) <= MAX_USERS:
-            self.token_to_addrs[token] = user_address
-            self.token_to_user_name[token] = user_name
-            return True
-        else:
-            print(f"{self.name} is full")
-            return False
+        with self.lock:
+            if self.closed:
+                logger.info("%s is closed", self.name)
+                return None
+            if len(self.members) >= ChatRoom.MAX_USERS:
+                logger.info("%s is full", self.name)
+                return None
+            member = Member(
+                token,
+                session_id,
+                self,
+                tuple(user_address),
+                user_name,
+                reliable,
+                compress,
+                fragment,
+            )
+            members = dict(self.members)
+            members[token.encode("utf-8")] = member
+            if not self.host_token:
+                # ログから復元した部屋にはホストがいないので、最初に参加した人をホストにする
+                self.host_token = token
+            # 連番の割り当てと同じロックの中で送信先を差し替え、最初に受信する連番を決める。
+            # これ以降に連番を割り当てたメッセージは、差し替えた送信先(この参加者を含む)へ送られる
+            with self.resend_window.lock:
+                self.__publish(members)
+                member.first_sequence = self.resend_window.next_sequence
+            return member
 
     def remove_user(self, token):
         """チャットルームからユーザー削除
-        
+
         :return: 成否
         """
-        if token in self.token_to_addrs:
-            del self.token_to_addrs[token]
-            del self.token_to_user_name[token]
+        token_key = token.encode("utf-8")
+        with self.lock:
+            if token_key not in self.members:
+                return False
+            members = dict(self.members)
+            del members[token_key]
+            self.__publish(members)
+            return True
 
     def remove_all_users(self):
-        """全ユーザーチャットルームから削除(ホスト退出)"""
-        tokens_to_romove = self.token_to_addrs.copy
-        for token in tokens_to_romove:
-            if self.remove_user(token):
-                self.users = {}
-                self.token_to_addrs = {}
-                self.messages = []
\ No newline at end of file
+        """全ユーザーチャットルームから削除(ホスト退出)
+
+        参加者の取得と削除を同じロックの中で行うので、直前に参加した人も取りこぼさない。
+        履歴の削除(永続化している場合はファイルの削除)は呼び出し側で後から行う。
+
+        :return: 削除した参加者(トークン(byte) -> Member)
+        """
+        with self.lock:
+            self.closed = True
+            members = self.members
+            self.__publish({})
+        return members
+
+    def hand_off(self, token):
+        """ホストを退出させ、最も長く参加している参加者をホストにする
+
+        membersは参加した順に並んでいる(差し替えても辞書の順序は保たれる)ので、先頭が最も古い。
+
+        :param token: 退出するホストのトークン
+        :return: 新しいホスト(ほかに参加者がいない場合はNone、何も変更しない)
+        """
+        token_key = token.encode("utf-8")
+        with self.lock:
+            members = dict(self.members)
+            members.pop(token_key, None)
+            if not members:
+                return None
+            new_host = next(iter(members.values()))
+            self.host_token = new_host.token
+            self.__publish(members)
+            return new_host
+
+    def __publish(self, members):
+        """参加者と送信先アドレスを差し替える(self.lockを保持して呼ぶ)
+
+        :param members: 新しい参加者(トークン(byte) -> Member)
+        """
+        self.addresses = tuple(
+            member.address for member in members.values() if not member.reliable
+        )
+        self.reliable_addresses = tuple(
+            member.address for member in members.values() if member.reliable
+        )
+        # 圧縮の有無は参加中に変わらないので、分けた組を1つの属性で差し替えれば
+        # 読み取り側が新旧の組を混ぜても圧縮を受け取らない参加者に圧縮して送ることはない
+        fragment_members = [
+            member for member in members.values() if member.fragment and not member.reliable
+        ]
+        self.fragment_addresses = tuple(member.address for member in fragment_members)
+        self.split_addresses = self.__split(
+            [member for member in members.values() if not member.reliable]
+        )
+        self.split_reliable_addresses = self.__split(
+            [member for member in members.values() if member.reliable]
+        )
+        self.split_fragment_addresses = self.__split(fragment_members)
+        self.members = members
+
+    @staticmethod
+    def __split(group):
+        """送信先アドレスを圧縮の有無で分ける
+
+        :param group: 参加者のリスト
+        :return: (圧縮を受け取る参加者のアドレス, それ以外のアドレス)
+        """
+        return (
+            tuple(member.address for member in group if member.compress),
+            tuple(member.address for member in group if not member.compress),
+        )
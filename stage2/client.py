@@ -1,18 +1,24 @@
-import socket
 import json
-import struct
 import threading
 
+import control
+import handshake
+import history
+import packet
 from user import User
 
 
 class Client:
     def __init__(self):
         self.tcp_address = ("127.0.0.1", 9002)
-        self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # 部屋の作成・参加を送るコントロールチャネル(失敗しても同じ接続で再試行する)
+        self.channel = None
         # クライアントが入力したアクション番号
         self.CREATE_ROOM = 1
         self.JOIN_ROOM = 2
+        self.FETCH_HISTORY = 4
+        # 入室時に取得する履歴の件数
+        self.HISTORY_COUNT = 20
         # state
         self.SERVER_INIT = 0
         self.REQUEST_COMPLETION = 2
@@ -30,28 +36,34 @@ class Client:
             tcp_connected = self.__check_tcp_connection(int(operation))
             if not tcp_connected:
                 print("Closing connection...")
-                self.tcp_socket.close()
+                if self.channel is not None:
+                    self.channel.close()
                 print("Connection closed.")
                 exit()
 
             # 部屋名を入力
             room_name = user.get_room_name()
-            # 入室リクエストを送信
-            self.__request_to_join_room(operation, user, room_name)
-            # 入室リクエストのレスポンスを受け取る
-            token = self.__receive_response_to_join_room()
+            # 入室リクエストを送信し、レスポンスを受け取る
+            responses = self.__request_to_join_room(operation, user, room_name)
+            token, session_id, sequence, udp_address = self.__receive_response_to_join_room(
+                responses
+            )
 
             if token is not None:
                 user.token = token
+                user.session_id = session_id
+                # クラスター構成では部屋を担当するノードへ直接メッセージを送る
+                if udp_address is not None:
+                    user.udp_server_address = tuple(udp_address)
+                user.mac_key = packet.session_key(token)
+                user.receiver.start(sequence)
                 # 参加した部屋名をセット
                 user.room_name = room_name
                 break
 
-        # TCP接続を閉じる
-        self.tcp_socket.close()
+        # コントロールチャネルを閉じる
+        self.channel.close()
 
-        # 部屋に参加してからタイマースタート
-        user.start_timer()
         # 他クライアントからのメッセージを別スレッドで受信
         threading.Thread(target=user.receive_message).start()
         # メッセージを送信
@@ -85,7 +97,9 @@ class Client:
         """
         tcp_connected = False
         if operation == self.CREATE_ROOM or operation == self.JOIN_ROOM:
-            self.tcp_socket.connect(self.tcp_address)
+            # 2回目以降は開いているチャネルを使い回す
+            if self.channel is None:
+                self.channel = control.ControlChannel(self.tcp_address)
             tcp_connected = True
 
         return tcp_connected
@@ -96,52 +110,58 @@ class Client:
         :param operation: クライアントが入力したアクション番号(1:部屋作成, 2:参加)
         :param user(インスタンス): ユーザー
         :param room_name: チャットルーム名
+        :return: レスポンスのリスト[(アクション番号, 状態コード, ペイロード)]
         """
-
-        encoded_room_name = room_name.encode("utf-8")
-        payload = {
-            "user_name": user.user_name,
-            "user_address": user.address,
-        }
-        payload_data = json.dumps(payload).encode("utf-8")
-        # ヘッダーを作成
-        header = struct.pack(
-            "!B B B 29s",
-            len(encoded_room_name),
-            int(operation),
-            self.SERVER_INIT,
-            len(payload_data).to_bytes(29, byteorder="big"),
+        # バイナリ形式(handshake.VERSION)のOperationPayloadを作成
+        payload_data = handshake.pack_join_request(
+            user.user_name,
+            user.address,
+            self.HISTORY_COUNT,
+            user.reliable_mode,
+            user.compress,
+            udp_address=True,
+            fragment=True,
         )
-        # ボディを作成
-        # Todo OperationPayloadSizeの最大バイト数を超えた場合の例外処理
-        body = encoded_room_name + payload_data
-
-        # ヘッダーとボディをサーバーに送信
-        req = header + body
-        self.tcp_socket.sendall(req)
+        return self.channel.request(int(operation), room_name, payload_data)
 
-    def __receive_response_to_join_room(self):
-        """部屋入室リクエストのレスポンスを受け取る
+    def __receive_response_to_join_room(self, responses):
+        """部屋入室リクエストのレスポンスを処理する
 
-        return : トークン
+        :param responses: レスポンスのリスト(入室完了時は履歴が続く)
+        return : (トークン, セッションID, 信頼モードで最初に受信する連番, 送信先のUDPアドレス)
         """
-        header = self.tcp_socket.recv(32)
-        _, _, state, payload_size = struct.unpack_from("!B B B 29s", header)
-        operation_payload_size = int.from_bytes(payload_size, byteorder="big")
-        payload = self.tcp_socket.recv(operation_payload_size)
-
-        if state == self.SERVER_INIT:
-            print(json.loads(payload.decode("utf-8"))["message"])
-            self.tcp_socket.close()
-            self.__init__()
-            return None
-        elif state == self.REQUEST_COMPLETION:
-            # トークンを取得
-            token = json.loads(payload.decode("utf-8"))["token"]
-            message = json.loads(payload.decode("utf-8"))["message"]
-            print(message)
-            return token
-
+        _, state, payload = responses[0]
+        # サーバーはリクエストと同じ形式(バイナリ/JSON)で返す
+        if handshake.is_binary(payload):
+            response = handshake.unpack_join_response(payload, udp_address=True)
+        else:
+            response = json.loads(payload.decode("utf-8"))
+
+        if state != self.REQUEST_COMPLETION:
+            print(response["message"])
+            return None, None, None, None
+        else:
+            # トークンとセッションIDを取得
+            print(response["message"])
+            if response["token"] is not None:
+                self.__print_history(responses[1:])
+            return (
+                response["token"],
+                response.get("session_id"),
+                response.get("sequence", 1),
+                response.get("udp_address"),
+            )
+
+    def __print_history(self, responses):
+        """入室完了レスポンスに続いて送られた履歴を表示する
+
+        :param responses: 入室完了レスポンス以降のレスポンス
+        """
+        for operation, _, payload in responses:
+            if operation != self.FETCH_HISTORY:
+                continue
+            for frame in history.unpack_frames(payload):
+                print(frame.decode("utf-8"))
 
 if __name__ == "__main__":
     print("---WELCOME TO THE CHAT MESSENGER PROGRAM!---")
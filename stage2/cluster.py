@@ -0,0 +1,520 @@
+import argparse
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import socket
+import time
+
+import async_server
+import logger as log_config
+import metrics
+import tcrp
+import workers
+
+logger = logging.getLogger("chat")
+
+
+def ring_hash(data):
+    """ハッシュリング上の位置を求める
+
+    CRC32は"node0:1"のように似た文字列で値が偏るため、BLAKE2sの先頭4バイトを使う。
+
+    :param data: ノードの仮想ノード名またはチャットルーム名(byte)
+    :return: 位置(32bit)
+    """
+    return int.from_bytes(hashlib.blake2s(data, digest_size=4).digest(), "big")
+
+
+class HashRing:
+    """チャットルーム名からノードを求めるコンシステントハッシュ
+
+    ノードごとにreplicas個の仮想ノードを環状に配置し、部屋名のハッシュ値以上で最初の
+    仮想ノードのノードが部屋を担当する。ノードが増減しても移動する部屋は全体の約1/ノード数で済む。
+    """
+
+    def __init__(self, node_ids=(), replicas=64):
+        """
+        :param node_ids: ノードIDのリスト
+        :param replicas: 1ノードあたりの仮想ノード数
+        """
+        points = sorted(
+            (ring_hash(f"{node_id}:{i}".encode("utf-8")), node_id)
+            for node_id in node_ids
+            for i in range(replicas)
+        )
+        self.points = [point for point, _ in points]
+        self.node_ids = [node_id for _, node_id in points]
+
+    def __len__(self):
+        return len(set(self.node_ids))
+
+    def owner(self, room_name):
+        """チャットルームを担当するノードを求める
+
+        :param room_name: チャットルーム名(byte)
+        :return: ノードID(ノードがなければNone)
+        """
+        if not self.points:
+            return None
+        i = bisect.bisect_left(self.points, ring_hash(room_name))
+        return self.node_ids[i % len(self.node_ids)]
+
+
+def request_coordinator(address, request, timeout=2.0):
+    """コーディネーターにリクエストを送り、レスポンスを受け取る
+
+    :param address: コーディネーターのアドレス
+    :param request: リクエスト(辞書)
+    :param timeout: タイムアウト(秒)
+    :return: レスポンス(辞書)
+    """
+    with socket.create_connection(address, timeout=timeout) as conn:
+        conn.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        with conn.makefile("rb") as reader:
+            line = reader.readline()
+    if not line:
+        raise ConnectionError("coordinator closed the connection")
+    return json.loads(line.decode("utf-8"))
+
+
+class Coordinator:
+    """どのノードがどのチャットルームを担当するかを答えるコーディネーター
+
+    部屋を作成したノードを部屋名ごとに記録し、作成済みの部屋はノードが増減しても同じノードが答える。
+    まだない部屋はハッシュリングで作成するノードを決める。
+    ノードは定期的にregisterを送り(ハートビートを兼ねる)、node_timeout秒送らなかったノードは外す。
+    外れたノードの部屋の記録は残し、同じノードIDで戻ってくれば再び答える。
+    プロトコルは1接続1リクエストの改行区切りJSON。
+    - register: {"op": "register", "node_id", "tcp_address", "udp_address", "peer_address",
+      "rooms"(省略可)} -> ノード一覧(roomsを指定するとそのノードの部屋の記録を置き換える)
+    - leave: {"op": "leave", "node_id"} -> ノード一覧(そのノードの部屋の記録も消す)
+    - lookup: {"op": "lookup", "room_name"} -> 部屋を持つ(または作成する)ノード
+    - create: {"op": "create", "room_name", "node_id"} -> 記録できたか(ほかのノードにあれば409)
+    - remove: {"op": "remove", "room_name", "node_id"} -> 部屋の記録を消す
+    - nodes: {"op": "nodes"} -> ノード一覧
+    """
+
+    def __init__(self, address=("127.0.0.1", 9100), node_timeout=5.0, replicas=64):
+        """
+        :param address: 待ち受けるアドレス
+        :param node_timeout: ハートビートが途絶えたノードを外すまでの秒数
+        :param replicas: 1ノードあたりの仮想ノード数
+        """
+        self.address = address
+        self.node_timeout = node_timeout
+        self.replicas = replicas
+        # ノードID -> (ノード情報, 最後にregisterを受け取った時刻)
+        self.nodes = {}
+        self.ring = HashRing(replicas=replicas)
+        # チャットルーム名 -> 部屋を作成したノードID
+        self.rooms = {}
+
+    def live_nodes(self):
+        """ハートビートの途絶えたノードを外してから、ノード一覧を返す
+
+        :return: ノード情報のリスト(ノードID順)
+        """
+        now = time.monotonic()
+        expired = [
+            node_id
+            for node_id, (_, seen_at) in self.nodes.items()
+            if now - seen_at > self.node_timeout
+        ]
+        for node_id in expired:
+            logger.info("Node %s expired", node_id)
+            del self.nodes[node_id]
+        if expired:
+            self.rebuild()
+        return [self.nodes[node_id][0] for node_id in sorted(self.nodes)]
+
+    def rebuild(self):
+        """ノード一覧からハッシュリングを作り直す"""
+        self.ring = HashRing(self.nodes, self.replicas)
+
+    def forget_rooms(self, node_id):
+        """ノードの部屋の記録を消す
+
+        :param node_id: ノードID
+        """
+        self.rooms = {name: owner for name, owner in self.rooms.items() if owner != node_id}
+
+    def handle_request(self, request):
+        """リクエストを処理する
+
+        :param request: リクエスト(辞書)
+        :return: レスポンス(辞書)
+        """
+        op = request.get("op")
+        if op == "register":
+            node = {
+                "node_id": str(request["node_id"]),
+                "tcp_address": list(request["tcp_address"]),
+                "udp_address": list(request["udp_address"]),
+                "peer_address": list(request["peer_address"]),
+            }
+            node_id = node["node_id"]
+            joined = node_id not in self.nodes
+            self.nodes[node_id] = (node, time.monotonic())
+            if joined:
+                logger.info("Node %s joined", node_id)
+                self.rebuild()
+            response = {"status": 200, "nodes": self.live_nodes()}
+            if "rooms" in request:
+                self.forget_rooms(node_id)
+                for room_name in request["rooms"]:
+                    self.rooms[str(room_name)] = node_id
+            elif joined:
+                # コーディネーターが再起動した場合などは、部屋の一覧を送り直してもらう
+                response["resync"] = True
+            return response
+        if op == "leave":
+            node_id = str(request["node_id"])
+            if self.nodes.pop(node_id, None) is not None:
+                logger.info("Node %s left", node_id)
+                self.rebuild()
+            self.forget_rooms(node_id)
+            return {"status": 200, "nodes": self.live_nodes()}
+        if op == "lookup":
+            self.live_nodes()
+            room_name = str(request["room_name"])
+            node_id = self.rooms.get(room_name)
+            created = node_id is not None
+            if not created:
+                node_id = self.ring.owner(room_name.encode("utf-8"))
+            if node_id not in self.nodes:
+                return {"status": 503, "message": "no node for room"}
+            return {"status": 200, "node": self.nodes[node_id][0], "created": created}
+        if op == "create":
+            room_name = str(request["room_name"])
+            node_id = str(request["node_id"])
+            owner = self.rooms.setdefault(room_name, node_id)
+            if owner != node_id:
+                return {"status": 409, "node_id": owner}
+            return {"status": 200}
+        if op == "remove":
+            room_name = str(request["room_name"])
+            if self.rooms.get(room_name) == str(request["node_id"]):
+                del self.rooms[room_name]
+            return {"status": 200}
+        if op == "nodes":
+            return {"status": 200, "nodes": self.live_nodes()}
+        return {"status": 400, "message": f"unknown op: {op}"}
+
+    async def handle_conn(self, reader, writer):
+        """1接続で1つのリクエストを処理する
+
+        :param reader: StreamReader
+        :param writer: StreamWriter
+        """
+        try:
+            line = await asyncio.wait_for(reader.readline(), 5.0)
+            try:
+                response = self.handle_request(json.loads(line.decode("utf-8")))
+            except (ValueError, KeyError, TypeError) as e:
+                response = {"status": 400, "message": str(e)}
+            writer.write(json.dumps(response).encode("utf-8") + b"\n")
+            await writer.drain()
+        except (asyncio.TimeoutError, OSError) as e:
+            logger.warning("Coordinator Error: %r", e)
+        finally:
+            writer.close()
+
+    async def serve(self):
+        """待ち受ける"""
+        coordinator = await asyncio.start_server(self.handle_conn, *self.address)
+        async with coordinator:
+            await coordinator.serve_forever()
+
+    def start(self):
+        """コーディネーターを起動する"""
+        logger.info("Coordinator started Port: %d", self.address[1])
+        asyncio.run(self.serve())
+
+
+class ClusterServer(async_server.AsyncServer):
+    """複数のノードでチャットルームを分担するクラスターのノード
+
+    自ノードにない部屋へのTCRPリクエストは、コーディネーターに部屋を持つノードを問い合わせ、
+    ノード間通信用のソケット(クライアント用のTCPポートとは別)で中継して、担当ノードのレスポンスを
+    そのまま返す。レスポンスには担当ノードのUDPアドレスが入るので、クライアントは以降の
+    メッセージを担当ノードへ直接送る(UDPはノード間で転送しない)。
+    部屋は作成したノードに残り、ノードが増減しても移動しない。
+    """
+
+    def __init__(
+        self,
+        node_id,
+        coordinator_address,
+        advertise_tcp_address=None,
+        peer_address=None,
+        refresh_interval=1.0,
+        **kwargs,
+    ):
+        """
+        :param node_id: ノードID(クラスター内で一意)
+        :param coordinator_address: コーディネーターのアドレス
+        :param advertise_tcp_address: ほかのノードから届くTCPアドレス(省略時は待ち受けアドレス)
+        :param peer_address: ノード間通信を待ち受けるアドレス(省略時はTCPと同じホストの空きポート)
+        :param refresh_interval: ノード一覧を取得し直す間隔(秒、ハートビートを兼ねる)
+        """
+        super().__init__(**kwargs)
+        self.node_id = node_id
+        self.coordinator_address = coordinator_address
+        self.advertise_tcp_address = advertise_tcp_address or self.tcp_socket.getsockname()
+        self.peer_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.peer_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.peer_socket.bind(peer_address or (self.tcp_address[0], 0))
+        self.advertise_peer_address = (
+            self.advertise_tcp_address[0],
+            self.peer_socket.getsockname()[1],
+        )
+        self.refresh_interval = refresh_interval
+        # ノードID -> ノード情報
+        self.nodes = {}
+        self.proxied = self.metrics.add(
+            metrics.Counter(
+                "chat_cluster_proxied_total", "TCRP requests proxied to the owning node"
+            )
+        )
+        self.metrics.add(
+            metrics.Gauge("chat_cluster_nodes", "nodes in the cluster", lambda: len(self.nodes))
+        )
+
+    def node_info(self, rooms=False):
+        """コーディネーターに登録する情報
+
+        :param rooms: このノードにある部屋の一覧を含めるか
+        :return: registerリクエスト(辞書)
+        """
+        request = {
+            "op": "register",
+            "node_id": self.node_id,
+            "tcp_address": list(self.advertise_tcp_address),
+            "udp_address": list(self.advertise_udp_address),
+            "peer_address": list(self.advertise_peer_address),
+        }
+        if rooms:
+            request["rooms"] = [room.name for room in self.rooms.search(limit=len(self.rooms))[0]]
+        return request
+
+    async def coordinator_request(self, request):
+        """イベントループを止めずにコーディネーターへリクエストを送る
+
+        :param request: リクエスト(辞書)
+        :return: レスポンス(辞書)
+        """
+        return await asyncio.to_thread(request_coordinator, self.coordinator_address, request)
+
+    async def register(self, rooms=False):
+        """コーディネーターに登録し、ノード一覧を更新する
+
+        :param rooms: このノードにある部屋の一覧を送るか(起動時と再同期時)
+        """
+        response = await self.coordinator_request(self.node_info(rooms))
+        if response.get("resync"):
+            response = await self.coordinator_request(self.node_info(rooms=True))
+        nodes = {node["node_id"]: node for node in response["nodes"]}
+        if nodes.keys() != self.nodes.keys():
+            logger.info("Cluster nodes: %s", ", ".join(sorted(nodes)))
+        self.nodes = nodes
+
+    async def refresh_nodes(self):
+        """一定間隔でコーディネーターに登録し、ノード一覧を取得し直す"""
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.register()
+            except (OSError, ValueError, KeyError) as e:
+                # 取得できなければ前回のノード一覧のまま続ける
+                logger.warning("Coordinator unavailable: %r", e)
+
+    async def process_tcrp_request(self, header, body):
+        """自ノードにある部屋ならそのまま処理し、そうでなければ部屋を持つノードに中継する
+
+        :param header: リクエストヘッダー
+        :param body: リクエストボディ
+        :return: レスポンス
+        """
+        room_name_size, operation, _, _ = tcrp.unpack_header(header)
+        if operation == self.LIST_ROOMS:
+            return await self.list_all_rooms(header, body)
+        room_name = bytes(body[:room_name_size]).decode("utf-8")
+        if self.rooms.get(room_name) is not None:
+            return await self.handle_owned_request(header, body)
+        try:
+            response = await self.coordinator_request({"op": "lookup", "room_name": room_name})
+            if response["status"] != 200:
+                raise LookupError(response.get("message"))
+            node = response["node"]
+            if node["node_id"] == self.node_id:
+                return await self.handle_owned_request(header, body)
+            response = await self.request_node(node, header, body)
+        except (OSError, ValueError, LookupError, asyncio.TimeoutError) as e:
+            logger.warning("Room %s unavailable: %r", room_name, e)
+            return self.build_state_res(room_name, operation, self.ERROR_RESPONSE)
+        self.proxied.inc()
+        return response
+
+    async def handle_owned_request(self, header, body):
+        """このノードでTCRPリクエストを処理する(作成はコーディネーターに記録してから行う)
+
+        :param header: リクエストヘッダー
+        :param body: リクエストボディ
+        :return: レスポンス
+        """
+        room_name_size, operation, _, _ = tcrp.unpack_header(header)
+        if operation == self.CREATE_ROOM:
+            room_name = bytes(body[:room_name_size]).decode("utf-8")
+            try:
+                response = await self.coordinator_request(
+                    {"op": "create", "room_name": room_name, "node_id": self.node_id}
+                )
+            except (OSError, ValueError) as e:
+                logger.warning("Coordinator unavailable: %r", e)
+                return self.build_state_res(room_name, operation, self.ERROR_RESPONSE)
+            if response["status"] != 200:
+                # ほかのノードに同名の部屋がある
+                return self.build_state_res(room_name, operation, self.SERVER_INIT)
+        return self.handle_tcrp_request(header, body)
+
+    async def request_node(self, node, header, body):
+        """ほかのノードのノード間通信用ソケットにTCRPリクエストを中継する
+
+        :param node: 中継先のノード情報
+        :return: レスポンス
+        """
+        host, port = node["peer_address"]
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port), self.read_timeout
+        )
+        try:
+            writer.write(header + body)
+            await writer.drain()
+            # 中継先はレスポンスを書き終えると接続を閉じる
+            return await asyncio.wait_for(reader.read(), self.read_timeout)
+        finally:
+            writer.close()
+
+    async def handle_peer_conn(self, reader, writer):
+        """ほかのノードから中継されたTCRPリクエストをこのノードで処理する
+
+        :param reader: StreamReader
+        :param writer: StreamWriter
+        """
+        try:
+            header, body = await asyncio.wait_for(self.read_request(reader), self.read_timeout)
+            writer.write(await self.handle_owned_request(header, body))
+            await asyncio.wait_for(writer.drain(), self.read_timeout)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, OSError, ValueError) as e:
+            logger.warning("Server Error1: %r", e)
+        finally:
+            writer.close()
+
+    def leave_room(self, room, member, timed_out=False):
+        """退出させ、部屋が終了したらコーディネーターの記録を消す
+
+        :param room: チャットルーム
+        :param member: 退出する参加者(Member)
+        :param timed_out: タイムアウトによる退出か
+        """
+        was_open = self.rooms.get(room.name) is room
+        super().leave_room(room, member, timed_out)
+        if was_open and self.rooms.get(room.name) is not room:
+            asyncio.get_running_loop().create_task(self.remove_room(room.name))
+
+    async def remove_room(self, room_name):
+        """終了した部屋の記録をコーディネーターから消す
+
+        消せなくても、記録の残った部屋名への参加はこのノードが「存在しない」と答え、
+        作成はこのノードで行われるので、部屋名の一意性は保たれる。
+
+        :param room_name: チャットルーム名
+        """
+        if self.rooms.get(room_name) is not None:
+            # 同じ名前で作り直された
+            return
+        try:
+            await self.coordinator_request(
+                {"op": "remove", "room_name": room_name, "node_id": self.node_id}
+            )
+        except (OSError, ValueError) as e:
+            logger.info("Coordinator unavailable: %r", e)
+
+    async def list_all_rooms(self, header, body):
+        """全ノードのチャットルーム一覧を名前順にまとめて返す(応答のないノードは除く)
+
+        :return: レスポンス
+        """
+        results = await asyncio.gather(
+            *(
+                self.request_node(node, header, body)
+                for node_id, node in self.nodes.items()
+                if node_id != self.node_id
+            ),
+            return_exceptions=True,
+        )
+        responses = [self.handle_tcrp_request(header, body)]
+        responses.extend(result for result in results if isinstance(result, bytes))
+        res_payload = workers.merge_room_lists(
+            responses, workers.list_limit(header, body, self.MAX_LIST_ROOMS)
+        )
+        return (
+            tcrp.pack_header(0, self.LIST_ROOMS, self.REQUEST_COMPLETION, len(res_payload))
+            + res_payload
+        )
+
+    async def serve(self):
+        """コーディネーターに部屋の一覧を登録してから待機し、終了時にクラスターから外れる
+
+        ログから復元した部屋はこのノードが作成したものなので、すべて登録し直す。
+        """
+        try:
+            await self.register(rooms=True)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("Coordinator unavailable: %r", e)
+        peer_server = await asyncio.start_server(self.handle_peer_conn, sock=self.peer_socket)
+        refresh_task = asyncio.create_task(self.refresh_nodes())
+        try:
+            await super().serve()
+        finally:
+            refresh_task.cancel()
+            peer_server.close()
+            try:
+                await self.coordinator_request({"op": "leave", "node_id": self.node_id})
+            except (OSError, ValueError) as e:
+                logger.info("Coordinator unavailable: %r", e)
+
+
+def parse_address(value, default_host="127.0.0.1"):
+    """HOST:PORT形式のアドレスを解析する
+
+    :param value: アドレス(HOSTは省略可)
+    :param default_host: HOSTを省略したときのホスト
+    :return: (ホスト, ポート番号)
+    """
+    host, _, port = value.rpartition(":")
+    return host or default_host, int(port)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Online Chat Messenger cluster coordinator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument(
+        "--node-timeout",
+        type=float,
+        default=5.0,
+        help="seconds without a heartbeat before a node is dropped",
+    )
+    parser.add_argument(
+        "--log-level", choices=list(log_config.LEVELS), default="info", help="log level"
+    )
+    args = parser.parse_args()
+    log_config.setup_logging(args.log_level)
+
+    try:
+        Coordinator((args.host, args.port), node_timeout=args.node_timeout).start()
+    except KeyboardInterrupt:
+        print("\nCoordinator closed")
@@ -0,0 +1,159 @@
+import itertools
+import threading
+import time
+import weakref
+from collections import deque
+
+import packet
+
+
+class Coalescer:
+    """部屋ごとに送信待ちのメッセージをためて、まとめて送信する
+
+    最初のメッセージからwindow秒経つか、ためたサイズがmax_bytesに達したら送信する。
+    送信はflush(部屋, [(送信者, データ, 連番つきデータグラム)])を呼んで行う。
+    スレッドモードではrunを専用スレッドで動かし、期限の来た部屋を送信する。
+    ウィンドウは一定なので、期限はメッセージが来た順に並ぶ(dequeで足りる)。
+    同じ部屋の送信は部屋ごとのロックで直列にし、取り出した順に送る。
+    ためはじめるたびに番号を振り、期限は番号で管理する(上限に達して先に送った分の期限で
+    次の送信待ちを早く送らない)。
+    """
+
+    def __init__(self, window, max_bytes, flush, clock=time.monotonic):
+        """
+        :param window: まとめる時間(秒)
+        :param max_bytes: 1つの結合データグラムの上限(MTU未満にする)
+        :param flush: 送信する関数(部屋, エントリーのリスト)
+        :param clock: 現在時刻を返す関数
+        """
+        self.window = window
+        self.max_bytes = max_bytes
+        self.flush = flush
+        self.clock = clock
+        # 部屋 -> [エントリーのリスト, 結合後のバイト数, 番号]
+        self.pending = {}
+        # (期限, 部屋, 番号)
+        self.deadlines = deque()
+        self.batch_ids = itertools.count(1)
+        # 部屋 -> 送信を直列にするロック(部屋が破棄されたら消える)
+        self.flush_locks = weakref.WeakKeyDictionary()
+        # ロックの順序は部屋ごとのロック -> self.lock
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+
+    def add(self, room, sender, data, datagram=None):
+        """送信待ちに追加する(上限に達したら呼び出し元のスレッドで送信する)
+
+        :param room: チャットルーム
+        :param sender: 送信者(Member)
+        :param data: 送信データ(byte)
+        :param datagram: 信頼モードの参加者へ送る連番つきデータグラム
+        :return: 新しくためはじめた場合はその番号(期限の管理が必要)、そうでなければNone
+        """
+        # 信頼モードのデータグラムの方が大きいので、そちらでサイズを見積もる
+        entry = (sender, data, datagram)
+        size = packet.BATCH_LENGTH.size + len(datagram if datagram is not None else data)
+        with self.lock:
+            added, batch_id = self.__append(room, entry, size)
+            if added:
+                return batch_id
+        # 上限に達したので、ほかのスレッドの送信と順序が入れ替わらないよう部屋のロックを取ってから送る
+        with self.__flush_lock(room):
+            with self.lock:
+                added, batch_id = self.__append(room, entry, size)
+                full = None
+                if not added:
+                    full = self.pending.pop(room)[0]
+                    _, batch_id = self.__append(room, entry, size)
+            if full is not None:
+                self.flush(room, full)
+        return batch_id
+
+    def __append(self, room, entry, size):
+        """送信待ちに追加する(self.lockを保持して呼ぶ)
+
+        :return: (追加できたか, 新しくためはじめた場合はその番号)
+        """
+        batch = self.pending.get(room)
+        if batch is None:
+            batch_id = next(self.batch_ids)
+            self.pending[room] = [[entry], packet.BATCH_HEADER.size + size, batch_id]
+            return True, batch_id
+        if batch[1] + size > self.max_bytes:
+            return False, None
+        batch[0].append(entry)
+        batch[1] += size
+        return True, None
+
+    def __flush_lock(self, room):
+        """部屋の送信を直列にするロックを取得する
+
+        :param room: チャットルーム
+        :return: ロック
+        """
+        with self.lock:
+            lock = self.flush_locks.get(room)
+            if lock is None:
+                lock = self.flush_locks[room] = threading.Lock()
+            return lock
+
+    def take(self, room, batch_id=None):
+        """部屋の送信待ちを取り出す
+
+        :param room: チャットルーム
+        :param batch_id: 番号(指定した場合は同じ番号の送信待ちだけを取り出す)
+        :return: エントリーのリスト(なければNone)
+        """
+        with self.lock:
+            batch = self.pending.get(room)
+            if batch is None or (batch_id is not None and batch[2] != batch_id):
+                return None
+            del self.pending[room]
+        return batch[0]
+
+    def flush_room(self, room, batch_id=None):
+        """部屋の送信待ちをすぐに送信する
+
+        :param room: チャットルーム
+        :param batch_id: 番号(期限による送信では、期限を登録した送信待ちが残っている場合だけ送る)
+        """
+        with self.__flush_lock(room):
+            entries = self.take(room, batch_id)
+            if entries is not None:
+                self.flush(room, entries)
+
+    def flush_before(self, room, send):
+        """部屋の送信待ちを送ってから、続けてsendを呼ぶ(まとめずにすぐ送るメッセージ用)
+
+        :param room: チャットルーム
+        :param send: 送信待ちの後に送る関数
+        """
+        with self.__flush_lock(room):
+            entries = self.take(room)
+            if entries is not None:
+                self.flush(room, entries)
+            send()
+
+    def schedule(self, room, batch_id):
+        """window秒後に送信するよう登録する(スレッドモード)
+
+        :param room: チャットルーム
+        :param batch_id: addが返した番号
+        """
+        with self.ready:
+            self.deadlines.append((self.clock() + self.window, room, batch_id))
+            self.ready.notify()
+
+    def run(self):
+        """期限の来た部屋を送信し続ける(スレッドモード)"""
+        while True:
+            with self.ready:
+                while not self.deadlines:
+                    self.ready.wait()
+                deadline, room, batch_id = self.deadlines[0]
+                delay = deadline - self.clock()
+                if delay > 0:
+                    self.ready.wait(delay)
+                    continue
+                self.deadlines.popleft()
+            self.flush_room(room, batch_id)
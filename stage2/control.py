@@ -0,0 +1,152 @@
+import itertools
+import socket
+import struct
+import time
+
+import tcrp
+
+# コントロールチャネルのフレーム: RequestId(4) | Length(4) | TCRPメッセージ
+# リクエストはTCRPリクエスト(ヘッダー + ボディ)を1つ、
+# レスポンスはTCRPレスポンス(ヘッダー + ペイロード)を1つ以上連結して入れる
+FRAME_HEADER = struct.Struct("!I I")
+MAX_FRAME_BYTE_SIZE = tcrp.HEADER_BYTE_SIZE + tcrp.MAX_BODY_BYTE_SIZE
+
+
+def pack_frame(request_id, message):
+    """フレームを作成する
+
+    :param request_id: リクエストID
+    :param message: TCRPメッセージ
+    :return: フレーム
+    """
+    return FRAME_HEADER.pack(request_id, len(message)) + message
+
+
+def unpack_frame_header(data):
+    """フレームヘッダーを解析する
+
+    :param data: フレームヘッダー(8バイト)
+    :return: (リクエストID, TCRPメッセージのバイト数)
+    """
+    request_id, length = FRAME_HEADER.unpack(data)
+    if length < tcrp.HEADER_BYTE_SIZE or length > MAX_FRAME_BYTE_SIZE:
+        raise ValueError(f"invalid control frame length: {length}")
+    return request_id, length
+
+
+def split_request(message):
+    """フレーム内のTCRPリクエストをヘッダーとボディに分ける
+
+    :param message: TCRPメッセージ
+    :return: (ヘッダー, ボディ)
+    """
+    header = message[: tcrp.HEADER_BYTE_SIZE]
+    room_name_size, _, _, payload_size = tcrp.unpack_header(header)
+    body = message[tcrp.HEADER_BYTE_SIZE :]
+    if room_name_size + payload_size != len(body):
+        raise ValueError("control frame does not match its TCRP header")
+    return header, body
+
+
+def split_responses(message):
+    """フレーム内に連結されたTCRPレスポンスを分割する
+
+    :param message: TCRPメッセージ
+    :return: [(アクション番号, 状態コード, ペイロード)]
+    """
+    responses = []
+    offset = 0
+    while offset < len(message):
+        _, operation, state, payload_size = tcrp.unpack_header(
+            message[offset : offset + tcrp.HEADER_BYTE_SIZE]
+        )
+        offset += tcrp.HEADER_BYTE_SIZE
+        responses.append((operation, state, message[offset : offset + payload_size]))
+        offset += payload_size
+    return responses
+
+
+def read_frame(conn, idle_timeout, read_timeout):
+    """フレームを1つ受信する(スレッドモード)
+
+    :param conn: ソケットオブジェクト
+    :param idle_timeout: 次のフレームを待つ時間(秒)
+    :param read_timeout: フレームの受信を始めてから読み終えるまでの期限(秒)
+    :return: (リクエストID, ヘッダー, ボディ)。フレームの境界で切断された場合はNone
+    """
+    conn.settimeout(idle_timeout)
+    first = conn.recv(FRAME_HEADER.size)
+    if not first:
+        return None
+    deadline = time.monotonic() + read_timeout
+    data = first + tcrp.recv_exactly(conn, FRAME_HEADER.size - len(first), deadline)
+    request_id, length = unpack_frame_header(data)
+    header, body = split_request(tcrp.recv_exactly(conn, length, deadline))
+    return request_id, header, body
+
+
+class ControlChannel:
+    """クライアント側のコントロールチャネル
+
+    1本のTCP接続で部屋の作成・参加・退出・一覧・履歴取得をリクエストIDつきで送る。
+    送信(send)と受信(receive)を分けて呼べば、レスポンスを待たずに複数送れる(パイプライン)。
+    """
+
+    # チャネルを開くアクション番号
+    CONTROL_CHANNEL = 5
+    # チャネルを受け付けたときの状態コード
+    REQUEST_OF_RESPONSE = 1
+
+    def __init__(self, tcp_address, timeout=5.0):
+        """
+        :param tcp_address: サーバーのTCPアドレス
+        :param timeout: 接続・受信のタイムアウト(秒)
+        """
+        self.conn = socket.create_connection(tcp_address, timeout=timeout)
+        self.request_ids = itertools.count(1)
+        self.conn.sendall(tcrp.pack_header(0, self.CONTROL_CHANNEL, 0, 0))
+        header = tcrp.recv_exactly(self.conn, tcrp.HEADER_BYTE_SIZE)
+        _, operation, state, payload_size = tcrp.unpack_header(header)
+        payload = tcrp.recv_exactly(self.conn, payload_size)
+        if operation != self.CONTROL_CHANNEL or state != self.REQUEST_OF_RESPONSE:
+            self.conn.close()
+            raise ConnectionError(payload.decode("utf-8", "replace"))
+
+    def send(self, operation, room_name, payload):
+        """リクエストを送信する(レスポンスは待たない)
+
+        :param operation: アクション番号
+        :param room_name: チャットルーム名
+        :param payload: OperationPayload(byte)
+        :return: リクエストID
+        """
+        request_id = next(self.request_ids)
+        encoded_room_name = room_name.encode("utf-8")
+        header = tcrp.pack_header(len(encoded_room_name), operation, 0, len(payload))
+        self.conn.sendall(pack_frame(request_id, header + encoded_room_name + payload))
+        return request_id
+
+    def receive(self):
+        """レスポンスを1つ受信する
+
+        :return: (リクエストID, [(アクション番号, 状態コード, ペイロード)])
+        """
+        request_id, length = unpack_frame_header(
+            tcrp.recv_exactly(self.conn, FRAME_HEADER.size)
+        )
+        return request_id, split_responses(tcrp.recv_exactly(self.conn, length))
+
+    def request(self, operation, room_name, payload):
+        """リクエストを送信してレスポンスを待つ
+
+        :return: [(アクション番号, 状態コード, ペイロード)]
+        """
+        request_id = self.send(operation, room_name, payload)
+        received_id, responses = self.receive()
+        if received_id != request_id:
+            raise ValueError(f"unexpected response id {received_id} (sent {request_id})")
+        return responses
+
+    def close(self):
+        """チャネルを閉じる"""
+        self.conn.close()
@@ -0,0 +1,79 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+class Fanout:
+    """エンコード済みのデータを複数のアドレスへ一斉送信する
+
+    参加者数がparallel_thresholdを超える部屋では、送信先リストを分割して
+    複数の送信ワーカーで並行してsendtoする(sendtoの間はGILが解放される)。
+    """
+
+    def __init__(self, sock, workers=0, parallel_threshold=256, on_blocked=None, on_error=None):
+        """
+        :param sock: 送信に使うUDPソケット
+        :param workers: 送信ワーカー数(0なら呼び出し元のスレッドで送信)
+        :param parallel_threshold: 並行送信に切り替える送信先数
+        :param on_blocked: ノンブロッキングソケットの送信バッファが一杯のときに呼ぶ関数(data, address)
+        :param on_error: 送信に失敗したときに呼ぶ関数(引数なし)
+        """
+        self.sock = sock
+        self.workers = workers
+        self.parallel_threshold = parallel_threshold
+        self.on_blocked = on_blocked
+        self.on_error = on_error
+        self.executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+
+    def broadcast(self, data, addresses, exclude=None):
+        """全アドレスにデータを送信する
+
+        :param data: 送信データ(byte、送信先ごとにエンコードしない)
+        :param addresses: 送信先アドレスのタプル
+        :param exclude: 送信しないアドレス(送信者)
+        :return: 送信数
+        """
+        if self.executor is None or len(addresses) < self.parallel_threshold:
+            return self.__send_all(data, addresses, exclude)
+
+        chunk_size = -(-len(addresses) // self.workers)
+        futures = [
+            self.executor.submit(
+                self.__send_all, data, addresses[i : i + chunk_size], exclude
+            )
+            for i in range(0, len(addresses), chunk_size)
+        ]
+        wait(futures)
+        return sum(future.result() for future in futures)
+
+    def __send_all(self, data, addresses, exclude):
+        """送信先リストに順番に送信する
+
+        :return: 送信数
+        """
+        sendto = self.sock.sendto
+        sent = 0
+        for address in addresses:
+            if address == exclude:
+                continue
+            try:
+                sendto(data, address)
+                sent += 1
+            except BlockingIOError:
+                if self.on_blocked is None:
+                    self.__failed()
+                    continue
+                self.on_blocked(data, address)
+                sent += 1
+            except OSError:
+                # 1件の送信失敗で残りの参加者への配送を止めない
+                self.__failed()
+        return sent
+
+    def __failed(self):
+        """送信の失敗を通知する"""
+        if self.on_error is not None:
+            self.on_error()
+
+    def close(self):
+        """送信ワーカーを停止する"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
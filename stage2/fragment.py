@@ -0,0 +1,83 @@
+import time
+from collections import OrderedDict
+
+import packet
+
+
+class Reassembler:
+    """断片からメッセージを組み立てる(受信側)
+
+    組み立て中のメッセージは上限つきの表に持つ。timeout秒以内に揃わないものと、
+    max_messages件・max_bytesバイトを超えた分は古い順に捨てる。
+    タイムアウトは一定なので、期限は追加した順に並ぶ(OrderedDictの先頭から調べれば足りる)。
+    """
+
+    def __init__(self, max_messages=64, max_bytes=1024 * 1024, timeout=10.0, clock=time.monotonic):
+        """
+        :param max_messages: 同時に組み立てるメッセージ数の上限
+        :param max_bytes: 組み立て中の断片の合計バイト数の上限
+        :param timeout: 最初の断片を受信してから揃うまで待つ時間(秒)
+        :param clock: 現在時刻を返す関数
+        """
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.clock = clock
+        # (送信者のセッションID, メッセージID) -> [期限, 断片のリスト, 受信した断片数, バイト数]
+        self.partial = OrderedDict()
+        self.size = 0
+        # 揃わずに捨てたメッセージ数
+        self.dropped = 0
+
+    def add(self, sender_session_id, data):
+        """断片を追加する
+
+        :param sender_session_id: 送信者のセッションID
+        :param data: FRAGMENT_HEADER + 断片のデータ
+        :return: 揃ったメッセージ(byte、まだ揃わない場合はNone)
+        """
+        message_id, index, count = packet.FRAGMENT_HEADER.unpack_from(data)
+        if index >= count or count > packet.MAX_FRAGMENTS:
+            return None
+        chunk = bytes(data[packet.FRAGMENT_HEADER.size :])
+        if count == 1:
+            return chunk
+        now = self.clock()
+        self.expire(now)
+        key = (sender_session_id, message_id)
+        entry = self.partial.get(key)
+        if entry is None:
+            entry = self.partial[key] = [now + self.timeout, [None] * count, 0, 0]
+        chunks = entry[1]
+        if len(chunks) != count or chunks[index] is not None:
+            # 重複した断片
+            return None
+        chunks[index] = chunk
+        entry[2] += 1
+        entry[3] += len(chunk)
+        self.size += len(chunk)
+        if entry[2] == count:
+            del self.partial[key]
+            self.size -= entry[3]
+            return b"".join(chunks)
+        while self.partial and (
+            self.size > self.max_bytes or len(self.partial) > self.max_messages
+        ):
+            self.__drop_oldest()
+        return None
+
+    def expire(self, now=None):
+        """期限を過ぎた組み立て中のメッセージを捨てる
+
+        :param now: 現在時刻(省略時はclock())
+        """
+        if now is None:
+            now = self.clock()
+        while self.partial and next(iter(self.partial.values()))[0] <= now:
+            self.__drop_oldest()
+
+    def __drop_oldest(self):
+        """最も古い組み立て中のメッセージを捨てる"""
+        _, entry = self.partial.popitem(last=False)
+        self.size -= entry[3]
+        self.dropped += 1
@@ -0,0 +1,153 @@
+import socket
+import struct
+
+# バイナリ形式の入室ハンドシェイクのバージョン
+# JSONのOperationPayloadは"{"(0x7B)で始まるので、先頭バイトで形式を判別できる
+VERSION = 1
+
+# 入室リクエスト: Version(1) | Flags(1) | IPv4(4) | Port(2) | History(2) | UserNameSize(1) | UserName
+JOIN_REQUEST = struct.Struct("!B B 4s H H B")
+# Flags: 信頼モード(連番・再送つきの配送)で参加する
+FLAG_RELIABLE = 0x01
+# Flags: 大きなメッセージを圧縮データグラムで受け取る
+FLAG_COMPRESS = 0x02
+# Flags: 入室レスポンスに部屋を担当するノードのUDPアドレスを含める(クラスター構成)
+FLAG_UDP_ADDRESS = 0x04
+# Flags: 大きなメッセージを断片(KIND_FRAGMENT)のまま受け取って組み立てる
+FLAG_FRAGMENT = 0x08
+# 入室レスポンス: Version(1) | Status(2) | SessionId(4) | Sequence(4) | TokenSize(1) | Token | Message
+# Sequenceは信頼モードで最初に受信する部屋の連番
+JOIN_RESPONSE = struct.Struct("!B H I I B")
+# FLAG_UDP_ADDRESSを指定して入室できた場合はJOIN_RESPONSEとTokenの間に IPv4(4) | Port(2) が入る
+UDP_ADDRESS = struct.Struct("!4s H")
+
+
+def is_binary(payload):
+    """バイナリ形式のペイロードか
+
+    :param payload: OperationPayload
+    :return: バイナリ形式ならTrue(JSONならFalse)
+    """
+    return len(payload) > 0 and payload[0] == VERSION
+
+
+def pack_join_request(
+    user_name,
+    user_address,
+    history_count=0,
+    reliable=False,
+    compress=False,
+    udp_address=False,
+    fragment=False,
+):
+    """入室リクエストのペイロードを作成する
+
+    :param user_name: ユーザー名
+    :param user_address: クライアントのUDPアドレス(IPv4, ポート番号)
+    :param history_count: 入室と同時に取得する履歴の件数
+    :param reliable: 信頼モードで参加するか
+    :param compress: 圧縮データグラムを受け取るか
+    :param udp_address: レスポンスに送信先のUDPアドレスを含めてもらうか
+    :param fragment: 大きなメッセージを断片のまま受け取るか
+    :return: ペイロード
+    """
+    encoded_user_name = user_name.encode("utf-8")
+    flags = (
+        (FLAG_RELIABLE if reliable else 0)
+        | (FLAG_COMPRESS if compress else 0)
+        | (FLAG_UDP_ADDRESS if udp_address else 0)
+        | (FLAG_FRAGMENT if fragment else 0)
+    )
+    return (
+        JOIN_REQUEST.pack(
+            VERSION,
+            flags,
+            socket.inet_aton(user_address[0]),
+            user_address[1],
+            history_count,
+            len(encoded_user_name),
+        )
+        + encoded_user_name
+    )
+
+
+def unpack_join_request(payload):
+    """入室リクエストのペイロードを解析する
+
+    :param payload: ペイロード
+    :return: (ユーザー名, クライアントアドレス, 履歴の件数, 信頼モードか, 圧縮するか,
+        UDPアドレスを返すか, 断片を受け取るか)
+    """
+    version, flags, ip, port, history_count, user_name_size = JOIN_REQUEST.unpack_from(payload)
+    if version != VERSION:
+        raise ValueError(f"unsupported handshake version: {version}")
+    end = JOIN_REQUEST.size + user_name_size
+    if end > len(payload):
+        raise ValueError("truncated user name")
+    user_name = bytes(payload[JOIN_REQUEST.size : end]).decode("utf-8")
+    reliable = bool(flags & FLAG_RELIABLE)
+    compress = bool(flags & FLAG_COMPRESS)
+    udp_address = bool(flags & FLAG_UDP_ADDRESS)
+    fragment = bool(flags & FLAG_FRAGMENT)
+    return (
+        user_name,
+        (socket.inet_ntoa(ip), port),
+        history_count,
+        reliable,
+        compress,
+        udp_address,
+        fragment,
+    )
+
+
+def pack_join_response(
+    status, message, token=None, session_id=None, sequence=0, udp_address=None
+):
+    """入室レスポンスのペイロードを作成する
+
+    :param status: ステータス
+    :param message: メッセージ
+    :param token: トークン(入室できなかった場合はNone)
+    :param session_id: セッションID(入室できなかった場合はNone)
+    :param sequence: 信頼モードで最初に受信する連番
+    :param udp_address: 送信先のUDPアドレス(FLAG_UDP_ADDRESSを指定されて入室できた場合)
+    :return: ペイロード
+    """
+    encoded_token = token.encode("ascii") if token is not None else b""
+    address = (
+        UDP_ADDRESS.pack(socket.inet_aton(udp_address[0]), udp_address[1])
+        if udp_address is not None
+        else b""
+    )
+    return (
+        JOIN_RESPONSE.pack(VERSION, status, session_id or 0, sequence, len(encoded_token))
+        + address
+        + encoded_token
+        + message.encode("utf-8")
+    )
+
+
+def unpack_join_response(payload, udp_address=False):
+    """入室レスポンスのペイロードを解析する
+
+    :param payload: ペイロード
+    :param udp_address: リクエストでFLAG_UDP_ADDRESSを指定したか
+    :return: JSON形式のレスポンスと同じキーを持つ辞書
+    """
+    _, status, session_id, sequence, token_size = JOIN_RESPONSE.unpack_from(payload)
+    token_start = JOIN_RESPONSE.size
+    address = None
+    if udp_address and token_size > 0:
+        ip, port = UDP_ADDRESS.unpack_from(payload, token_start)
+        address = (socket.inet_ntoa(ip), port)
+        token_start += UDP_ADDRESS.size
+    token_end = token_start + token_size
+    token = bytes(payload[token_start:token_end]).decode("ascii")
+    return {
+        "status": status,
+        "message": bytes(payload[token_end:]).decode("utf-8"),
+        "token": token or None,
+        "session_id": session_id if token else None,
+        "sequence": sequence,
+        "udp_address": address,
+    }
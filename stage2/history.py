@@ -0,0 +1,155 @@
+import struct
+import threading
+from collections import deque
+
+# 履歴ペイロード内の1メッセージ: Length(2) | Frame
+FRAME_LENGTH = struct.Struct("!H")
+
+
+class HistoryBudget:
+    """全チャットルームで共有する履歴メモリの上限"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, size):
+        """履歴用のメモリを確保する
+
+        :param size: バイト数
+        :return: 確保できたか
+        """
+        with self.lock:
+            if self.used_bytes + size > self.max_bytes:
+                return False
+            self.used_bytes += size
+            return True
+
+    def release(self, size):
+        """履歴用のメモリを返却する
+
+        :param size: バイト数
+        """
+        with self.lock:
+            self.used_bytes -= size
+
+
+class MessageHistory:
+    """チャットルームの直近メッセージを保持するリングバッファ
+
+    中継したエンコード済みのフレームをそのまま保持し、件数・部屋ごとのバイト数・
+    全部屋共通のバイト数(HistoryBudget)のいずれかを超えたら古いものから捨てる。
+    """
+
+    def __init__(self, max_messages=100, max_bytes=64 * 1024, budget=None):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.budget = budget
+        self.frames = deque()
+        self.used_bytes = 0
+        # 次に追加するフレームのオフセット(追加したフレームの通し番号)
+        self.next_offset = 0
+        self.lock = threading.Lock()
+
+    def append(self, frame):
+        """フレームを追加する
+
+        :param frame: 中継したメッセージ(byte)
+        :return: 保持できたか
+        """
+        size = len(frame)
+        if self.max_messages <= 0 or size > self.max_bytes:
+            return False
+        with self.lock:
+            while self.frames and (
+                len(self.frames) >= self.max_messages or self.used_bytes + size > self.max_bytes
+            ):
+                self.__evict_oldest()
+            # 全体の上限に達している場合は自分の部屋の古いものを捨てて空ける
+            while self.budget is not None and not self.budget.reserve(size):
+                if not self.frames:
+                    return False
+                self.__evict_oldest()
+            self.frames.append(frame)
+            self.used_bytes += size
+            self.next_offset += 1
+            return True
+
+    def __evict_oldest(self):
+        """最も古いフレームを捨てる(self.lockを保持して呼ぶ)"""
+        frame = self.frames.popleft()
+        self.used_bytes -= len(frame)
+        if self.budget is not None:
+            self.budget.release(len(frame))
+
+    def latest(self, count):
+        """直近のフレームを古い順に取得する
+
+        :param count: 件数
+        :return: フレームのリスト
+        """
+        with self.lock:
+            if count <= 0:
+                return []
+            return list(self.frames)[-count:]
+
+    def since(self, offset, count=None):
+        """オフセット以降のフレームを古い順に取得する
+
+        :param offset: 取得を始めるオフセット(捨てた分は残っている先頭から)
+        :param count: 最大件数(省略時はすべて)
+        :return: フレームのリスト
+        """
+        with self.lock:
+            skip = max(offset - (self.next_offset - len(self.frames)), 0)
+            frames = list(self.frames)[skip:]
+        return frames if count is None else frames[:count]
+
+    def clear(self):
+        """全フレームを捨てる"""
+        with self.lock:
+            while self.frames:
+                self.__evict_oldest()
+
+
+def pack_frames(frames):
+    """フレームを長さ付きで連結する
+
+    :param frames: フレームのリスト
+    :return: ペイロード
+    """
+    return b"".join(FRAME_LENGTH.pack(len(frame)) + frame for frame in frames)
+
+
+def fit_frames(frames, max_bytes, newest=True):
+    """pack_framesで連結したときにmax_bytesに収まるフレームだけを残す
+
+    :param frames: フレームのリスト(古い順)
+    :param max_bytes: 連結後の最大バイト数
+    :param newest: 新しい方から残すか(Falseなら古い方から残す)
+    :return: フレームのリスト
+    """
+    size = 0
+    order = range(len(frames) - 1, -1, -1) if newest else range(len(frames))
+    for i in order:
+        size += FRAME_LENGTH.size + len(frames[i])
+        if size > max_bytes:
+            return frames[i + 1 :] if newest else frames[:i]
+    return frames
+
+
+def unpack_frames(payload):
+    """pack_framesで連結したペイロードをフレームに分割する
+
+    :param payload: ペイロード
+    :return: フレームのリスト
+    """
+    frames = []
+    offset = 0
+    while offset < len(payload):
+        (size,) = FRAME_LENGTH.unpack_from(payload, offset)
+        offset += FRAME_LENGTH.size
+        frames.append(bytes(payload[offset : offset + size]))
+        offset += size
+    return frames
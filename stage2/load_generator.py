@@ -0,0 +1,297 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import time
+
+import benchmark
+import packet
+import tcrp
+
+CREATE_ROOM = 1
+JOIN_ROOM = 2
+REQUEST_COMPLETION = 2
+# 計測用メッセージの接頭辞: lg:<送信時刻(ns)>:<連番>
+MESSAGE_PREFIX = b"lg:"
+
+
+class LoadStats:
+    """送受信数と配送遅延を集計する"""
+
+    def __init__(self):
+        self.sent = 0
+        self.expected = 0
+        self.received = 0
+        self.received_bytes = 0
+        self.latencies_ns = []
+
+    def percentile_ms(self, ratio):
+        """配送遅延のパーセンタイル(ミリ秒)
+
+        :param ratio: 0.0〜1.0
+        """
+        if not self.latencies_ns:
+            return None
+        latencies = sorted(self.latencies_ns)
+        index = min(int(len(latencies) * ratio), len(latencies) - 1)
+        return latencies[index] / 1_000_000
+
+
+class LoadUser(asyncio.DatagramProtocol):
+    """1ユーザー分のUDPソケット(受信したメッセージの配送遅延を記録する)"""
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        """中継されたメッセージ("ユーザー名: lg:...")から送信時刻を取り出す"""
+        received_at = time.monotonic_ns()
+        stats = self.stats
+        stats.received += 1
+        stats.received_bytes += len(data)
+        start = data.find(MESSAGE_PREFIX)
+        if start < 0:
+            return
+        end = data.find(b":", start + len(MESSAGE_PREFIX))
+        try:
+            sent_at = int(data[start + len(MESSAGE_PREFIX) : end])
+        except ValueError:
+            return
+        stats.latencies_ns.append(received_at - sent_at)
+
+
+async def request_room(tcp_address, operation, room_name, user_name, user_address):
+    """Client.__request_to_join_roomと同じTCRPリクエストで部屋作成・参加を行う
+
+    :return: 完了レスポンスのペイロード
+    """
+    reader, writer = await asyncio.open_connection(*tcp_address)
+    try:
+        encoded_room_name = room_name.encode("utf-8")
+        payload = json.dumps(
+            {"user_name": user_name, "user_address": user_address}
+        ).encode("utf-8")
+        header = tcrp.pack_header(len(encoded_room_name), operation, 0, len(payload))
+        writer.write(header + encoded_room_name + payload)
+        await writer.drain()
+        _, _, state, payload_size = tcrp.unpack_header(
+            await reader.readexactly(tcrp.HEADER_BYTE_SIZE)
+        )
+        response = json.loads(await reader.readexactly(payload_size))
+    finally:
+        writer.close()
+    if state != REQUEST_COMPLETION or response.get("token") is None:
+        raise RuntimeError(response["message"])
+    return response
+
+
+def read_cpu_seconds(pid):
+    """プロセスと子プロセス(ワーカー)の累計CPU時間を/procから読む
+
+    :param pid: プロセスID
+    :return: CPU時間(秒、取得できなければNone)
+    """
+    ticks = os.sysconf("SC_CLK_TCK")
+    pids = {pid}
+    stats = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # comm に空白が入る場合があるので ")" 以降を分割する
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        stats[int(entry)] = fields
+    # fields[1]: ppid, fields[11]: utime, fields[12]: stime
+    for child, fields in stats.items():
+        if int(fields[1]) == pid:
+            pids.add(child)
+    if pid not in stats:
+        return None
+    return sum(
+        (int(stats[p][11]) + int(stats[p][12])) / ticks for p in pids if p in stats
+    )
+
+
+async def run_load(
+    tcp_address,
+    udp_address,
+    rooms,
+    users,
+    rate,
+    duration,
+    compact=True,
+    message_size=64,
+    drain=1.0,
+    server_pid=None,
+):
+    """K部屋 × Mユーザー × R msgs/sec の負荷をかけて結果を集計する
+
+    :param rooms: 部屋数(K)
+    :param users: 1部屋あたりのユーザー数(M)
+    :param rate: 1ユーザーあたりの送信レート(R msgs/sec)
+    :param duration: 送信する時間(秒)
+    :param compact: コンパクト形式(セッションID)で送信するか
+    :param message_size: 1メッセージのおおよそのバイト数
+    :param drain: 送信終了後に受信を待つ時間(秒)
+    :param server_pid: CPU使用率を測るサーバーのプロセスID
+    :return: 結果(JSONに変換できる辞書)
+    """
+    loop = asyncio.get_running_loop()
+    stats = LoadStats()
+    sessions = []
+
+    # 全ユーザーを入室させる(部屋ごとに先頭ユーザーが作成)
+    for room_index in range(rooms):
+        room_name = f"load{room_index}"
+        room_sessions = []
+        for user_index in range(users):
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: LoadUser(stats), local_addr=("127.0.0.1", 0)
+            )
+            sock = transport.get_extra_info("socket")
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+            response = await request_room(
+                tcp_address,
+                CREATE_ROOM if user_index == 0 else JOIN_ROOM,
+                room_name,
+                f"user{user_index}",
+                transport.get_extra_info("sockname"),
+            )
+            room_sessions.append((transport, response))
+        sessions.append((room_name, room_sessions))
+
+    padding = b"x" * max(message_size - 40, 0)
+
+    async def send_loop(room_name, transport, response):
+        """1ユーザー分の送信ループ(開始時刻をずらして一定レートで送信)"""
+        interval = 1 / rate
+        await asyncio.sleep(random.random() * interval)
+        deadline = loop.time() + duration
+        sequence = 0
+        encoded_room_name = room_name.encode("utf-8")
+        token = response["token"].encode("utf-8")
+        key = packet.session_key(response["token"])
+        while loop.time() < deadline:
+            message = b"%s%d:%d:%s" % (MESSAGE_PREFIX, time.monotonic_ns(), sequence, padding)
+            if compact:
+                datagram = packet.pack_compact(response["session_id"], message, key=key)
+            else:
+                datagram = packet.pack_legacy(encoded_room_name, token, message)
+            transport.sendto(datagram, udp_address)
+            stats.sent += 1
+            stats.expected += users - 1
+            sequence += 1
+            await asyncio.sleep(interval)
+
+    cpu_before = read_cpu_seconds(server_pid) if server_pid else None
+    started_at = time.perf_counter()
+    await asyncio.gather(
+        *(
+            send_loop(room_name, transport, response)
+            for room_name, room_sessions in sessions
+            for transport, response in room_sessions
+        )
+    )
+    send_elapsed = time.perf_counter() - started_at
+    await asyncio.sleep(drain)
+    elapsed = time.perf_counter() - started_at
+    cpu_after = read_cpu_seconds(server_pid) if server_pid else None
+
+    for _, room_sessions in sessions:
+        for transport, _ in room_sessions:
+            transport.close()
+
+    server_cpu = None
+    if cpu_before is not None and cpu_after is not None:
+        server_cpu = (cpu_after - cpu_before) / elapsed
+
+    return {
+        "config": {
+            "rooms": rooms,
+            "users_per_room": users,
+            "rate_per_user": rate,
+            "duration_sec": duration,
+            "protocol": "compact" if compact else "legacy",
+            "message_size": message_size,
+        },
+        "sent": stats.sent,
+        "expected_deliveries": stats.expected,
+        "delivered": stats.received,
+        "packet_loss": 1 - stats.received / stats.expected if stats.expected else 0.0,
+        "send_rate_msgs_per_sec": stats.sent / send_elapsed,
+        "fanout_deliveries_per_sec": stats.received / elapsed,
+        "fanout_bytes_per_sec": stats.received_bytes / elapsed,
+        "latency_p50_ms": stats.percentile_ms(0.50),
+        "latency_p99_ms": stats.percentile_ms(0.99),
+        "server_cpu_utilization": server_cpu,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="headless load generator for stage2 server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--tcp-port", type=int, default=9002)
+    parser.add_argument("--udp-port", type=int, default=9003)
+    parser.add_argument("--rooms", type=int, default=10, help="K rooms")
+    parser.add_argument("--users", type=int, default=10, help="M users per room")
+    parser.add_argument("--rate", type=float, default=1.0, help="R messages/sec per user")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--message-size", type=int, default=64)
+    parser.add_argument("--legacy", action="store_true", help="send room-name/token datagrams")
+    parser.add_argument("--server-pid", type=int, help="measure CPU of a running server")
+    parser.add_argument(
+        "--spawn-server",
+        choices=["async", "threaded"],
+        help="start a server on the given ports and measure its CPU",
+    )
+    parser.add_argument("--workers", type=int, default=1, help="workers for --spawn-server")
+    parser.add_argument("--output", help="write the JSON result to this file")
+    args = parser.parse_args()
+
+    process = None
+    server_pid = args.server_pid
+    if args.spawn_server:
+        process = benchmark.start_server(
+            args.spawn_server, args.tcp_port, args.udp_port, args.workers
+        )
+        server_pid = process.pid
+    try:
+        result = asyncio.run(
+            run_load(
+                (args.host, args.tcp_port),
+                (args.host, args.udp_port),
+                args.rooms,
+                args.users,
+                args.rate,
+                args.duration,
+                compact=not args.legacy,
+                message_size=args.message_size,
+                server_pid=server_pid,
+            )
+        )
+    finally:
+        if process is not None:
+            process.terminate()
+            process.join()
+
+    if args.spawn_server:
+        result["config"]["server"] = {"mode": args.spawn_server, "workers": args.workers}
+    result["timestamp"] = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+
+# サーバー全体で使うロガー
+logger = logging.getLogger("chat")
+logger.addHandler(logging.NullHandler())
+
+LEVELS = {
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+    "off": logging.CRITICAL + 1,
+}
+
+
+def setup_logging(level="info"):
+    """ログ出力を設定する
+
+    ログはキューに積むだけで、標準出力への書き込みは別スレッド(QueueListener)で行う。
+    levelに"off"を指定するとログを出力しない。
+
+    :param level: ログレベル(debug/info/warning/error/off)
+    """
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.propagate = False
+    logger.setLevel(LEVELS[level])
+    if level == "off":
+        logger.addHandler(logging.NullHandler())
+        return
+
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener.start()
+    atexit.register(listener.stop)
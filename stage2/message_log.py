@@ -0,0 +1,412 @@
+import bisect
+import json
+import mmap
+import os
+import shutil
+import struct
+import threading
+import zlib
+
+# ログ内の1メッセージ: Length(4) | CRC32(4) | Frame
+FRAME_HEADER = struct.Struct("!I I")
+# 疎インデックスの1エントリ: 相対オフセット(4) | ファイル内の位置(8)
+INDEX_ENTRY = struct.Struct("!I Q")
+SEGMENT_SUFFIX = ".log"
+INDEX_SUFFIX = ".index"
+META_FILE = "room.json"
+
+
+class Segment:
+    """ログのセグメント(1ファイル)
+
+    ファイル名は先頭メッセージのオフセット。index_intervalメッセージごとに
+    (相対オフセット, 位置)を.indexファイルに記録する。
+    """
+
+    def __init__(self, directory, base_offset):
+        """
+        :param directory: 部屋のログディレクトリ
+        :param base_offset: 先頭メッセージのオフセット
+        """
+        self.base_offset = base_offset
+        self.path = os.path.join(directory, f"{base_offset:020d}{SEGMENT_SUFFIX}")
+        self.index_path = os.path.join(directory, f"{base_offset:020d}{INDEX_SUFFIX}")
+        self.size = 0
+        self.count = 0
+        self.index = []
+        self.fd = None
+        self.index_fd = None
+        self.mm = None
+
+    def open_for_append(self):
+        """追記用にファイルを開く"""
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.index_fd = os.open(self.index_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def load_index(self):
+        """.indexファイルから疎インデックスを読み込む"""
+        try:
+            with open(self.index_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        usable = len(data) - len(data) % INDEX_ENTRY.size
+        self.index = [entry for entry in INDEX_ENTRY.iter_unpack(data[:usable])]
+
+    def view(self):
+        """セグメントのmmapを取得する(追記で大きくなっていればマップし直す)
+
+        :return: mmap(空ならNone)
+        """
+        if self.size == 0:
+            return None
+        if self.mm is None or len(self.mm) < self.size:
+            if self.mm is not None:
+                self.mm.close()
+            with open(self.path, "rb") as f:
+                self.mm = mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_READ)
+        return self.mm
+
+    def position_of(self, offset):
+        """オフセット以前で最も近いインデックスの位置を求める
+
+        :param offset: 相対オフセット
+        :return: (相対オフセット, ファイル内の位置)
+        """
+        i = bisect.bisect_right(self.index, (offset, float("inf"))) - 1
+        if i < 0:
+            return 0, 0
+        return self.index[i]
+
+    def close(self):
+        """ファイルとmmapを閉じる"""
+        for fd in (self.fd, self.index_fd):
+            if fd is not None:
+                os.close(fd)
+        self.fd = None
+        self.index_fd = None
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+
+class RoomLog:
+    """チャットルーム1つ分の追記専用ログ
+
+    MessageHistoryと同じappend/latest/clearを持ち、ChatRoom.historyとして使える。
+    書き込みはページキャッシュへのwriteだけで、fsyncはMessageLogがまとめて行う(グループコミット)。
+    読み込みはmmap経由で、疎インデックスから近い位置を求めて必要な範囲だけ走査する。
+    """
+
+    def __init__(self, message_log, directory, segment_bytes, index_interval, max_segments):
+        """
+        :param message_log: fsyncを行うMessageLog
+        :param directory: 部屋のログディレクトリ
+        :param segment_bytes: 1セグメントの上限サイズ
+        :param index_interval: インデックスを記録するメッセージ間隔
+        :param max_segments: 保持するセグメント数(古いものから削除)
+        """
+        self.message_log = message_log
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.max_segments = max_segments
+        self.segments = []
+        self.dirty = False
+        self.closed = False
+        self.lock = threading.Lock()
+
+    @property
+    def next_offset(self):
+        """次に追記するメッセージのオフセット"""
+        active = self.segments[-1]
+        return active.base_offset + active.count
+
+    def recover(self):
+        """既存のセグメントを読み込み、最後のセグメントの壊れた末尾を切り詰める
+
+        最後以外のセグメントは保存済みのインデックスを使い、中身は走査しない。
+        """
+        bases = sorted(
+            int(name[: -len(SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+        for base in bases:
+            segment = Segment(self.directory, base)
+            segment.size = os.path.getsize(segment.path)
+            segment.load_index()
+            self.segments.append(segment)
+        for segment, following in zip(self.segments, self.segments[1:]):
+            segment.count = following.base_offset - segment.base_offset
+        if not self.segments:
+            self.segments.append(Segment(self.directory, 0))
+        self.__scan_active()
+        self.segments[-1].open_for_append()
+
+    def __scan_active(self):
+        """最後のセグメントを走査して件数を数え、CRCが合わない末尾を切り詰める"""
+        active = self.segments[-1]
+        active.index = []
+        view = active.view()
+        position = 0
+        count = 0
+        while view is not None and position + FRAME_HEADER.size <= len(view):
+            size, checksum = FRAME_HEADER.unpack_from(view, position)
+            end = position + FRAME_HEADER.size + size
+            if end > len(view) or zlib.crc32(view[position + FRAME_HEADER.size : end]) != checksum:
+                break
+            if count % self.index_interval == 0:
+                active.index.append((count, position))
+            position = end
+            count += 1
+        active.close()
+        if position != active.size:
+            os.truncate(active.path, position)
+        active.size = position
+        active.count = count
+        # インデックスも走査結果で書き直す
+        with open(active.index_path, "wb") as f:
+            f.write(b"".join(INDEX_ENTRY.pack(*entry) for entry in active.index))
+
+    def append(self, frame):
+        """フレームを追記する
+
+        :param frame: 中継したメッセージ(byte)
+        :return: 追記できたか
+        """
+        record = FRAME_HEADER.pack(len(frame), zlib.crc32(frame)) + frame
+        with self.lock:
+            if self.closed:
+                return False
+            active = self.segments[-1]
+            if active.size and active.size + len(record) > self.segment_bytes:
+                active = self.__roll()
+            if active.count % self.index_interval == 0:
+                entry = (active.count, active.size)
+                os.write(active.index_fd, INDEX_ENTRY.pack(*entry))
+                active.index.append(entry)
+            os.write(active.fd, record)
+            active.size += len(record)
+            active.count += 1
+            self.dirty = True
+            return True
+
+    def __roll(self):
+        """新しいセグメントに切り替え、古いセグメントを削除する(self.lockを保持して呼ぶ)
+
+        :return: 新しいセグメント
+        """
+        previous = self.segments[-1]
+        os.fsync(previous.fd)
+        os.fsync(previous.index_fd)
+        os.close(previous.fd)
+        os.close(previous.index_fd)
+        previous.fd = None
+        previous.index_fd = None
+        segment = Segment(self.directory, previous.base_offset + previous.count)
+        segment.open_for_append()
+        self.segments.append(segment)
+        while len(self.segments) > self.max_segments:
+            oldest = self.segments.pop(0)
+            oldest.close()
+            os.remove(oldest.path)
+            if os.path.exists(oldest.index_path):
+                os.remove(oldest.index_path)
+        return segment
+
+    def since(self, offset, count=None):
+        """オフセット以降のフレームを古い順に取得する
+
+        :param offset: 取得を始めるオフセット(削除済みなら残っている先頭から)
+        :param count: 最大件数(省略時はすべて)
+        :return: フレームのリスト
+        """
+        frames = []
+        with self.lock:
+            if self.closed:
+                return frames
+            offset = max(offset, self.segments[0].base_offset)
+            bases = [segment.base_offset for segment in self.segments]
+            start = max(bisect.bisect_right(bases, offset) - 1, 0)
+            for segment in self.segments[start:]:
+                if count is not None and len(frames) >= count:
+                    break
+                self.__read_segment(segment, offset, count, frames)
+        return frames
+
+    def __read_segment(self, segment, offset, count, frames):
+        """セグメントからオフセット以降のフレームを読む(self.lockを保持して呼ぶ)"""
+        view = segment.view()
+        if view is None:
+            return
+        relative = max(offset - segment.base_offset, 0)
+        current, position = segment.position_of(relative)
+        while position < segment.size:
+            if count is not None and len(frames) >= count:
+                return
+            (size, _) = FRAME_HEADER.unpack_from(view, position)
+            start = position + FRAME_HEADER.size
+            position = start + size
+            if current >= relative:
+                frames.append(view[start:position])
+            current += 1
+
+    def latest(self, count):
+        """直近のフレームを古い順に取得する
+
+        :param count: 件数
+        :return: フレームのリスト
+        """
+        if count <= 0:
+            return []
+        with self.lock:
+            offset = self.next_offset - count
+        return self.since(offset, count)
+
+    def sync(self):
+        """未同期の追記をfsyncする"""
+        with self.lock:
+            if not self.dirty or self.closed:
+                return
+            self.dirty = False
+            # 切り替え・closeで閉じられても同じファイルをfsyncできるよう複製しておく
+            fds = [os.dup(self.segments[-1].fd), os.dup(self.segments[-1].index_fd)]
+        # fsyncの間は追記を止めない
+        try:
+            for fd in fds:
+                os.fsync(fd)
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def close(self):
+        """ファイルを閉じる(ログは残す)"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            for segment in self.segments:
+                if segment.fd is not None:
+                    os.fsync(segment.fd)
+                segment.close()
+
+    def clear(self):
+        """チャットルームの終了時にログを削除する"""
+        self.close()
+        self.message_log.forget(self)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class MessageLog:
+    """チャットルームごとの追記専用ログを管理する
+
+    部屋ごとにdata_dir/<部屋名(UTF-8)の16進>/にセグメントを作る。
+    fsyncはfsync_interval秒ごとにまとめて行い、その間の追記は同じfsyncで永続化される。
+    """
+
+    def __init__(
+        self,
+        data_dir,
+        segment_bytes=16 * 1024 * 1024,
+        index_interval=64,
+        max_segments=8,
+        fsync_interval=0.05,
+    ):
+        """
+        :param data_dir: ログを置くディレクトリ
+        :param segment_bytes: 1セグメントの上限サイズ
+        :param index_interval: インデックスを記録するメッセージ間隔
+        :param max_segments: 部屋ごとに保持するセグメント数
+        :param fsync_interval: グループコミットの間隔(秒)
+        """
+        self.data_dir = data_dir
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.max_segments = max_segments
+        self.fsync_interval = fsync_interval
+        self.logs = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        os.makedirs(data_dir, exist_ok=True)
+        self.committer = threading.Thread(target=self.__commit_loop, daemon=True)
+        self.committer.start()
+
+    def __room_log(self, directory):
+        room_log = RoomLog(
+            self, directory, self.segment_bytes, self.index_interval, self.max_segments
+        )
+        with self.lock:
+            self.logs.add(room_log)
+        return room_log
+
+    def open_room(self, room_name):
+        """チャットルームのログを新しく作成する(同名の古いログは削除する)
+
+        トークンは再起動をまたいで使えないので、ホストは保存しない。
+
+        :param room_name: チャットルーム名
+        :return: RoomLog
+        """
+        directory = os.path.join(self.data_dir, room_name.encode("utf-8").hex())
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        with open(os.path.join(directory, META_FILE), "w") as f:
+            json.dump({"room_name": room_name}, f)
+        room_log = self.__room_log(directory)
+        room_log.recover()
+        return room_log
+
+    def recover(self, owns_room=None):
+        """保存済みのログからチャットルームを読み込む
+
+        :param owns_room: 部屋名を受け取り、読み込むかを返す関数(省略時はすべて)
+        :return: (チャットルーム名, RoomLog)のリスト
+        """
+        recovered = []
+        for name in sorted(os.listdir(self.data_dir)):
+            directory = os.path.join(self.data_dir, name)
+            try:
+                with open(os.path.join(directory, META_FILE)) as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if owns_room is not None and not owns_room(meta["room_name"]):
+                continue
+            room_log = self.__room_log(directory)
+            room_log.recover()
+            recovered.append((meta["room_name"], room_log))
+        return recovered
+
+    def forget(self, room_log):
+        """fsyncの対象から外す
+
+        :param room_log: RoomLog
+        """
+        with self.lock:
+            self.logs.discard(room_log)
+
+    def sync(self):
+        """すべての部屋の未同期の追記をfsyncする"""
+        with self.lock:
+            logs = list(self.logs)
+        for room_log in logs:
+            try:
+                room_log.sync()
+            except OSError:
+                # 削除中のログなどは次回に回す
+                room_log.dirty = True
+
+    def __commit_loop(self):
+        """一定間隔でグループコミットする"""
+        while not self.stopped.wait(self.fsync_interval):
+            self.sync()
+
+    def close(self):
+        """コミットを止めてすべてのログを閉じる"""
+        self.stopped.set()
+        self.committer.join()
+        with self.lock:
+            logs = list(self.logs)
+        for room_log in logs:
+            room_log.close()
@@ -0,0 +1,205 @@
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 所要時間(秒)のヒストグラムのバケット境界
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1.0)
+
+
+class Counter:
+    """単調増加するカウンター
+
+    ホットパスで使うためロックを取らない(スレッドモードでは値がまれに数え漏れることがある)。
+    """
+
+    def __init__(self, name, help_text, label_name=None):
+        self.name = name
+        self.help_text = help_text
+        self.label_name = label_name
+        self.values = {}
+
+    def inc(self, amount=1, label=None):
+        """カウンターを増やす
+
+        :param amount: 増分
+        :param label: ラベルの値(label_nameを指定した場合)
+        """
+        values = self.values
+        values[label] = values.get(label, 0) + amount
+
+    def value(self, label=None):
+        return self.values.get(label, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label, value in sorted(self.values.items(), key=lambda item: str(item[0])):
+            lines.append(f"{self.name}{format_labels(self.label_name, label)} {value}")
+        if not self.values:
+            lines.append(f"{self.name} 0")
+        return lines
+
+
+class Gauge:
+    """取得時に関数を呼んで値を求めるゲージ"""
+
+    def __init__(self, name, help_text, read):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+
+    def render(self):
+        return [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {self.read()}",
+        ]
+
+
+class Histogram:
+    """バケットごとの件数を数えるヒストグラム(ロックなし)"""
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS, label_name=None):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.label_name = label_name
+        # ラベル -> [バケットごとの件数(最後は+Inf), 合計, 件数]
+        self.series = {}
+
+    def observe(self, value, label=None):
+        """値を記録する
+
+        :param value: 値
+        :param label: ラベルの値(label_nameを指定した場合)
+        """
+        series = self.series.get(label)
+        if series is None:
+            series = self.series[label] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label, (counts, total, count) in sorted(
+            self.series.items(), key=lambda item: str(item[0])
+        ):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                labels = format_labels(self.label_name, label, le=bound)
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.label_name, label)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def format_labels(label_name, label, le=None):
+    """Prometheusのラベル表記を作成する"""
+    pairs = []
+    if label_name is not None and label is not None:
+        pairs.append(f'{label_name}="{label}"')
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def room_size_class(size):
+    """部屋の人数をヒストグラムのラベル用に区分する
+
+    :param size: 人数
+    :return: 区分
+    """
+    if size <= 10:
+        return "1-10"
+    if size <= 100:
+        return "11-100"
+    return "101-1000"
+
+
+class ServerMetrics:
+    """サーバーのメトリクス一覧"""
+
+    def __init__(self):
+        self.datagrams_in = Counter("chat_datagrams_received_total", "UDP datagrams received")
+        self.bytes_in = Counter("chat_received_bytes_total", "UDP bytes received")
+        self.datagrams_out = Counter("chat_datagrams_sent_total", "UDP datagrams sent")
+        self.bytes_out = Counter("chat_sent_bytes_total", "UDP bytes sent")
+        self.drops = Counter(
+            "chat_dropped_datagrams_total", "datagrams dropped before relay", label_name="reason"
+        )
+        self.fanout_seconds = Histogram(
+            "chat_fanout_seconds", "time to broadcast one message", label_name="room_size"
+        )
+        self.handshake_seconds = Histogram(
+            "chat_handshake_seconds", "time from accept to TCRP response"
+        )
+        self.handshakes = Counter(
+            "chat_handshakes_total", "TCRP requests by operation", label_name="operation"
+        )
+        self.metrics = [
+            self.datagrams_in,
+            self.bytes_in,
+            self.datagrams_out,
+            self.bytes_out,
+            self.drops,
+            self.fanout_seconds,
+            self.handshake_seconds,
+            self.handshakes,
+        ]
+
+    def add(self, metric):
+        """メトリクスを追加する
+
+        :param metric: Counter/Gauge/Histogram
+        :return: 追加したメトリクス
+        """
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Prometheusのテキスト形式で出力する
+
+        :return: テキスト
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """/metricsをHTTPで公開するサーバー(別スレッドで動作)"""
+
+    def __init__(self, server_metrics, address):
+        """
+        :param server_metrics: ServerMetrics
+        :param address: 待ち受けるアドレス
+        """
+        render = server_metrics.render
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(address, Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
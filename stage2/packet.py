@@ -0,0 +1,329 @@
+import hashlib
+import hmac
+import struct
+import zlib
+
+# 従来形式: RoomNameSize(1) | TokenSize(1) | RoomName | Token | Message
+LEGACY_HEADER = struct.Struct("!B B")
+
+# コンパクト形式: Marker(1) = 0 | Flags(1) | SessionId(4) | Message
+# 部屋名は1バイト以上なので、先頭バイトが0なら従来形式と区別できる
+COMPACT_MARKER = 0
+COMPACT_HEADER = struct.Struct("!B B I")
+MAX_SESSION_ID = 0xFFFFFFFF
+
+# FLAG_MAC: 末尾に MAC(8) を付ける(ヘッダーとメッセージに対するセッション鍵つきのBLAKE2s)
+FLAG_MAC = 0x04
+MAC_SIZE = 8
+# FLAG_COMPRESSED: Message(信頼モードではClientSeqの後ろ)をcompressで圧縮している
+FLAG_COMPRESSED = 0x08
+# FLAG_FRAGMENT: Message(信頼モードではClientSeqの後ろ)が大きなメッセージの断片
+# (FRAGMENT_HEADERと断片のデータ)。サーバーは組み立てずに断片ごとに中継する
+FLAG_FRAGMENT = 0x10
+
+
+def pack_legacy(room_name, token, message):
+    """従来形式のデータグラムを作成する
+
+    :param room_name: チャットルーム名(byte)
+    :param token: トークン(byte)
+    :param message: メッセージ(byte)
+    :return: データグラム
+    """
+    return LEGACY_HEADER.pack(len(room_name), len(token)) + room_name + token + message
+
+
+def pack_compact(session_id, message, flags=0, key=None):
+    """コンパクト形式のデータグラムを作成する
+
+    :param session_id: 入室時にサーバーから割り当てられたセッションID
+    :param message: メッセージ(byte)
+    :param flags: フラグ
+    :param key: セッション鍵(指定するとMACを付ける)
+    :return: データグラム
+    """
+    if key is None:
+        return COMPACT_HEADER.pack(COMPACT_MARKER, flags, session_id) + message
+    datagram = COMPACT_HEADER.pack(COMPACT_MARKER, flags | FLAG_MAC, session_id) + message
+    return datagram + compute_mac(key, datagram)
+
+
+def session_key(token):
+    """入室時に発行されたトークンからセッション鍵を導出する
+
+    :param token: トークン
+    :return: セッション鍵(32バイト)
+    """
+    return hashlib.blake2s(token.encode("ascii"), person=b"chatmac").digest()
+
+
+def compute_mac(key, data):
+    """MACを計算する
+
+    :param key: セッション鍵
+    :param data: MACの対象(ヘッダー + メッセージ)
+    :return: MAC(MAC_SIZEバイト)
+    """
+    return hashlib.blake2s(data, key=key, digest_size=MAC_SIZE).digest()
+
+
+def verify_mac(key, view):
+    """末尾のMACを定数時間で比較する
+
+    :param key: セッション鍵
+    :param view: 受信データ(memoryview)
+    :return: 正しいか
+    """
+    if len(view) < COMPACT_HEADER.size + MAC_SIZE:
+        return False
+    return hmac.compare_digest(compute_mac(key, view[:-MAC_SIZE]), view[-MAC_SIZE:])
+
+
+def sender_key(view):
+    """ヘッダーだけを見て送信者を識別するキーを取り出す(デコード・参照なし)
+
+    :param view: 受信データ(memoryview)
+    :return: コンパクト形式ならセッションID(int)、従来形式ならトークン(byte)
+    """
+    if view[0] == COMPACT_MARKER:
+        return COMPACT_HEADER.unpack_from(view)[2]
+    room_name_size, token_size = LEGACY_HEADER.unpack_from(view)
+    token_offset = LEGACY_HEADER.size + room_name_size
+    return bytes(view[token_offset : token_offset + token_size])
+
+
+# 信頼モード(上り): コンパクト形式のFlagsで種類を示す
+# FLAG_RELIABLE: Message の前に ClientSeq(4) を付ける(サーバーはKIND_ACKを返し、再送は重複として捨てる)
+# FLAG_NACK: Message の代わりに再送してほしい範囲 (FirstSeq(4) | Count(2)) を並べる
+FLAG_RELIABLE = 0x01
+FLAG_NACK = 0x02
+CLIENT_SEQUENCE = struct.Struct("!I")
+NACK_RANGE = struct.Struct("!I H")
+
+# 信頼モード(下り): Marker(1) = 0 | Kind(1) | Seq(4) | Value(4) | Data
+# KIND_DATA: 部屋ごとの連番つきメッセージ(Valueは送信者のセッションID)
+# KIND_HEARTBEAT: 最新の連番の通知(末尾の欠落を検出するため)
+# KIND_LOST: 再送できない範囲の通知(Seqから Value 件)
+# KIND_ACK: 送信者だけに返す上りメッセージの受領通知(SeqはClientSeq、Valueは割り当てた部屋の連番)
+# KIND_LEFT/KIND_CLOSED: 退出・部屋の終了の通知(Valueは退出した参加者のセッションID、Dataは通知文)
+# Seqが0のデータグラムは順序づけない通知(タイムアウトで退出させた本人への通知など)
+SEQUENCED_HEADER = struct.Struct("!B B I I")
+KIND_DATA = 1
+KIND_HEARTBEAT = 2
+KIND_LOST = 3
+KIND_ACK = 4
+KIND_LEFT = 6
+KIND_CLOSED = 7
+# KIND_FRAGMENT: 大きなメッセージの断片(Valueは送信者のセッションID、DataはFRAGMENT_HEADERと断片)
+# 信頼モードでない参加者にはSeqを0にして送る
+KIND_FRAGMENT = 9
+
+
+def pack_reliable(session_id, client_sequence, message, key=None, flags=0):
+    """送達確認つきのコンパクト形式データグラムを作成する
+
+    :param session_id: セッションID
+    :param client_sequence: クライアントが付ける連番
+    :param message: メッセージ(byte)
+    :param key: セッション鍵(指定するとMACを付ける)
+    :param flags: FLAG_RELIABLE以外のフラグ
+    :return: データグラム
+    """
+    return pack_compact(
+        session_id, CLIENT_SEQUENCE.pack(client_sequence) + message, FLAG_RELIABLE | flags, key
+    )
+
+
+def pack_nack(session_id, ranges, key=None):
+    """再送要求のデータグラムを作成する
+
+    :param session_id: セッションID
+    :param ranges: [(先頭の連番, 件数)]
+    :param key: セッション鍵(指定するとMACを付ける)
+    :return: データグラム
+    """
+    return pack_compact(
+        session_id,
+        b"".join(NACK_RANGE.pack(first, count) for first, count in ranges),
+        FLAG_NACK,
+        key,
+    )
+
+
+def pack_sequenced(kind, sequence, value, data=b""):
+    """信頼モードの下りデータグラムを作成する
+
+    :param kind: 種類(KIND_DATA/KIND_HEARTBEAT/KIND_LOST/KIND_FRAGMENTなど)
+    :param sequence: 部屋ごとの連番
+    :param value: 種類ごとの値
+    :param data: メッセージ(byte)
+    :return: データグラム
+    """
+    return SEQUENCED_HEADER.pack(COMPACT_MARKER, kind, sequence, value) + data
+
+
+# 結合データグラム(下り): Marker(1) = 0 | Kind(1) = KIND_BATCH | Count(2) | (Length(2) | Datagram) * Count
+# 同じ部屋の複数のメッセージ(通常のテキストまたは連番つき)を1つのデータグラムにまとめる
+KIND_BATCH = 5
+BATCH_HEADER = struct.Struct("!B B H")
+BATCH_LENGTH = struct.Struct("!H")
+
+
+def pack_batch(datagrams):
+    """複数のデータグラムを1つにまとめる
+
+    :param datagrams: データグラム(byte)のリスト
+    :return: 結合データグラム
+    """
+    parts = [BATCH_HEADER.pack(COMPACT_MARKER, KIND_BATCH, len(datagrams))]
+    for datagram in datagrams:
+        parts.append(BATCH_LENGTH.pack(len(datagram)))
+        parts.append(datagram)
+    return b"".join(parts)
+
+
+def unpack_batch(data):
+    """結合データグラムを元のデータグラムに分割する
+
+    :param data: 受信データ
+    :return: データグラム(memoryview)のリスト
+    """
+    view = memoryview(data)
+    _, _, count = BATCH_HEADER.unpack_from(view)
+    offset = BATCH_HEADER.size
+    datagrams = []
+    for _ in range(count):
+        (length,) = BATCH_LENGTH.unpack_from(view, offset)
+        offset += BATCH_LENGTH.size
+        if offset + length > len(view):
+            raise ValueError("truncated batch")
+        datagrams.append(view[offset : offset + length])
+        offset += length
+    return datagrams
+
+
+# 圧縮データグラム(下り): Marker(1) = 0 | Kind(1) = KIND_COMPRESSED | 圧縮した元のデータグラム
+# 元のデータグラムは通常のテキスト・連番つき・結合データグラムのいずれでもよい
+KIND_COMPRESSED = 8
+COMPRESSED_HEADER = struct.Struct("!B B")
+COMPRESS_LEVEL = 6
+# これより小さいメッセージは圧縮しない(ヘッダーと辞書の効果が見合わない)
+COMPRESS_THRESHOLD = 256
+# メッセージは数KBなので窓と内部状態を小さくし、圧縮器を作る費用を抑える
+COMPRESS_WBITS = 12
+COMPRESS_MEM_LEVEL = 4
+# 圧縮の辞書(クライアントとサーバーで共通。よく出る文字列ほど末尾に置く)
+COMPRESSION_DICTIONARY = (
+    "https://www. http:// .com/ .jp/ github.com/ ```python\n```\n"
+    "Traceback (most recent call last):\n  File \"\", line , in \n"
+    "def return import from class self. None True False "
+    " the and that this with for you have are not what but can just "
+    "thanks ok lol yes no please "
+    "ありがとうございます。よろしくお願いします。お疲れさまです。"
+    "です。ます。でした。ました。ですね。ですか?"
+    "ホストが退出したため、チャットルーム:を終了します"
+    "から退出しました\n"
+).encode("utf-8")
+
+
+def compress(data):
+    """辞書つきのdeflate(ヘッダーなし)で圧縮する
+
+    :param data: 元のデータ(bytes/memoryview)
+    :return: 圧縮したデータ
+    """
+    compressor = zlib.compressobj(
+        COMPRESS_LEVEL,
+        zlib.DEFLATED,
+        -COMPRESS_WBITS,
+        COMPRESS_MEM_LEVEL,
+        zdict=COMPRESSION_DICTIONARY,
+    )
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress(data, max_size):
+    """compressで圧縮したデータを展開する
+
+    :param data: 圧縮したデータ(bytes/memoryview)
+    :param max_size: 展開後の上限(超える場合はValueError)
+    :return: 展開したデータ
+    """
+    decompressor = zlib.decompressobj(-COMPRESS_WBITS, zdict=COMPRESSION_DICTIONARY)
+    inflated = decompressor.decompress(data, max_size)
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        raise ValueError("compressed data is too large or truncated")
+    return inflated
+
+
+def compress_message(message, threshold=COMPRESS_THRESHOLD):
+    """上りメッセージが大きければ圧縮する
+
+    :param message: メッセージ(byte)
+    :param threshold: 圧縮する最小のバイト数
+    :return: (メッセージ, フラグ(圧縮した場合はFLAG_COMPRESSED))
+    """
+    if len(message) >= threshold:
+        compressed = compress(message)
+        if len(compressed) < len(message):
+            return compressed, FLAG_COMPRESSED
+    return message, 0
+
+
+def pack_compressed(datagram):
+    """下りデータグラムを圧縮データグラムにする
+
+    :param datagram: 元のデータグラム
+    :return: 圧縮データグラム
+    """
+    return COMPRESSED_HEADER.pack(COMPACT_MARKER, KIND_COMPRESSED) + compress(datagram)
+
+
+def unpack_compressed(data, max_size=65536):
+    """圧縮データグラムを元のデータグラムに戻す
+
+    :param data: 受信データ
+    :param max_size: 展開後の上限
+    :return: 元のデータグラム
+    """
+    return decompress(memoryview(data)[COMPRESSED_HEADER.size :], max_size)
+
+
+def split_datagrams(data):
+    """受信した下りデータグラムを圧縮・結合を解いて元のデータグラムに分ける
+
+    :param data: 受信データ
+    :return: データグラムのリスト
+    """
+    if data[0] == COMPACT_MARKER and data[1] == KIND_COMPRESSED:
+        data = unpack_compressed(data)
+    if data[0] == COMPACT_MARKER and data[1] == KIND_BATCH:
+        return unpack_batch(data)
+    return [data]
+
+
+# 断片: MessageId(4) | Index(2) | Count(2) | 断片のデータ
+# MessageIdは送信者ごとに一意(受信側は送信者のセッションIDと組み合わせて組み立てる)
+# 最初の断片にだけ、サーバーが"ユーザー名: "を付け足して中継する
+FRAGMENT_HEADER = struct.Struct("!I H H")
+# 1つの断片のデータの上限(ヘッダーを足してもMTUに収まる大きさ)
+FRAGMENT_SIZE = 1200
+# 1つのメッセージの断片数の上限
+MAX_FRAGMENTS = 256
+
+
+def pack_fragments(message, message_id, size=FRAGMENT_SIZE):
+    """メッセージを断片に分ける
+
+    :param message: メッセージ(byte)
+    :param message_id: メッセージID
+    :param size: 1つの断片のデータの上限
+    :return: 断片(FRAGMENT_HEADER + データ)のリスト
+    """
+    count = -(-len(message) // size)
+    if count > MAX_FRAGMENTS:
+        raise ValueError(f"message is too large: {len(message)} bytes")
+    return [
+        FRAGMENT_HEADER.pack(message_id, index, count) + message[index * size : (index + 1) * size]
+        for index in range(count)
+    ]
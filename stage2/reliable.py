@@ -0,0 +1,170 @@
+import threading
+import time
+from collections import deque
+
+import packet
+
+
+class ResendWindow:
+    """チャットルームの信頼モード用の再送ウィンドウ(サーバー側)
+
+    部屋ごとに連番を割り当て、直近max_messages件のデータグラムを再送用に保持する。
+    """
+
+    def __init__(self, max_messages=1024):
+        self.max_messages = max_messages
+        self.datagrams = deque()
+        # datagramsの先頭の連番
+        self.first_sequence = 1
+        self.next_sequence = 1
+        self.lock = threading.Lock()
+
+    @property
+    def latest_sequence(self):
+        """最後に割り当てた連番(まだなければ0)"""
+        return self.next_sequence - 1
+
+    def append(self, data, sender_session_id, kind=packet.KIND_DATA):
+        """連番を割り当てて保持する
+
+        :param data: 送信データ(byte)
+        :param sender_session_id: 送信者のセッションID
+        :param kind: 種類(KIND_DATA/KIND_LEFT/KIND_CLOSED/KIND_FRAGMENT)
+        :return: (連番, 送信するデータグラム)
+        """
+        with self.lock:
+            sequence = self.next_sequence
+            datagram = packet.pack_sequenced(kind, sequence, sender_session_id, data)
+            self.datagrams.append(datagram)
+            self.next_sequence += 1
+            if len(self.datagrams) > self.max_messages:
+                self.datagrams.popleft()
+                self.first_sequence += 1
+            return sequence, datagram
+
+    def get(self, sequence):
+        """再送するデータグラムを取得する
+
+        :param sequence: 連番
+        :return: データグラム(ウィンドウの外ならNone)
+        """
+        with self.lock:
+            if self.first_sequence <= sequence < self.next_sequence:
+                return self.datagrams[sequence - self.first_sequence]
+            return None
+
+
+# 連番順に取り出す種類
+ORDERED_KINDS = (packet.KIND_DATA, packet.KIND_LEFT, packet.KIND_CLOSED, packet.KIND_FRAGMENT)
+
+
+class ReliableReceiver:
+    """信頼モードの受信側(クライアント側)
+
+    連番の欠落を検出して再送要求(NACK)の範囲を求め、重複を捨て、連番順に取り出す。
+    ACKは送らず、欠落したときだけnack_interval秒に1回まとめてNACKを送る。
+    """
+
+    def __init__(self, nack_interval=0.2, clock=time.monotonic):
+        """
+        :param nack_interval: 同じ欠落に再送要求を送り直す間隔(秒)
+        :param clock: 現在時刻を返す関数
+        """
+        self.nack_interval = nack_interval
+        self.clock = clock
+        # 次に取り出す連番(最初に受信した連番から始める)
+        self.expected = None
+        # サーバーが送ったとわかっている最大の連番
+        self.latest = 0
+        # 先に届いた連番 -> (種類, 送信者のセッションID, データ)。再送できない連番はNone
+        self.pending = {}
+        self.last_nack_at = None
+
+    def start(self, sequence):
+        """入室レスポンスで通知された連番から受信を始める
+
+        :param sequence: 最初に受信する連番
+        """
+        self.expected = sequence
+        self.latest = sequence - 1
+
+    def receive(self, datagram):
+        """下りデータグラムを処理する
+
+        :param datagram: 受信データ
+        :return: 連番順に取り出せた[(種類, 送信者のセッションID, データ)]
+        """
+        _, kind, sequence, value = packet.SEQUENCED_HEADER.unpack_from(datagram)
+        if sequence == 0:
+            # 順序づけない通知はそのまま渡す
+            return [(kind, value, datagram[packet.SEQUENCED_HEADER.size :])]
+        if kind == packet.KIND_HEARTBEAT:
+            if self.expected is None:
+                self.expected = sequence + 1
+            self.latest = max(self.latest, sequence)
+            return []
+        if self.expected is None:
+            self.expected = sequence
+        if kind == packet.KIND_LOST:
+            for lost in range(max(sequence, self.expected), sequence + value):
+                self.pending[lost] = None
+            self.latest = max(self.latest, sequence + value - 1)
+        elif kind in ORDERED_KINDS:
+            if sequence < self.expected or self.pending.get(sequence) is not None:
+                # 重複
+                return []
+            self.pending[sequence] = (kind, value, datagram[packet.SEQUENCED_HEADER.size :])
+            self.latest = max(self.latest, sequence)
+        return self.__drain()
+
+    def skip(self, sequence):
+        """受信しない連番(自分が送ったメッセージ)を欠落として扱わないようにする
+
+        :param sequence: 連番(0なら何もしない)
+        :return: 連番順に取り出せた[(種類, 送信者のセッションID, データ)]
+        """
+        if sequence == 0 or self.expected is None or sequence < self.expected:
+            return []
+        if sequence not in self.pending:
+            self.pending[sequence] = None
+        self.latest = max(self.latest, sequence)
+        return self.__drain()
+
+    def __drain(self):
+        """連番順に取り出せるものを取り出す"""
+        delivered = []
+        while self.expected in self.pending:
+            item = self.pending.pop(self.expected)
+            if item is not None:
+                delivered.append(item)
+            self.expected += 1
+        return delivered
+
+    def missing_ranges(self, max_ranges=64):
+        """再送を要求する範囲を求める(前回の要求からnack_interval秒経っていなければ空)
+
+        :param max_ranges: 1回で要求する範囲数の上限
+        :return: [(先頭の連番, 件数)]
+        """
+        if self.expected is None or self.expected > self.latest:
+            return []
+        now = self.clock()
+        if self.last_nack_at is not None and now - self.last_nack_at < self.nack_interval:
+            return []
+        ranges = []
+        sequence = self.expected
+        while sequence <= self.latest and len(ranges) < max_ranges:
+            if sequence in self.pending:
+                sequence += 1
+                continue
+            first = sequence
+            while (
+                sequence <= self.latest
+                and sequence not in self.pending
+                and sequence - first < 0xFFFF
+            ):
+                sequence += 1
+            ranges.append((first, sequence - first))
+        if ranges:
+            self.last_nack_at = now
+        return ranges
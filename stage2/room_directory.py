@@ -0,0 +1,61 @@
+import bisect
+import threading
+
+
+class RoomDirectory:
+    """チャットルーム名のソート済みインデックス
+
+    部屋の作成・削除のたびに二分探索で挿入・削除し、一覧の取得で辞書全体をコピーしない。
+    前方一致は二分探索で開始位置を求め、部分一致は開始位置から必要な件数だけ走査する。
+    部屋名はUTF-8のbytesで保持する(bytesの順序はコードポイント順と一致する)。
+    """
+
+    def __init__(self):
+        self.names = []
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name):
+        """部屋名を追加する
+
+        :param name: チャットルーム名(byte)
+        """
+        with self.lock:
+            bisect.insort(self.names, name)
+
+    def remove(self, name):
+        """部屋名を削除する
+
+        :param name: チャットルーム名(byte)
+        """
+        with self.lock:
+            i = bisect.bisect_left(self.names, name)
+            if i < len(self.names) and self.names[i] == name:
+                del self.names[i]
+
+    def search(self, prefix=b"", contains=b"", after=None, limit=100):
+        """条件に合う部屋名を名前順に取得する
+
+        :param prefix: 前方一致させる文字列(byte)
+        :param contains: 部分一致させる文字列(byte)
+        :param after: この部屋名より後から取得する(前ページの最後の部屋名、byte)
+        :param limit: 最大件数
+        :return: (部屋名のリスト, 続きがあるか)
+        """
+        found = []
+        with self.lock:
+            names = self.names
+            start = bisect.bisect_left(names, prefix)
+            if after is not None:
+                start = max(start, bisect.bisect_right(names, after))
+            for i in range(start, len(names)):
+                name = names[i]
+                if not name.startswith(prefix):
+                    break
+                if contains in name:
+                    if len(found) == limit:
+                        return found, True
+                    found.append(name)
+        return found, False
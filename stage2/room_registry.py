@@ -0,0 +1,128 @@
+import threading
+
+import room_directory
+
+
+class RoomRegistry:
+    """チャットルームをシャードに分けて管理するレジストリ
+
+    部屋名のハッシュでシャードを決め、シャードごとのロックで作成・削除を直列化する。
+    参照(get)はロックを取らない。
+    部屋名はstrでもUTF-8のbytesでも指定でき、内部ではbytesをキーにする。
+    作成・削除に合わせて部屋名のソート済みインデックス(directory)も更新する。
+    """
+
+    def __init__(self, shard_count=16):
+        self.shard_count = shard_count
+        self.shards = [{} for _ in range(shard_count)]
+        self.locks = [threading.Lock() for _ in range(shard_count)]
+        self.directory = room_directory.RoomDirectory()
+
+    def __key(self, room_name):
+        """部屋名をレジストリのキー(bytes)に変換する
+
+        :param room_name: チャットルーム名(str/bytes)
+        :return: キー
+        """
+        if isinstance(room_name, str):
+            return room_name.encode("utf-8")
+        return room_name
+
+    def __shard_index(self, key):
+        """キーからシャード番号を求める
+
+        :param key: キー
+        :return: シャード番号
+        """
+        return hash(key) % self.shard_count
+
+    def get(self, room_name):
+        """チャットルームを取得する
+
+        :param room_name: チャットルーム名(str/bytes)
+        :return: チャットルーム(存在しない場合はNone)
+        """
+        key = self.__key(room_name)
+        return self.shards[self.__shard_index(key)].get(key)
+
+    def __getitem__(self, room_name):
+        room = self.get(room_name)
+        if room is None:
+            raise KeyError(f"{room_name} not found")
+        return room
+
+    def __contains__(self, room_name):
+        return self.get(room_name) is not None
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def create(self, room_name, factory):
+        """チャットルームを作成して登録する(同名の部屋があれば失敗)
+
+        :param room_name: チャットルーム名
+        :param factory: チャットルームを生成する関数
+        :return: 作成したチャットルーム
+        """
+        key = self.__key(room_name)
+        index = self.__shard_index(key)
+        with self.locks[index]:
+            shard = self.shards[index]
+            if key in shard:
+                raise KeyError(f"{room_name} already exists")
+            room = factory()
+            shard[key] = room
+            self.directory.add(key)
+            return room
+
+    def remove(self, room_name, room=None):
+        """チャットルームを登録から外す
+
+        :param room_name: チャットルーム名
+        :param room: 指定した場合は同じインスタンスが登録されているときだけ外す
+        :return: 外したチャットルーム(登録されていなければNone)
+        """
+        key = self.__key(room_name)
+        index = self.__shard_index(key)
+        with self.locks[index]:
+            shard = self.shards[index]
+            current = shard.get(key)
+            if current is None or (room is not None and current is not room):
+                return None
+            del shard[key]
+            self.directory.remove(key)
+            return current
+
+    def search(self, prefix="", contains="", after=None, limit=100):
+        """部屋名で検索してチャットルームを名前順に取得する
+
+        :param prefix: 前方一致させる文字列
+        :param contains: 部分一致させる文字列
+        :param after: この部屋名より後から取得する(ページング用)
+        :param limit: 最大件数
+        :return: (チャットルームのリスト, 続きがあるか)
+        """
+        keys, has_more = self.directory.search(
+            self.__key(prefix),
+            self.__key(contains),
+            self.__key(after) if after is not None else None,
+            limit,
+        )
+        rooms = []
+        for key in keys:
+            room = self.get(key)
+            # 検索後に削除された部屋は飛ばす
+            if room is not None:
+                rooms.append(room)
+        return rooms, has_more
+
+    def rooms(self):
+        """登録済みチャットルームの一覧(シャードごとのコピー)
+
+        :return: チャットルームのリスト
+        """
+        rooms = []
+        for index, shard in enumerate(self.shards):
+            with self.locks[index]:
+                rooms.extend(shard.values())
+        return rooms
@@ -1,84 +1,460 @@
+import argparse
+import itertools
+import struct
 import json
+import logging
 import secrets
 import socket
-import struct
 import threading
+import time
 from concurrent.futures import ThreadPoolExecutor
 
+import backpressure
 import chat_room
+import coalesce
+import control
+import fanout
+import handshake
+import history
+import logger as log_config
+import message_log
+import metrics
+import packet
+import reliable
+import room_registry
+import teardown
+import tcrp
+import timing_wheel
+
+logger = logging.getLogger("chat")
+
 
 class Server:
-    def __init__(self):
-        self.tcp_address = ("127.0.0.1", 9002)
-        self.udp_address = ("127.0.0.1", 9003)
+    def __init__(
+        self,
+        tcp_address=("127.0.0.1", 9002),
+        udp_address=("127.0.0.1", 9003),
+        listen_backlog=128,
+        handshake_workers=32,
+        read_timeout=5.0,
+        fanout_workers=0,
+        history_messages=100,
+        history_room_bytes=64 * 1024,
+        history_total_bytes=64 * 1024 * 1024,
+        session_timeout=300,
+        reuse_port=False,
+        metrics_address=None,
+        sender_rate=0,
+        sender_burst=20,
+        room_rate=0,
+        room_burst=200,
+        inbound_queue=0,
+        queue_policy=backpressure.DROP_OLDEST,
+        message_log_dir=None,
+        message_log_segment_bytes=16 * 1024 * 1024,
+        message_log_fsync_interval=0.05,
+        max_channels=1024,
+        channel_idle_timeout=300,
+        reliable_window=1024,
+        require_mac=False,
+        coalesce_window=0,
+        coalesce_bytes=1200,
+        compress_threshold=256,
+        host_handoff=False,
+        advertise_udp_address=None,
+    ):
+        self.tcp_address = tcp_address
+        self.udp_address = udp_address
+        # TCRPハンドシェイクの設定
+        self.listen_backlog = listen_backlog
+        self.handshake_workers = handshake_workers
+        self.read_timeout = read_timeout
+        # コントロールチャネル(1接続で複数リクエストを送る長期接続)の設定
+        self.channel_slots = threading.BoundedSemaphore(max_channels)
+        self.channel_idle_timeout = channel_idle_timeout
         self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            # 複数のワーカープロセスで同じポートを共有する
+            self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.udp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.tcp_socket.bind(self.tcp_address)
         self.udp_socket.bind(self.udp_address)
-        self.rooms = {}
+        # 入室レスポンスで通知するUDPアドレス(クラスター構成ではクライアントから届くアドレス)
+        self.advertise_udp_address = advertise_udp_address or self.udp_socket.getsockname()
+        self.rooms = room_registry.RoomRegistry()
+        # セッションID -> Member(コンパクト形式のデータグラムで参照する)
+        self.sessions = {}
+        self.session_ids = itertools.count(1)
+        # 一定時間発言のないセッションをサーバー側で退出させる
+        self.session_timeout = session_timeout
+        self.idle_timer = timing_wheel.TimingWheel(tick=1.0)
+        # 送信の失敗はメトリクスのdropsに数える
+        self.fanout = fanout.Fanout(
+            self.udp_socket, workers=fanout_workers, on_error=self.count_send_failure
+        )
+        # 同じ部屋のメッセージをまとめて送る(0ならメッセージごとにすぐ送る)
+        self.coalescer = (
+            coalesce.Coalescer(coalesce_window, coalesce_bytes, self.flush_batch)
+            if coalesce_window > 0
+            else None
+        )
+        # メッセージ履歴の設定(件数・部屋ごとの上限と全部屋共通の上限)
+        self.history_messages = history_messages
+        self.history_room_bytes = history_room_bytes
+        self.history_budget = history.HistoryBudget(history_total_bytes)
+        # 永続化する場合はメモリ上の履歴の代わりに部屋ごとの追記専用ログを使う
+        self.message_log = (
+            message_log.MessageLog(
+                message_log_dir,
+                segment_bytes=message_log_segment_bytes,
+                fsync_interval=message_log_fsync_interval,
+            )
+            if message_log_dir is not None
+            else None
+        )
+        # 中継処理のメトリクス(metrics_addressを指定するとHTTPで公開する)
+        self.metrics = metrics.ServerMetrics()
+        self.metrics.add(
+            metrics.Gauge("chat_active_rooms", "rooms currently open", lambda: len(self.rooms))
+        )
+        self.metrics.add(
+            metrics.Gauge(
+                "chat_active_users", "sessions currently joined", lambda: len(self.sessions)
+            )
+        )
+        self.metrics_address = metrics_address
+        self.metrics_server = None
+        # 信頼モード: 部屋ごとの再送ウィンドウの件数と、ハートビートを送る部屋(部屋 -> 残り回数)
+        self.reliable_window = reliable_window
+        self.heartbeat_rooms = {}
+        # 終了した部屋 -> (信頼モードだった参加者のアドレス, 残り回数)
+        self.closed_rooms = {}
+        self.retransmits = self.metrics.add(
+            metrics.Counter(
+                "chat_retransmitted_datagrams_total", "datagrams resent on NACK", label_name="kind"
+            )
+        )
+        # MACのないデータグラム(従来形式を含む)を受け付けないか
+        self.require_mac = require_mac
+        # このバイト数以上のデータグラムを、圧縮を受け取る参加者へ圧縮して送る(0なら圧縮しない)
+        self.compress_threshold = compress_threshold
+        self.compression_saved = self.metrics.add(
+            metrics.Counter(
+                "chat_compression_saved_bytes_total", "outbound bytes saved by compression"
+            )
+        )
+        self.compression_seconds = self.metrics.add(
+            metrics.Counter(
+                "chat_compression_seconds_total", "time spent in zlib", label_name="op"
+            )
+        )
+        # ホストが退出したとき、部屋を終了せずに最も長く参加している参加者をホストにするか
+        self.host_handoff = host_handoff
+        # 終了した部屋の参加者への通知とセッションの破棄は、中継処理の外でまとめて行う
+        self.teardown = teardown.Teardown(self.finish_member, self.finish_room)
+        self.metrics.add(
+            metrics.Gauge(
+                "chat_teardown_pending",
+                "members of closed rooms waiting to be notified",
+                lambda: len(self.teardown),
+            )
+        )
+        # 送信者・部屋ごとのレート制限(0なら制限しない)
+        self.sender_limiter = (
+            backpressure.RateLimiter(sender_rate, sender_burst) if sender_rate > 0 else None
+        )
+        self.room_rate = room_rate
+        self.room_burst = room_burst
+        # 受信から中継までの上限付きキュー(0なら受信したスレッドでそのまま中継する)
+        self.inbound_queue = (
+            backpressure.InboundQueue(inbound_queue, queue_policy) if inbound_queue > 0 else None
+        )
+        if self.inbound_queue is not None:
+            self.metrics.add(
+                metrics.Gauge(
+                    "chat_inbound_queue_depth",
+                    "datagrams waiting to be relayed",
+                    lambda: len(self.inbound_queue),
+                )
+            )
         # クライアントアクション
         self.CREATE_ROOM = 1
         self.JOIN_ROOM = 2
         self.QUIT = 3
+        self.FETCH_HISTORY = 4
+        self.CONTROL_CHANNEL = 5
+        self.LEAVE_ROOM = 6
+        self.LIST_ROOMS = 7
         # State
         self.SERVER_INIT = 0
         self.REQUEST_OF_RESPPONSE = 1
         self.REQUEST_COMPLETION = 2
         self.ERROR_RESPONSE = 3
+        # UDP受信バッファ
+        self.RECV_BUFFER_SIZE = 4096
+        # 部屋一覧の1ページの上限
+        self.MAX_LIST_ROOMS = 1000
+        # 1回の再送要求で再送する上限
+        self.MAX_RETRANSMIT = 256
+        # 最後のメッセージの後にハートビートを送る回数(タイミングホイールの1tickごと)
+        self.HEARTBEAT_TICKS = 3
     
     def start(self):
         """サーバーを起動する"""
-        print("Server started Port: 9002")
+        logger.info("Server started Port: %d", self.tcp_address[1])
+        self.recover_rooms()
+        self.start_metrics()
 
         while True:
             try:
-                with ThreadPoolExecutor(max_workers=2) as executor:
+                with ThreadPoolExecutor(max_workers=6) as executor:
                     executor.submit(self.__hand_tcp_con)
                     executor.submit(self.__handle_udp_conn)
+                    executor.submit(self.__expire_idle_sessions)
+                    executor.submit(self.teardown.run)
+                    if self.inbound_queue is not None:
+                        executor.submit(self.__relay_queued)
+                    if self.coalescer is not None:
+                        executor.submit(self.coalescer.run)
             except:
                 self.tcp_socket.close()
                 self.udp_socket.close()
-                print("\nServer Closed")
+                self.stop_metrics()
+                self.close_message_log()
+                logger.info("Server Closed")
                 break
 
+    def recover_rooms(self):
+        """保存済みのログからチャットルームを復元する(参加者はいない状態で復元する)
+
+        ホストのいない状態で復元し、最初に参加し直した人がホストになる。
+        """
+        if self.message_log is None:
+            return
+        for room_name, room_log in self.message_log.recover(self.owns_room):
+            room = chat_room.ChatRoom(
+                room_name,
+                room_log,
+                self.__room_rate_limit(),
+                reliable.ResendWindow(self.reliable_window),
+            )
+            self.rooms.create(room_name, lambda room=room: room)
+            logger.info("%sを復元しました(%d件)", room_name, room_log.next_offset)
+
+    def owns_room(self, room_name):
+        """このサーバーが担当するチャットルームか
+
+        :param room_name: チャットルーム名
+        :return: 担当するか
+        """
+        return True
+
+    def close_message_log(self):
+        """未同期のログをfsyncして閉じる"""
+        if self.message_log is not None:
+            self.message_log.close()
+
+    def start_metrics(self):
+        """メトリクスのHTTPエンドポイントを起動する(metrics_address指定時のみ)"""
+        if self.metrics_address is None:
+            return
+        self.metrics_server = metrics.MetricsServer(self.metrics, self.metrics_address)
+        self.metrics_server.start()
+        logger.info("Metrics at http://%s:%d/metrics", *self.metrics_address)
+
+    def stop_metrics(self):
+        """メトリクスのHTTPエンドポイントを停止する"""
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            self.metrics_server = None
+
+    def count_send_failure(self):
+        """一斉送信で送れなかったデータグラムを数える"""
+        self.metrics.drops.inc(label="send_failed")
+
     def __hand_tcp_con(self):
-        """TCP接続を処理する"""
-        HEADER_BYTE_SZIE = 32
-        while True:
-            self.tcp_socket.listen(5)
-            conn, _ = self.tcp_socket.accept()
+        """TCP接続を受け付け、ワーカースレッドでハンドシェイクを並行処理する
 
-            try:
-                # クライアントデータ受信
-                header = conn.recv(HEADER_BYTE_SZIE)
-                room_name_size, operation, _, _ = struct.unpack_from("!B B B 29s", header)
-                
-                body = conn.recv(4096)
-                room_name = body[:room_name_size].decode("utf-8")
-                operation_payload = body[room_name_size:].decode("utf-8")
-
-                # OperationPayloadを辞書に変換
-                payload = json.loads(operation_payload)
-                user_name = payload["user_name"]
-                user_address = payload["user_address"]
+        処理中の接続がワーカー数の2倍に達したらacceptを止め、残りはlistenのバックログで待たせる。
+        """
+        self.tcp_socket.listen(self.listen_backlog)
+        slots = threading.BoundedSemaphore(self.handshake_workers * 2)
 
-            except Exception as e:
-                print(f"Server Error1: {e}")
-                self.__send_state_res(
-                    conn, room_name, operation, self.ERROR_RESPONSE, ""
-                )
+        with ThreadPoolExecutor(max_workers=self.handshake_workers) as executor:
+            while True:
+                slots.acquire()
+                try:
+                    conn, _ = self.tcp_socket.accept()
+                except OSError:
+                    slots.release()
+                    raise
+                executor.submit(self.__handle_tcp_request, conn, slots, time.perf_counter())
 
-            try:
-                token = self.handle_room(
-                    room_name, user_address, user_name, operation
-                )
+    def __handle_tcp_request(self, conn, slots, accepted_at):
+        """1接続分のTCRPハンドシェイクを処理する
 
-                self.__send_state_res(
-                    conn, room_name, operation, self.REQUEST_COMPLETION, token
-                )
-            except Exception as e:
-                print(f"Server Error2:{e}")
-                self.__send_state_res(conn, room_name, operation, self.SERVER_INIT, "")
+        :param conn: ソケットオブジェクト
+        :param slots: 処理中接続数を制限するセマフォ
+        :param accepted_at: acceptした時刻(perf_counter)
+        """
+        try:
+            # クライアントデータ受信(接続ごとの読み込み期限付き)
+            deadline = time.monotonic() + self.read_timeout
+            header, body = tcrp.read_request(conn, deadline)
+            conn.settimeout(self.read_timeout)
+            if tcrp.unpack_header(header)[1] == self.CONTROL_CHANNEL:
+                if self.open_channel(conn):
+                    # 長期接続はハンドシェイクのワーカーを占有しないよう専用スレッドで処理する
+                    threading.Thread(target=self.__serve_channel, args=(conn,), daemon=True).start()
+                    conn = None
+                return
+            conn.sendall(self.handle_tcrp_request(header, body))
+            self.metrics.handshake_seconds.observe(time.perf_counter() - accepted_at)
+        except (OSError, ValueError) as e:
+            logger.warning("Server Error1: %s", e)
+        finally:
+            if conn is not None:
+                conn.close()
+            slots.release()
+
+    def open_channel(self, conn):
+        """コントロールチャネルを受け付ける(上限に達していればエラーを返す)
+
+        :param conn: ソケットオブジェクト
+        :return: 受け付けたか
+        """
+        if not self.channel_slots.acquire(blocking=False):
+            conn.sendall(self.build_state_res("", self.CONTROL_CHANNEL, self.ERROR_RESPONSE))
+            return False
+        try:
+            conn.sendall(
+                self.build_state_res("", self.CONTROL_CHANNEL, self.REQUEST_OF_RESPPONSE)
+            )
+        except OSError:
+            # 受け付けを返せなかった(クライアントが切断した)ので枠を返す
+            self.channel_slots.release()
+            raise
+        return True
+
+    def __serve_channel(self, conn):
+        """コントロールチャネルのリクエストを順番に処理する(スレッドモード)
+
+        :param conn: ソケットオブジェクト
+        """
+        try:
+            while True:
+                frame = control.read_frame(conn, self.channel_idle_timeout, self.read_timeout)
+                if frame is None:
+                    break
+                request_id, header, body = frame
+                conn.sendall(control.pack_frame(request_id, self.handle_tcrp_request(header, body)))
+        except (OSError, ValueError) as e:
+            logger.info("Channel closed: %s", e)
+        finally:
+            conn.close()
+            self.channel_slots.release()
+
+    def handle_tcrp_request(self, header, body):
+        """TCRPリクエストを処理してレスポンスを作成する
+
+        :param header: リクエストヘッダー(32バイト)
+        :param body: リクエストボディ(チャットルーム名 + OperationPayload)
+        :return: レスポンス(ヘッダー + ペイロード)
+        """
+        room_name = ""
+        operation = 0
+        binary = False
+        try:
+            room_name_size, operation, _, _ = tcrp.unpack_header(header)
+            self.metrics.handshakes.inc(label=operation)
+            room_name = body[:room_name_size].decode("utf-8")
+            operation_payload = body[room_name_size:]
+            # 先頭バイトがバージョン番号ならバイナリ形式(レスポンスも同じ形式で返す)
+            binary = operation in (self.CREATE_ROOM, self.JOIN_ROOM) and handshake.is_binary(
+                operation_payload
+            )
+
+            # JSON形式の完了レスポンスには常にUDPアドレスを含める
+            udp_address = False
+            if binary:
+                (
+                    user_name,
+                    user_address,
+                    history_count,
+                    reliable_mode,
+                    compress,
+                    udp_address,
+                    fragment,
+                ) = handshake.unpack_join_request(operation_payload)
+            else:
+                # OperationPayloadを辞書に変換(部屋一覧などは空でもよい)
+                payload = json.loads(operation_payload.decode("utf-8")) if operation_payload else {}
+                if operation == self.FETCH_HISTORY:
+                    token = payload["token"]
+                    history_count = int(payload.get("count", self.history_messages))
+                    # 指定したオフセット以降を取得する(省略時は直近から)
+                    since = payload.get("since")
+                elif operation == self.LEAVE_ROOM:
+                    token = payload["token"]
+                elif operation == self.LIST_ROOMS:
+                    # 前方一致・部分一致で絞り込み、afterで指定した部屋名の次からlimit件返す
+                    after = payload.get("after")
+                    search = {
+                        "prefix": str(payload.get("prefix", "")),
+                        "contains": str(payload.get("contains", "")),
+                        "after": str(after) if after is not None else None,
+                        "limit": max(1, min(int(payload.get("limit", 100)), self.MAX_LIST_ROOMS)),
+                    }
+                else:
+                    user_name = payload["user_name"]
+                    user_address = payload["user_address"]
+                    # 入室と同時に履歴を取得する件数(省略時は取得しない)
+                    history_count = int(payload.get("history", 0))
+                    # 信頼モード(連番・再送つきの配送)で参加するか
+                    reliable_mode = bool(payload.get("reliable", False))
+                    # 大きなメッセージを圧縮データグラムで受け取るか
+                    compress = bool(payload.get("compress", False))
+                    # 大きなメッセージを断片のまま受け取るか
+                    fragment = bool(payload.get("fragment", False))
+
+        except Exception as e:
+            logger.warning("Server Error1: %s", e)
+            return self.build_state_res(
+                room_name, operation, self.ERROR_RESPONSE, binary=binary
+            )
+
+        if operation == self.LIST_ROOMS:
+            return self.build_rooms_res(**search)
+
+        if operation in (self.FETCH_HISTORY, self.LEAVE_ROOM):
+            room = self.rooms.get(room_name)
+            member = room.get_member(token.encode("utf-8")) if room is not None else None
+            if member is None:
+                return self.build_state_res(room_name, operation, self.SERVER_INIT)
+            if operation == self.LEAVE_ROOM:
+                self.leave_room(room, member)
+                return self.build_state_res(room_name, operation, self.REQUEST_COMPLETION)
+            return self.build_history_res(room, history_count, since)
+
+        try:
+            member = self.handle_room(
+                room_name, user_address, user_name, operation, reliable_mode, compress, fragment
+            )
+            response = self.build_state_res(
+                room_name, operation, self.REQUEST_COMPLETION, member, binary, udp_address
+            )
+        except Exception as e:
+            logger.info("Server Error2: %s", e)
+            return self.build_state_res(room_name, operation, self.SERVER_INIT, binary=binary)
+
+        if member and history_count > 0:
+            # 完了レスポンスに続けて履歴を1回の送信でまとめて返す
+            response += self.build_history_res(
+                member.room, history_count, max_bytes=tcrp.MAX_BODY_BYTE_SIZE - len(response)
+            )
+        return response
 
     def __generate_token(self):
         """トークンを生成する
@@ -87,47 +463,151 @@ class Server:
         """
         return secrets.token_hex(32)
 
-    def handle_room(self, room_name, user_address, user_name, operation):
+    def next_session_id(self):
+        """新しいセッションIDを割り当てる
+
+        :return: セッションID
+        """
+        return next(self.session_ids) & packet.MAX_SESSION_ID
+
+    def handle_room(
+        self,
+        room_name,
+        user_address,
+        user_name,
+        operation,
+        reliable_mode=False,
+        compress=False,
+        fragment=False,
+    ):
         """チャットルームを作成またはチャットルームに参加
         
         :param room_name: チャットルーム名
         :param user_address: クライアントアドレス(IPアドレス&ポート番号)
         :param user_name: ユーザー名
         :param operation: アクション番号(1:チャットルーム作成, 2:チャットルームに参加)
-        :return: トークン
+        :param reliable_mode: 信頼モードで参加するか
+        :param compress: 圧縮データグラムを受け取るか
+        :param fragment: 断片を受け取れるか
+        :return: 参加者(Member、満員などで参加できない場合はNone)
         """
 
         token = self.__generate_token()
+        session_id = self.next_session_id()
 
         # チャットルームを新規作成の場合
         if operation == self.CREATE_ROOM:
             # チャットルームの存在確認
-            if room_name in self.rooms:
-                raise KeyError(f"{room_name} already exists")
-            else:
-                room = chat_room.ChatRoom(room_name)
-                self.rooms[room_name] = room
-                print(f"{user_name}が{room_name}を作成しました")
-                room.host_token = token
+            # 同名の部屋があればKeyError
+            room = self.rooms.create(
+                room_name, lambda: self.__new_room(room_name, token)
+            )
+            logger.info("%sが%sを作成しました", user_name, room_name)
         # チャットルームに参加の場合
         elif operation == self.JOIN_ROOM:
-            if room_name not in self.rooms:
-                raise KeyError(f"{room_name} not found")
-            else:
-                room = self.rooms[room_name]
+            room = self.rooms[room_name]
 
-        if room.add_user(token, user_address, user_name):
-            print(f"{user_name}が{room_name}に参加しました")
-            return token
+        member = room.add_user(
+            token, user_address, user_name, session_id, reliable_mode, compress, fragment
+        )
+        if member:
+            self.sessions[session_id] = member
+            self.idle_timer.touch(session_id, self.session_timeout)
+            logger.info("%sが%sに参加しました", user_name, room_name)
+            return member
     
-    def __send_state_res(self, conn, room_name, operation, state, token):
-        """リクエストに応じてヘッダーとペイロードを送信
-        
-        :param conn: ソケットオブジェクト
+    def __new_room(self, room_name, host_token):
+        """チャットルームを生成する
+
+        :param room_name: チャットルーム名
+        :param host_token: ホストのトークン
+        :return: チャットルーム
+        """
+        if self.message_log is not None:
+            message_history = self.message_log.open_room(room_name)
+        else:
+            message_history = history.MessageHistory(
+                self.history_messages, self.history_room_bytes, self.history_budget
+            )
+        room = chat_room.ChatRoom(
+            room_name,
+            message_history,
+            self.__room_rate_limit(),
+            reliable.ResendWindow(self.reliable_window),
+        )
+        room.host_token = host_token
+        return room
+
+    def __room_rate_limit(self):
+        """チャットルームのレート制限を生成する
+
+        :return: TokenBucket(制限しない場合はNone)
+        """
+        if self.room_rate > 0:
+            return backpressure.TokenBucket(self.room_rate, self.room_burst)
+        return None
+
+    def build_history_res(self, room, count, since=None, max_bytes=tcrp.MAX_BODY_BYTE_SIZE):
+        """直近またはオフセット以降の履歴を返すレスポンスを作成
+
+        件数はhistory_messagesまで、ペイロードはmax_bytesまでに抑え、
+        コントロールチャネルの1フレームに収める。
+
+        :param room: チャットルーム
+        :param count: 取得件数
+        :param since: 取得を始めるオフセット(省略時は直近count件)
+        :param max_bytes: ペイロードの最大バイト数(収まらない分は直近なら古い方、
+            オフセット指定なら新しい方を捨てる)
+        :return: レスポンス(ヘッダー + 長さ付きで連結したメッセージ)
+        """
+        count = max(0, min(count, self.history_messages))
+        if since is None:
+            frames = history.fit_frames(room.history.latest(count), max_bytes)
+        else:
+            frames = history.fit_frames(
+                room.history.since(int(since), count), max_bytes, newest=False
+            )
+        res_payload = history.pack_frames(frames)
+        header = tcrp.pack_header(
+            len(room.name), self.FETCH_HISTORY, self.REQUEST_COMPLETION, len(res_payload)
+        )
+        return header + res_payload
+
+    def build_rooms_res(self, prefix="", contains="", after=None, limit=100):
+        """チャットルームの一覧(名前順、ページ単位)を返すレスポンスを作成
+
+        :param prefix: 前方一致させる文字列
+        :param contains: 部分一致させる文字列
+        :param after: この部屋名より後から取得する
+        :param limit: 最大件数
+        :return: レスポンス(ヘッダー + ペイロード)
+        """
+        rooms, has_more = self.rooms.search(prefix, contains, after, limit)
+        res_payload = json.dumps(
+            {
+                "status": 200,
+                "rooms": [
+                    {"room_name": room.name, "users": len(room.members)} for room in rooms
+                ],
+                # 次のページを取得するときにafterに指定する部屋名
+                "next": rooms[-1].name if has_more and rooms else None,
+            }
+        ).encode("utf-8")
+        header = tcrp.pack_header(0, self.LIST_ROOMS, self.REQUEST_COMPLETION, len(res_payload))
+        return header + res_payload
+
+    def build_state_res(
+        self, room_name, operation, state, member=None, binary=False, udp_address=False
+    ):
+        """リクエストに応じてヘッダーとペイロードを作成
+
         :param room_name: チャットルーム名
         :param operation: アクション番号
         :param state: 操作コード(0:サーバー初期化, 1:リクエストの応答, 2:リクエストの完了)
-        :param token: トークン
+        :param member: 参加者(リクエスト完了時)
+        :param binary: バイナリ形式で返すか(リクエストがバイナリ形式の場合)
+        :param udp_address: バイナリ形式の完了レスポンスにUDPアドレスを含めるか
+        :return: レスポンス(ヘッダー + ペイロード)
         """
         if state == self.SERVER_INIT:
             payload_data = (
@@ -143,81 +623,854 @@ class Server:
                 "message": "リクエストを完了できませんでした。\n入力し直してください。",
             }
         else:
-            payload_data = {"status": 202, "message": "リクエストを完了しました。", "token": token}
+            payload_data = {
+                "status": 202,
+                "message": "リクエストを完了しました。",
+                "token": member.token if member else None,
+                "session_id": member.session_id if member else None,
+                "reliable": member.reliable if member else False,
+                "compress": member.compress if member else False,
+                "fragment": member.fragment if member else False,
+                # 信頼モードで最初に受信する連番(参加と同時に決めたもの)
+                "sequence": member.first_sequence if member else 0,
+                # メッセージを送るUDPアドレス(クラスター構成では部屋を担当するノード)
+                "udp_address": list(self.advertise_udp_address) if member else None,
+            }
 
-        res_payload = json.dumps(payload_data).encode("utf-8")
+        if binary:
+            res_payload = handshake.pack_join_response(
+                payload_data["status"],
+                payload_data["message"],
+                payload_data.get("token"),
+                payload_data.get("session_id"),
+                payload_data.get("sequence", 0),
+                self.advertise_udp_address if udp_address and member else None,
+            )
+        else:
+            res_payload = json.dumps(payload_data).encode("utf-8")
 
-        header = struct.pack(
-            "!B B B 29s",
-            len(room_name),
-            operation,
-            state,
-            len(res_payload).to_bytes(29, byteorder="big"),
-        )
+        header = tcrp.pack_header(len(room_name), operation, state, len(res_payload))
 
-        conn.sendall(header + res_payload)
+        return header + res_payload
 
     def __handle_udp_conn(self):
-        """UDP接続を処理する"""
-        HEADER_BYTE_SIZE = 2
+        """UDP接続を処理する
+
+        受信バッファを使い回し、データグラムごとにスレッドを生成せずそのまま処理する。
+        受信キューがある場合は、レート制限を通ったものだけをコピーしてキューに入れる。
+        """
+        buffer = bytearray(self.RECV_BUFFER_SIZE)
+        view = memoryview(buffer)
+        recvfrom_into = self.udp_socket.recvfrom_into
+        inbound_queue = self.inbound_queue
 
         while True:
-            data, _ = self.udp_socket.recvfrom(4096)
+            size, address = recvfrom_into(buffer)
+            data = view[:size]
+            if not self.admit(data, address):
+                continue
+            if inbound_queue is not None:
+                if not inbound_queue.put((bytes(data), address)):
+                    self.metrics.drops.inc(label="queue_full")
+                continue
+            self.process_datagram(data, address)
 
-            room_name_size, token_size = struct.unpack_from("!B B", data[:HEADER_BYTE_SIZE])
-            room_name = data[HEADER_BYTE_SIZE:HEADER_BYTE_SIZE + room_name_size].decode("utf-8")
-            token = data[
-                HEADER_BYTE_SIZE + room_name_size : HEADER_BYTE_SIZE + room_name_size + token_size
-            ].decode("utf-8")
-            message = data[HEADER_BYTE_SIZE + room_name_size + token_size:]
+    def __relay_queued(self):
+        """受信キューからデータグラムを取り出して中継する(スレッドモード)"""
+        while True:
+            data, address = self.inbound_queue.get()
+            self.process_datagram(data, address)
 
-            threading.Thread(
-                target=self.handle_message, args=(message, room_name, token)
-            ).start()
+    def admit(self, data, address):
+        """MACと送信者ごとのレート制限を確認する(デコード・キューへの投入の前に行う)
 
-    def handle_message(self, message, room_name, token):
-        """メッセージを処理する関数
+        偽造されたデータグラムで正規の送信者のレートを消費させないよう、MACを先に確認する。
 
-        :param message: 送信メッセージ(byte)
-        :param room_name: チャットルーム名
-        :param token: トークン
+        :param data: 受信データ(memoryview)
+        :param address: 送信元アドレス
+        :return: 処理してよいか
+        """
+        try:
+            if not self.verify(data, address):
+                self.metrics.drops.inc(label="bad_mac")
+                return False
+            if self.sender_limiter is None:
+                return True
+            key = packet.sender_key(data)
+        except (struct.error, IndexError):
+            # 不正なデータグラムはhandle_datagramで破棄する
+            return True
+        if self.sender_limiter.allow(key):
+            return True
+        self.metrics.drops.inc(label="sender_rate")
+        return False
+
+    def verify(self, data, address):
+        """コンパクト形式のデータグラムのMACと送信元アドレスを確認する
+
+        このサーバーにないセッションは破棄する(ほかのワーカーが担当するセッションは担当ワーカーで確認する)。
+
+        :param data: 受信データ(memoryview)
+        :param address: 送信元アドレス
+        :return: 正しいか
+        """
+        if data[0] != packet.COMPACT_MARKER:
+            # 従来形式はトークンで認証する(MAC必須の場合は受け付けない)
+            return not self.require_mac
+        _, flags, session_id = packet.COMPACT_HEADER.unpack_from(data)
+        member = self.sessions.get(session_id)
+        if member is None:
+            return self.is_remote_session(session_id)
+        if member.address != address:
+            return False
+        if flags & packet.FLAG_MAC:
+            return packet.verify_mac(member.mac_key, data)
+        return not self.require_mac
+
+    def is_remote_session(self, session_id):
+        """ほかのサーバーが担当するセッションか(このサーバーではMACを確認できない)
+
+        :param session_id: セッションID
+        :return: ほかのサーバーが担当するか
         """
-        room = self.rooms[room_name]
-        sender_name = room.token_to_user_name[token]
+        return False
+
+    def process_datagram(self, data, address):
+        """データグラムを処理する(不正なデータグラムは破棄する)
+
+        :param data: 受信データ
+        :param address: 送信元アドレス
+        """
+        try:
+            self.handle_datagram(data, address)
+        except Exception as e:
+            self.metrics.drops.inc(label="malformed")
+            logger.debug("Server Error3: %s", e)
+
+    def parse_datagram(self, data):
+        """UDPデータグラムをコピーせずに解析する
 
+        :param data: 受信データ(bytes/memoryview)
+        :return: (チャットルーム名(byte), トークン(byte), 送信メッセージ(memoryview))
+        """
+        HEADER_BYTE_SIZE = 2
+
+        view = memoryview(data)
+        room_name_size, token_size = packet.LEGACY_HEADER.unpack_from(view)
+        token_offset = HEADER_BYTE_SIZE + room_name_size
+        message_offset = token_offset + token_size
+        return (
+            bytes(view[HEADER_BYTE_SIZE:token_offset]),
+            bytes(view[token_offset:message_offset]),
+            view[message_offset:],
+        )
+
+    def handle_datagram(self, data, address):
+        """受信したデータグラムを処理する
+
+        :param data: 受信データ(bytes/memoryview)
+        :param address: 送信元アドレス
+        """
+        view = memoryview(data)
+        drops = self.metrics.drops
+        self.metrics.datagrams_in.inc()
+        self.metrics.bytes_in.inc(len(view))
+        if view[0] == packet.COMPACT_MARKER:
+            # コンパクト形式: セッションIDだけで送信者と部屋が決まる
+            _, flags, session_id = packet.COMPACT_HEADER.unpack_from(view)
+            sender = self.sessions.get(session_id)
+            if sender is None:
+                drops.inc(label="unknown_session")
+                return
+            if sender.room.closed:
+                # 終了した部屋のセッションは後始末が済むまで残っている
+                drops.inc(label="closed_room")
+                return
+            message = view[packet.COMPACT_HEADER.size:]
+            if flags & packet.FLAG_MAC:
+                # MACはadmit(またはverify)で確認済み
+                message = message[: -packet.MAC_SIZE]
+            if flags & packet.FLAG_COMPRESSED:
+                message = self.inflate(message, flags & packet.FLAG_RELIABLE)
+            if flags & packet.FLAG_NACK:
+                self.retransmit(sender, message)
+                return
+            self.idle_timer.touch(session_id, self.session_timeout)
+            fragment = bool(flags & packet.FLAG_FRAGMENT)
+            if flags & packet.FLAG_RELIABLE:
+                self.relay_reliable(sender, message, fragment)
+                return
+            self.relay(sender.room, sender, message, fragment)
+            return
+
+        room_key, token_key, message = self.parse_datagram(view)
+        room = self.rooms.get(room_key)
+        if room is None:
+            drops.inc(label="unknown_room")
+            return
+        sender = room.get_member(token_key)
+        if sender is None:
+            drops.inc(label="unknown_token")
+            return
+        if sender.address != address:
+            # トークンを盗み見た第三者からの送信は受け付けない
+            drops.inc(label="bad_address")
+            return
+        self.idle_timer.touch(sender.session_id, self.session_timeout)
+        self.relay(room, sender, message)
+
+    def inflate(self, message, reliable):
+        """圧縮された上りメッセージを展開する
+
+        展開後の上限は受信バッファと同じにし、圧縮しない場合より大きなメッセージは受け付けない。
+
+        :param message: 受信したメッセージ(memoryview)
+        :param reliable: 先頭にClientSeqがあるか
+        :return: 展開したメッセージ(信頼モードではClientSeqつき)
+        """
+        offset = packet.CLIENT_SEQUENCE.size if reliable else 0
+        started_at = time.perf_counter()
+        inflated = packet.decompress(message[offset:], self.RECV_BUFFER_SIZE)
+        self.compression_seconds.inc(time.perf_counter() - started_at, label="decompress")
+        return bytes(message[:offset]) + inflated
+
+    def relay(self, room, sender, message, fragment=False):
+        """メッセージを同じ部屋の参加者へ中継する
+
+        :param room: チャットルーム
+        :param sender: 送信者(Member)
+        :param message: 送信メッセージ(bytes/memoryview)
+        :param fragment: 大きなメッセージの断片か
+        :return: 受け付けたか(レート制限や不正な断片で破棄した場合はFalse)
+        """
+        if fragment:
+            return self.relay_fragment(room, sender, message)
         if message == b"exit":
-            if token == room.host_token:
-                message = f"{sender_name}が{room_name}から退出しました\nホストが退出したため、チャットルーム:{room_name}を終了します"
-                self.__send_message(room, token, message)
-                room.remove_all_users()
-                del self.rooms[room_name]
-            else:
-                message = f"{sender_name}が{room_name}から退出しました"
-                self.__send_message(room, token, message)
-                room.remove_user(token)
-            print(message)
+            self.leave_room(room, sender)
+        elif room.rate_limit is not None and not room.rate_limit.allow():
+            self.metrics.drops.inc(label="room_rate")
+            return False
+        else:
+            logger.debug("%s: %sが%dバイトのメッセージを送信しました", room.name, sender.user_name, len(message))
+            # 送信者名のプレフィックスはバイト列のまま連結する(デコード・再エンコードしない)
+            data = sender.name_prefix + message
+            room.history.append(data)
+            self.__send_message(room, sender, data)
+        return True
+
+    def relay_fragment(self, room, sender, message):
+        """大きなメッセージの断片を組み立てずにそのまま中継する
+
+        最初の断片にだけ送信者名のプレフィックスを付け足す。
+        メッセージ全体がサーバーに揃うことはないので、履歴には残さない。
+
+        :param room: チャットルーム
+        :param sender: 送信者(Member)
+        :param message: FRAGMENT_HEADER + 断片のデータ(memoryview)
+        :return: 受け付けたか
+        """
+        header_size = packet.FRAGMENT_HEADER.size
+        _, index, count = packet.FRAGMENT_HEADER.unpack_from(message)
+        if index >= count or count > packet.MAX_FRAGMENTS:
+            self.metrics.drops.inc(label="bad_fragment")
+            return False
+        if room.rate_limit is not None and not room.rate_limit.allow():
+            self.metrics.drops.inc(label="room_rate")
+            return False
+        prefix = sender.name_prefix if index == 0 else b""
+        data = bytes(message[:header_size]) + prefix + message[header_size:]
+        self.__send_message(room, sender, data, kind=packet.KIND_FRAGMENT)
+        return True
+
+    def relay_reliable(self, sender, message, fragment=False):
+        """連番つきの上りメッセージを中継し、送信者に受領通知(ACK)を返す
+
+        ACKは送信者1人にだけ返すので、部屋の人数によらず1メッセージにつき1つで済む。
+        送信者には自分のメッセージを送らないので、ACKで割り当てた部屋の連番を知らせる。
+        再送された重複は中継せず、ACKが失われた場合に備えてACKだけ返し直す。
+
+        :param sender: 送信者(Member)
+        :param message: ClientSeq(4) + 送信メッセージ(memoryview)
+        :param fragment: 大きなメッセージの断片か
+        """
+        (client_sequence,) = packet.CLIENT_SEQUENCE.unpack_from(message)
+        if client_sequence <= sender.last_client_sequence:
+            self.metrics.drops.inc(label="duplicate")
+        elif self.relay(sender.room, sender, message[packet.CLIENT_SEQUENCE.size:], fragment):
+            sender.last_client_sequence = client_sequence
         else:
-            print(f"{room_name}: {sender_name}が'{message.decode('utf-8')}'を送信しました")
-            decode_message = message.decode('utf-8')
-            message = f"{sender_name}: {decode_message}"
-            self.__send_message(room, token, message)
+            # 受け付けなかったメッセージはACKを返さず、クライアントの再送に任せる
+            return
+        self.send_datagram(
+            packet.pack_sequenced(packet.KIND_ACK, client_sequence, sender.last_room_sequence),
+            sender.address,
+        )
+
+    def retransmit(self, member, ranges):
+        """再送要求(NACK)に応じて再送ウィンドウから再送する
+
+        ウィンドウから外れた範囲はKIND_LOSTで通知し、クライアントが待ち続けないようにする。
+
+        :param member: 再送を要求した参加者(Member)
+        :param ranges: (FirstSeq(4) | Count(2))の並び(memoryview)
+        """
+        window = member.room.resend_window
+        budget = self.MAX_RETRANSMIT
+        for offset in range(0, len(ranges) - packet.NACK_RANGE.size + 1, packet.NACK_RANGE.size):
+            first, count = packet.NACK_RANGE.unpack_from(ranges, offset)
+            end = min(first + count, window.next_sequence)
+            sequence = first
+            while sequence < end and budget > 0:
+                datagram = window.get(sequence)
+                if datagram is None:
+                    # 再送できない連番は先頭からまとめて通知する
+                    lost_end = min(max(window.first_sequence, sequence + 1), end)
+                    datagram = packet.pack_sequenced(
+                        packet.KIND_LOST, sequence, lost_end - sequence
+                    )
+                    self.retransmits.inc(label="lost")
+                    sequence = lost_end
+                else:
+                    self.retransmits.inc(label="data")
+                    sequence += 1
+                self.send_datagram(datagram, member.address)
+                budget -= 1
+
+    def leave_room(self, room, member, timed_out=False):
+        """参加者を退出させる(ホストの場合はチャットルームを終了する)
+
+        すでに退出済みの場合は何もしない。
+
+        :param room: チャットルーム
+        :param member: 退出する参加者(Member)
+        :param timed_out: タイムアウトによる退出か(本人にも通知する)
+        """
+        member_name = member.user_name
+        room_name = room.name
+        new_host = None
+        if member.token == room.host_token and self.host_handoff:
+            new_host = room.hand_off(member.token)
+        if new_host is not None:
+            notice = f"{member_name}が{room_name}から退出しました\n{new_host.user_name}が新しいホストになりました"
+            data = notice.encode("utf-8")
+            kind = packet.KIND_LEFT
+            room.history.append(data)
+            self.__send_message(room, member, data, immediate=True, kind=kind)
+            self.__forget_session(member)
+        elif member.token == room.host_token:
+            # 新規参加を止めてから残りの参加者へ通知する
+            if self.rooms.remove(room_name, room) is None:
+                return
+            notice = f"{member_name}が{room_name}から退出しました\nホストが退出したため、チャットルーム:{room_name}を終了します"
+            data = notice.encode("utf-8")
+            kind = packet.KIND_CLOSED
+            if self.coalescer is not None:
+                # 送信待ちを先に送って順序を保つ
+                self.coalescer.flush_room(room)
+            datagram = None
+            if room.reliable_addresses:
+                _, datagram = room.resend_window.append(data, member.session_id, kind)
+                # 退出後は再送要求を受けられないので、終了通知をハートビートの代わりに送り直す
+                self.closed_rooms[room] = (room.reliable_addresses, self.HEARTBEAT_TICKS)
+            # 部屋を切り離すところまでをここで行い、参加者への通知とセッションの破棄は後で行う
+            members = room.remove_all_users()
+            self.__forget_session(member)
+            self.teardown.add(room, members, member, data, datagram)
+            self.schedule_teardown()
+        else:
+            if not room.remove_user(member.token):
+                return
+            notice = f"{member_name}が{room_name}から退出しました"
+            data = notice.encode("utf-8")
+            kind = packet.KIND_LEFT
+            room.history.append(data)
+            self.__send_message(room, member, data, immediate=True, kind=kind)
+            self.__forget_session(member)
+        if timed_out:
+            if member.reliable:
+                # 信頼モードの本人には順序づけない通知(連番0)で送る
+                data = packet.pack_sequenced(kind, 0, member.session_id, data)
+            self.send_datagram(data, member.address)
+        logger.info(notice)
+
+    def schedule_teardown(self):
+        """終了した部屋の後始末を始める(スレッドモードでは専用スレッドが処理する)"""
+
+    def finish_member(self, member, data, datagram):
+        """終了した部屋の参加者に終了通知を送り、セッションを破棄する
+
+        :param member: 参加者(Member)
+        :param data: 終了通知(byte)
+        :param datagram: 信頼モードの参加者へ送る連番つきの終了通知
+        """
+        if member.reliable and datagram is not None:
+            data = datagram
+        try:
+            self.send_datagram(data, member.address)
+        except OSError as e:
+            logger.debug("Server Error5: %s", e)
+        else:
+            self.metrics.datagrams_out.inc()
+            self.metrics.bytes_out.inc(len(data))
+        self.__forget_session(member)
+
+    def finish_room(self, room):
+        """終了した部屋の履歴を削除する(永続化している場合はファイルも削除する)
+
+        :param room: チャットルーム
+        """
+        room.history.clear()
+
+    def __forget_session(self, member):
+        """セッションとアイドルタイマーを破棄する
+
+        :param member: 参加者(Member)
+        """
+        self.sessions.pop(member.session_id, None)
+        self.idle_timer.cancel(member.session_id)
+        if self.sender_limiter is not None:
+            self.sender_limiter.forget(member.session_id)
+            self.sender_limiter.forget(member.token.encode("utf-8"))
+
+    def expire_sessions(self):
+        """タイミングホイールを進め、一定時間発言のないセッションをまとめて退出させる
+
+        信頼モードのハートビートも同じ間隔で送る。
+
+        :return: 退出させた数
+        """
+        self.send_heartbeats()
+        expired = 0
+        for session_id in self.idle_timer.advance():
+            member = self.sessions.get(session_id)
+            if member is not None:
+                self.leave_room(member.room, member, timed_out=True)
+                expired += 1
+        return expired
 
-    def __send_message(self, room, token, message):
+    def send_heartbeats(self):
+        """直近にメッセージを送った部屋の信頼モードの参加者へ最新の連番を通知する
+
+        最後のメッセージが失われてもクライアントが欠落に気づけるよう、
+        メッセージが途絶えてからHEARTBEAT_TICKS回だけ送る。
+        終了した部屋には、同じ回数だけ終了通知を送り直す。
+        """
+        for room, remaining in list(self.heartbeat_rooms.items()):
+            if remaining <= 1 or room.closed:
+                self.heartbeat_rooms.pop(room, None)
+            else:
+                self.heartbeat_rooms[room] = remaining - 1
+            datagram = packet.pack_sequenced(
+                packet.KIND_HEARTBEAT, room.resend_window.latest_sequence, 0
+            )
+            self.fanout.broadcast(datagram, room.reliable_addresses)
+        for room, (addresses, remaining) in list(self.closed_rooms.items()):
+            if remaining <= 1:
+                self.closed_rooms.pop(room, None)
+            else:
+                self.closed_rooms[room] = (addresses, remaining - 1)
+            self.fanout.broadcast(
+                room.resend_window.get(room.resend_window.latest_sequence), addresses
+            )
+
+    def __expire_idle_sessions(self):
+        """一定間隔でアイドルセッションを退出させる(スレッドモード)"""
+        while True:
+            time.sleep(self.idle_timer.tick)
+            try:
+                self.expire_sessions()
+            except Exception as e:
+                logger.error("Server Error4: %s", e)
+
+    def __send_message(self, room, sender, data, immediate=False, kind=packet.KIND_DATA):
         """同じ部屋のほかのユーザーにメッセージを送信
-        
-        :param romm: チャットルーム
-        :param token: トークン
-        :param message: 送信メッセージ
+
+        まとめて送る設定の場合は送信待ちに追加し、期限かサイズの上限でまとめて送る。
+
+        :param room: チャットルーム
+        :param sender: 送信者(Member)
+        :param data: 送信データ(byte)
+        :param immediate: まとめずにすぐ送るか(退出通知など、直後に参加者が変わる場合)
+        :param kind: 信頼モードで送る種類(KIND_DATA/KIND_LEFT/KIND_CLOSED/KIND_FRAGMENT)
         """
-        for token_key, user_address in room.token_to_addrs.items():
-            if token != token_key:
-                self.udp_socket.sendto(message.encode("utf-8"), tuple(user_address))
+        datagram = None
+        if room.reliable_addresses:
+            # 信頼モードの参加者には連番つきで送り、再送用にウィンドウへ残す
+            sender.last_room_sequence, datagram = room.resend_window.append(
+                data, sender.session_id, kind
+            )
+            self.heartbeat_rooms[room] = self.HEARTBEAT_TICKS
+        if kind == packet.KIND_FRAGMENT:
+            # 断片は信頼モードでない参加者にも連番0のデータグラムで送る。
+            # 断片を受け取れると通知しなかった参加者(旧クライアント)には送らない
+            data = packet.pack_sequenced(kind, 0, sender.session_id, data)
+        entries = [(sender, data, datagram)]
+        fragment = kind == packet.KIND_FRAGMENT
+        if self.coalescer is None:
+            self.flush_batch(room, entries, fragment)
+        elif immediate or fragment:
+            # 送信待ちを先に送って順序を保つ
+            self.coalescer.flush_before(room, lambda: self.flush_batch(room, entries, fragment))
+        else:
+            batch_id = self.coalescer.add(room, sender, data, datagram)
+            if batch_id is not None:
+                self.schedule_flush(room, batch_id)
+
+    def schedule_flush(self, room, batch_id):
+        """送信待ちをまとめる時間が過ぎたら送信するよう登録する
+
+        :param room: チャットルーム
+        :param batch_id: Coalescer.addが返した番号
+        """
+        self.coalescer.schedule(room, batch_id)
+
+    def flush_batch(self, room, entries, fragment=False):
+        """メッセージを部屋の参加者へ一斉送信する
+
+        :param room: チャットルーム
+        :param entries: [(送信者, 送信データ, 連番つきデータグラム)]
+        :param fragment: 断片か(信頼モードでない参加者は断片を受け取れる人にだけ送る)
+        """
+        # エンコード済みのデータを変換済みのアドレスへ一斉送信する
+        if fragment:
+            addresses, split_addresses = room.fragment_addresses, room.split_fragment_addresses
+        else:
+            addresses, split_addresses = room.addresses, room.split_addresses
+        reliable_addresses = room.reliable_addresses
+        started_at = time.perf_counter()
+        sent, sent_bytes = self.__broadcast_frames(
+            addresses,
+            split_addresses,
+            [(sender.address, data) for sender, data, _ in entries],
+        )
+        if reliable_addresses:
+            reliable_sent, reliable_bytes = self.__broadcast_frames(
+                reliable_addresses,
+                room.split_reliable_addresses,
+                [
+                    (sender.address, datagram)
+                    for sender, _, datagram in entries
+                    if datagram is not None
+                ],
+            )
+            sent += reliable_sent
+            sent_bytes += reliable_bytes
+        self.metrics.fanout_seconds.observe(
+            time.perf_counter() - started_at,
+            metrics.room_size_class(len(addresses) + len(reliable_addresses)),
+        )
+        self.metrics.datagrams_out.inc(sent)
+        self.metrics.bytes_out.inc(sent_bytes)
+
+    def __broadcast_frames(self, addresses, split_addresses, frames):
+        """送信者以外にメッセージを送信する(複数なら1つのデータグラムにまとめる)
+
+        まとめた場合、送信者には自分のメッセージを除いたものを個別に送る。
+
+        :param addresses: 送信先アドレスのタプル
+        :param split_addresses: (圧縮を受け取るアドレス, それ以外のアドレス)
+        :param frames: [(送信者のアドレス, データ)]
+        :return: (送信数, 送信バイト数)
+        """
+        if not frames or not addresses:
+            return 0, 0
+        if len(frames) == 1:
+            sender_address, data = frames[0]
+            return self.__broadcast(data, addresses, split_addresses, sender_address)
+
+        senders = {sender_address for sender_address, _ in frames}
+        data = packet.pack_batch([frame for _, frame in frames])
+        sent, sent_bytes = self.__broadcast(data, addresses, split_addresses, senders)
+        members = set(addresses)
+        for sender_address in senders & members:
+            own = [frame for address, frame in frames if address != sender_address]
+            if not own:
+                continue
+            data = own[0] if len(own) == 1 else packet.pack_batch(own)
+            self.send_datagram(data, sender_address)
+            sent += 1
+            sent_bytes += len(data)
+        return sent, sent_bytes
+
+    def __broadcast(self, data, addresses, split_addresses, exclude):
+        """データグラムを一斉送信する(大きければ圧縮を受け取る参加者には1回だけ圧縮して送る)
+
+        :param data: 送信データ(byte)
+        :param addresses: 送信先アドレスのタプル
+        :param split_addresses: (圧縮を受け取るアドレス, それ以外のアドレス)
+        :param exclude: 送信しないアドレス(送信者、まとめた場合は送信者の集合)
+        :return: (送信数, 送信バイト数)
+        """
+        compressed = None
+        if split_addresses[0] and 0 < self.compress_threshold <= len(data):
+            compressed = self.compress_datagram(data)
+        if compressed is None:
+            groups = ((data, addresses),)
+        else:
+            groups = ((compressed, split_addresses[0]), (data, split_addresses[1]))
+        sent = sent_bytes = 0
+        for datagram, group in groups:
+            if isinstance(exclude, set):
+                count = self.fanout.broadcast(datagram, tuple(a for a in group if a not in exclude))
+            else:
+                count = self.fanout.broadcast(datagram, group, exclude=exclude)
+            sent += count
+            sent_bytes += count * len(datagram)
+            if datagram is compressed:
+                self.compression_saved.inc(count * (len(data) - len(compressed)))
+        return sent, sent_bytes
+
+    def compress_datagram(self, data):
+        """下りデータグラムを圧縮する
+
+        :param data: 送信データ(byte)
+        :return: 圧縮データグラム(小さくならない場合はNone)
+        """
+        started_at = time.perf_counter()
+        compressed = packet.pack_compressed(data)
+        self.compression_seconds.inc(time.perf_counter() - started_at, label="compress")
+        return compressed if len(compressed) < len(data) else None
+
+    def send_datagram(self, data, address):
+        """UDPでデータを送信する
+
+        :param data: 送信データ(byte)
+        :param address: 送信先アドレス
+        """
+        self.udp_socket.sendto(data, address)
+
+
+def create_server(mode, **kwargs):
+    """起動モードに応じたサーバーを作成する
+
+    :param mode: 起動モード(async: asyncioイベントループ, threaded: スレッド)
+    :return: サーバー
+    """
+    if mode == "async":
+        import async_server
+
+        return async_server.AsyncServer(**kwargs)
+    return Server(**kwargs)
+
+
+def run(mode, workers=1, log_level="info", coordinator=None, node_id=None, **kwargs):
+    """サーバーを起動する(workersが2以上ならSO_REUSEPORTのワーカープロセスで起動)
+
+    coordinatorを指定するとクラスターのノードとして起動する(asyncioモード)。
+
+    :param mode: 起動モード
+    :param workers: ワーカープロセス数
+    :param log_level: ログレベル(offで出力しない)
+    :param coordinator: クラスターのコーディネーターのアドレス
+    :param node_id: クラスター内で一意のノードID(省略時はTCPアドレス)
+    """
+    log_config.setup_logging(log_level)
+    if coordinator is not None:
+        import cluster
+
+        if mode != "async" or workers > 1:
+            raise ValueError("cluster mode runs a single asyncio server per node")
+        tcp_address = kwargs.get("tcp_address", ("127.0.0.1", 9002))
+        node_id = node_id or "{}:{}".format(*kwargs.get("advertise_tcp_address", tcp_address))
+        cluster.ClusterServer(node_id, coordinator, **kwargs).start()
+        return
+    if workers > 1:
+        import workers as worker_pool
+
+        worker_pool.run_workers(workers, log_level=log_level, **kwargs)
+        return
+    create_server(mode, **kwargs).start()
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Online Chat Messenger server")
+    parser.add_argument("--mode", choices=["async", "threaded"], default="async")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--tcp-port", type=int, default=9002)
+    parser.add_argument("--udp-port", type=int, default=9003)
+    parser.add_argument(
+        "--workers", type=int, default=1, help="SO_REUSEPORT worker processes (asyncio mode)"
+    )
+    parser.add_argument("--backlog", type=int, default=128, help="TCP listen backlog")
+    parser.add_argument(
+        "--handshake-workers", type=int, default=32, help="threaded mode handshake workers"
+    )
+    parser.add_argument(
+        "--read-timeout", type=float, default=5.0, help="per-connection TCRP read deadline (sec)"
+    )
+    parser.add_argument(
+        "--fanout-workers",
+        type=int,
+        default=0,
+        help="sender workers for large-room broadcasts (threaded mode)",
+    )
+    parser.add_argument(
+        "--history-messages", type=int, default=100, help="messages kept per room (0 disables)"
+    )
+    parser.add_argument(
+        "--history-room-bytes", type=int, default=64 * 1024, help="history memory per room"
+    )
+    parser.add_argument(
+        "--history-total-bytes",
+        type=int,
+        default=64 * 1024 * 1024,
+        help="history memory across all rooms",
+    )
+    parser.add_argument(
+        "--session-timeout", type=float, default=300, help="idle seconds before a session expires"
+    )
+    parser.add_argument(
+        "--max-channels", type=int, default=1024, help="concurrent control channels"
+    )
+    parser.add_argument(
+        "--channel-idle-timeout",
+        type=float,
+        default=300,
+        help="idle seconds before a control channel is closed",
+    )
+    parser.add_argument(
+        "--log-level", choices=list(log_config.LEVELS), default="info", help="server log level"
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="serve Prometheus metrics on this port (workers use port + worker index)",
+    )
+    parser.add_argument(
+        "--sender-rate", type=float, default=50, help="messages/sec per session (0 disables)"
+    )
+    parser.add_argument("--sender-burst", type=float, default=100, help="burst per session")
+    parser.add_argument(
+        "--room-rate", type=float, default=500, help="messages/sec per room (0 disables)"
+    )
+    parser.add_argument("--room-burst", type=float, default=1000, help="burst per room")
+    parser.add_argument(
+        "--inbound-queue",
+        type=int,
+        default=4096,
+        help="datagrams buffered between receive and fan-out (0 relays inline)",
+    )
+    parser.add_argument(
+        "--queue-policy",
+        choices=[backpressure.DROP_OLDEST, backpressure.DROP_NEWEST],
+        default=backpressure.DROP_OLDEST,
+        help="what to shed when the inbound queue is full",
+    )
+    parser.add_argument(
+        "--message-log-dir", help="persist rooms and messages to an append-only log here"
+    )
+    parser.add_argument(
+        "--message-log-segment-bytes",
+        type=int,
+        default=16 * 1024 * 1024,
+        help="size of one log segment file",
+    )
+    parser.add_argument(
+        "--message-log-fsync-interval",
+        type=float,
+        default=0.05,
+        help="group commit interval (sec)",
+    )
+    parser.add_argument(
+        "--coalesce-window",
+        type=float,
+        default=0,
+        help="seconds to batch messages per room into one datagram (0 sends each at once)",
+    )
+    parser.add_argument(
+        "--coalesce-bytes",
+        type=int,
+        default=1200,
+        help="flush a batch before it grows past this size (keep under the MTU)",
+    )
+    parser.add_argument(
+        "--require-mac",
+        action="store_true",
+        help="reject UDP datagrams without a valid per-session MAC",
+    )
+    parser.add_argument(
+        "--host-handoff",
+        action="store_true",
+        help="keep a room open when its host leaves and promote the longest-connected member",
+    )
+    parser.add_argument(
+        "--compress-threshold",
+        type=int,
+        default=256,
+        help="compress datagrams of at least this size for clients that negotiated it (0 disables)",
+    )
+    parser.add_argument(
+        "--reliable-window",
+        type=int,
+        default=1024,
+        help="messages kept per room for NACK retransmits",
+    )
+    parser.add_argument(
+        "--coordinator",
+        help="HOST:PORT of the cluster coordinator (shards rooms across nodes)",
+    )
+    parser.add_argument("--node-id", help="unique node id in the cluster (default: TCP address)")
+    parser.add_argument(
+        "--advertise-host",
+        help="address other nodes and clients use to reach this node (default: --host)",
+    )
+    parser.add_argument(
+        "--peer-port",
+        type=int,
+        default=0,
+        help="node-to-node port for proxied requests (default: any free port)",
+    )
+    args = parser.parse_args()
+
+    cluster_kwargs = {}
+    if args.coordinator is not None:
+        import cluster
+
+        advertise_host = args.advertise_host or args.host
+        cluster_kwargs = {
+            "coordinator": cluster.parse_address(args.coordinator),
+            "node_id": args.node_id,
+            "advertise_tcp_address": (advertise_host, args.tcp_port),
+            "advertise_udp_address": (advertise_host, args.udp_port),
+            "peer_address": (args.host, args.peer_port),
+        }
+
     try:
-        server = Server()
-        server.start()
+        run(
+            args.mode,
+            workers=args.workers,
+            tcp_address=(args.host, args.tcp_port),
+            udp_address=(args.host, args.udp_port),
+            listen_backlog=args.backlog,
+            handshake_workers=args.handshake_workers,
+            read_timeout=args.read_timeout,
+            fanout_workers=args.fanout_workers,
+            history_messages=args.history_messages,
+            history_room_bytes=args.history_room_bytes,
+            history_total_bytes=args.history_total_bytes,
+            session_timeout=args.session_timeout,
+            max_channels=args.max_channels,
+            channel_idle_timeout=args.channel_idle_timeout,
+            log_level=args.log_level,
+            sender_rate=args.sender_rate,
+            sender_burst=args.sender_burst,
+            room_rate=args.room_rate,
+            room_burst=args.room_burst,
+            inbound_queue=args.inbound_queue,
+            queue_policy=args.queue_policy,
+            message_log_dir=args.message_log_dir,
+            message_log_segment_bytes=args.message_log_segment_bytes,
+            message_log_fsync_interval=args.message_log_fsync_interval,
+            reliable_window=args.reliable_window,
+            require_mac=args.require_mac,
+            coalesce_window=args.coalesce_window,
+            coalesce_bytes=args.coalesce_bytes,
+            compress_threshold=args.compress_threshold,
+            host_handoff=args.host_handoff,
+            metrics_address=(
+                ("127.0.0.1", args.metrics_port) if args.metrics_port is not None else None
+            ),
+            **cluster_kwargs,
+        )
     except KeyboardInterrupt:
-        server.tcp_socket.close()
-        server.udp_socket.close()
         print("\nServer closed")
@@ -0,0 +1,79 @@
+import socket
+import struct
+import time
+
+# TCRP(TCP Chat Room Protocol)ヘッダー
+# RoomNameSize(1) | Operation(1) | State(1) | OperationPayloadSize(29)
+HEADER_BYTE_SIZE = 32
+PAYLOAD_SIZE_BYTE_SIZE = 29
+HEADER_FORMAT = f"!B B B {PAYLOAD_SIZE_BYTE_SIZE}s"
+# 同じレイアウトで、OperationPayloadSizeの上位21バイトを0として下位8バイトだけを扱う
+# (MAX_BODY_BYTE_SIZEを超えるサイズは使わないので、29バイトの整数変換を省ける)
+SIZE_PADDING = bytes(PAYLOAD_SIZE_BYTE_SIZE - 8)
+HEADER = struct.Struct(f"!B B B {len(SIZE_PADDING)}x Q")
+# リクエストボディ(チャットルーム名 + OperationPayload)の上限
+MAX_BODY_BYTE_SIZE = 64 * 1024
+
+
+def pack_header(room_name_size, operation, state, payload_size):
+    """TCRPヘッダーを作成する
+
+    :param room_name_size: チャットルーム名のバイト数
+    :param operation: アクション番号
+    :param state: 状態コード
+    :param payload_size: OperationPayloadのバイト数
+    :return: ヘッダー(32バイト)
+    """
+    return HEADER.pack(room_name_size, operation, state, payload_size)
+
+
+def unpack_header(header):
+    """TCRPヘッダーを解析する
+
+    :param header: ヘッダー(32バイト)
+    :return: (チャットルーム名のバイト数, アクション番号, 状態コード, OperationPayloadのバイト数)
+    """
+    if header[3 : 3 + len(SIZE_PADDING)] != SIZE_PADDING:
+        # 上位バイトに値がある(8バイトに収まらない)サイズはそのまま変換する
+        room_name_size, operation, state, payload_size = struct.unpack_from(
+            HEADER_FORMAT, header
+        )
+        return room_name_size, operation, state, int.from_bytes(payload_size, byteorder="big")
+    return HEADER.unpack_from(header)
+
+
+def recv_exactly(conn, size, deadline=None):
+    """指定バイト数を受信するまで読み込む
+
+    :param conn: ソケットオブジェクト
+    :param size: 受信バイト数
+    :param deadline: 読み込み期限(time.monotonic()基準、Noneなら無期限)
+    :return: 受信データ
+    """
+    data = bytearray()
+    while len(data) < size:
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("read deadline exceeded")
+            conn.settimeout(remaining)
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed by peer")
+        data += chunk
+    return bytes(data)
+
+
+def read_request(conn, deadline=None):
+    """TCRPリクエストをヘッダーとボディに分けて受信する
+
+    :param conn: ソケットオブジェクト
+    :param deadline: 読み込み期限(time.monotonic()基準)
+    :return: (ヘッダー, ボディ)
+    """
+    header = recv_exactly(conn, HEADER_BYTE_SIZE, deadline)
+    room_name_size, _, _, payload_size = unpack_header(header)
+    body_size = room_name_size + payload_size
+    if body_size > MAX_BODY_BYTE_SIZE:
+        raise ValueError(f"request body too large: {body_size} bytes")
+    return header, recv_exactly(conn, body_size, deadline)
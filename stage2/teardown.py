@@ -0,0 +1,78 @@
+import threading
+from collections import deque
+
+
+class Teardown:
+    """終了した部屋の後始末(参加者への終了通知・セッションの破棄・履歴の削除)を中継処理の外で行う
+
+    部屋は呼び出し元で切り離し済みなので、後始末の間に新しい参加や中継は起きない。
+    参加者はbatch_size人ずつ処理し、1回のstepが部屋の人数に比例して長くならないようにする。
+    スレッドモードではrunを専用スレッドで動かし、asyncioモードではstepをイベントループで繰り返し呼ぶ。
+    """
+
+    def __init__(self, finish_member, finish_room, batch_size=256):
+        """
+        :param finish_member: 参加者ごとに呼ぶ関数(参加者, 通知文, 連番つきの通知)
+        :param finish_room: 全員を処理した後に呼ぶ関数(部屋)
+        :param batch_size: 1回のstepで処理する参加者数
+        """
+        self.finish_member = finish_member
+        self.finish_room = finish_room
+        self.batch_size = batch_size
+        # [部屋, 残りの参加者のイテレーター, 除く参加者, 通知文, 連番つきの通知]
+        self.jobs = deque()
+        # 後始末を待っている参加者数
+        self.pending = 0
+        self.ready = threading.Condition()
+
+    def __len__(self):
+        return self.pending
+
+    def add(self, room, members, exclude, data, datagram):
+        """部屋の後始末を登録する
+
+        :param room: 切り離したチャットルーム
+        :param members: 終了時の参加者(トークン(byte) -> Member、以後変更されない辞書)
+        :param exclude: 通知しない参加者(退出したホスト)
+        :param data: 終了通知(byte)
+        :param datagram: 信頼モードの参加者へ送る連番つきの終了通知(いなければNone)
+        """
+        with self.ready:
+            self.jobs.append([room, iter(members.values()), exclude, data, datagram])
+            self.pending += len(members)
+            self.ready.notify()
+
+    def step(self):
+        """先頭の部屋の参加者をbatch_size人まで処理する
+
+        :return: まだ後始末が残っているか
+        """
+        with self.ready:
+            if not self.jobs:
+                return False
+            job = self.jobs[0]
+        room, members, exclude, data, datagram = job
+        finished = True
+        processed = 0
+        for member in members:
+            if member is not exclude:
+                self.finish_member(member, data, datagram)
+            processed += 1
+            if processed == self.batch_size:
+                finished = False
+                break
+        if finished:
+            self.finish_room(room)
+        with self.ready:
+            self.pending -= processed
+            if finished:
+                self.jobs.popleft()
+            return bool(self.jobs)
+
+    def run(self):
+        """登録された後始末を処理し続ける(スレッドモード)"""
+        while True:
+            with self.ready:
+                while not self.jobs:
+                    self.ready.wait()
+            self.step()
@@ -0,0 +1,93 @@
+import asyncio
+import os
+import sys
+import threading
+
+import pytest
+
+# stage2のモジュールはフラットにimportする
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import async_server  # noqa: E402
+
+
+class FakeClock:
+    """テストから進める時計"""
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+class ServerThread:
+    """AsyncServerをループバックの空きポートで起動し、別スレッドのイベントループで動かす"""
+
+    def __init__(self, server_class=async_server.AsyncServer, **kwargs):
+        self.server = server_class(
+            tcp_address=("127.0.0.1", 0), udp_address=("127.0.0.1", 0), **kwargs
+        )
+        self.tcp_address = self.server.tcp_socket.getsockname()
+        self.udp_address = self.server.udp_socket.getsockname()
+        # serveが始まる前の接続もバックログで待たせる
+        self.server.tcp_socket.listen(self.server.listen_backlog)
+        self.server.recover_rooms()
+        self.loop = asyncio.new_event_loop()
+        self.task = None
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+
+    def __run(self):
+        self.task = self.loop.create_task(self.server.serve())
+        try:
+            self.loop.run_until_complete(self.task)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            # 処理中の接続も終わらせてからイベントループを閉じる
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                self.loop.run_until_complete(asyncio.wait(tasks))
+            self.loop.close()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def call(self, function, *args):
+        """サーバーのイベントループ上で関数を呼び、結果を返す"""
+        return asyncio.run_coroutine_threadsafe(self.__call(function, *args), self.loop).result(5)
+
+    async def __call(self, function, *args):
+        return function(*args)
+
+    def stop(self):
+        if not self.thread.is_alive():
+            return
+        self.loop.call_soon_threadsafe(self.task.cancel)
+        self.thread.join(5)
+        self.server.tcp_socket.close()
+        self.server.udp_socket.close()
+        self.server.close_message_log()
+
+
+@pytest.fixture
+def chat_server():
+    """ループバックでサーバーを起動する関数(テストの終わりに停止する)"""
+    servers = []
+
+    def start(**kwargs):
+        server_thread = ServerThread(**kwargs).start()
+        servers.append(server_thread)
+        return server_thread
+
+    yield start
+    for server_thread in servers:
+        server_thread.stop()
@@ -0,0 +1,24 @@
+import time
+
+import benchmark
+
+
+def wait_until(predicate, timeout=5.0):
+    """条件を満たすまで待つ(サーバーはほかのスレッドで処理する)"""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def join(server, operation, room_name, user_name, **kwargs):
+    """UDPソケットを開いてTCRPで部屋に入る
+
+    :return: (UDPソケット, 完了レスポンス)
+    """
+    sock = benchmark.open_udp_socket()
+    sock.settimeout(5)
+    response = benchmark.request_room(
+        server.tcp_address, operation, room_name, user_name, sock.getsockname(), **kwargs
+    )
+    return sock, response
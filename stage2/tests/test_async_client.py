@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+import async_client
+import tcrp
+
+
+async def silent_server(reader, writer):
+    """コントロールチャネルを受け付けた後、リクエストに応答しない"""
+    await reader.readexactly(tcrp.HEADER_BYTE_SIZE)
+    writer.write(tcrp.pack_header(0, async_client.CONTROL_CHANNEL, 1, 0))
+    await reader.read()
+    writer.close()
+
+
+def test_timed_out_request_is_forgotten():
+    async def main():
+        listener = await asyncio.start_server(silent_server, "127.0.0.1", 0)
+        address = listener.sockets[0].getsockname()
+        client = await async_client.connect(address, address, timeout=0.05)
+        for _ in range(3):
+            with pytest.raises(asyncio.TimeoutError):
+                await client.list_rooms()
+        pending = dict(client.responses)
+        await client.close()
+        listener.close()
+        await listener.wait_closed()
+        return pending
+
+    assert asyncio.run(main()) == {}
+
+
+def test_events_end_when_the_host_closes_the_room(chat_server):
+    chat = chat_server()
+
+    async def main():
+        client = await async_client.connect(chat.tcp_address, chat.udp_address)
+        host = await client.create_room("room", "host")
+        bob = await client.join_room("room", "bob")
+        await host.send("hi")
+        await host.leave()
+        events = [event async for event in bob]
+        await client.close()
+        return [(event.type, event.session_id) for event in events], host.session_id
+
+    events, host_session_id = asyncio.run(main())
+    assert events == [
+        (async_client.MESSAGE, host_session_id),
+        (async_client.CLOSED, host_session_id),
+    ]
@@ -0,0 +1,91 @@
+import asyncio
+import threading
+
+import pytest
+
+import async_client
+import benchmark
+import cluster
+from loopback import join, wait_until
+
+
+class CoordinatorThread:
+    """Coordinatorをループバックの空きポートで起動し、別スレッドのイベントループで動かす"""
+
+    def __init__(self):
+        self.coordinator = cluster.Coordinator()
+        self.loop = asyncio.new_event_loop()
+        self.listener = self.loop.run_until_complete(
+            asyncio.start_server(self.coordinator.handle_conn, "127.0.0.1", 0)
+        )
+        self.coordinator.address = self.listener.sockets[0].getsockname()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+        self.listener.close()
+        self.loop.run_until_complete(self.listener.wait_closed())
+        self.loop.close()
+
+
+@pytest.fixture
+def coordinator():
+    coordinator_thread = CoordinatorThread()
+    yield coordinator_thread.coordinator
+    coordinator_thread.stop()
+
+
+def test_ring_moves_few_rooms_when_a_node_joins():
+    names = [f"room{i}".encode() for i in range(1000)]
+    before = cluster.HashRing(["n1", "n2"])
+    after = cluster.HashRing(["n1", "n2", "n3"])
+    moved = [name for name in names if before.owner(name) != after.owner(name)]
+    assert all(after.owner(name) == "n3" for name in moved)
+    assert len(moved) < len(names) / 2
+
+
+def test_requests_are_proxied_to_the_owning_node(chat_server, coordinator):
+    nodes = [
+        chat_server(
+            server_class=cluster.ClusterServer,
+            node_id=node_id,
+            coordinator_address=coordinator.address,
+            refresh_interval=0.05,
+        )
+        for node_id in ("n1", "n2")
+    ]
+    # 一覧の取得は各ノードが持つノード一覧を使うので、互いを知るまで待つ
+    wait_until(lambda: all(len(node.server.nodes) == 2 for node in nodes))
+    ring = cluster.HashRing(["n1", "n2"])
+    room_name = next(
+        name for name in (f"room{i}" for i in range(100)) if ring.owner(name.encode()) == "n2"
+    )
+
+    # n1に作成を頼んでも、部屋はn2に作られ、完了レスポンスはn2のUDPアドレスを返す
+    host_sock, host = join(nodes[0], 1, room_name, "host")
+    bob_sock, bob = join(nodes[1], 2, room_name, "bob")
+    assert tuple(host["udp_address"]) == nodes[1].udp_address
+    assert nodes[0].server.proxied.value() == 1
+    assert room_name in nodes[1].server.rooms
+    assert room_name not in nodes[0].server.rooms
+    assert coordinator.rooms == {room_name: "n2"}
+
+    datagram = benchmark.build_datagram(room_name, bob, "hello", compact=True)
+    bob_sock.sendto(datagram, nodes[1].udp_address)
+    assert host_sock.recv(4096) == "bob: hello".encode()
+
+    async def list_rooms():
+        client = await async_client.connect(nodes[0].tcp_address, nodes[0].udp_address)
+        listed = await client.list_rooms()
+        await client.close()
+        return listed
+
+    listed = asyncio.run(list_rooms())
+    assert listed["rooms"] == [{"room_name": room_name, "users": 2}]
+    for sock in (host_sock, bob_sock):
+        sock.close()
+    for node in nodes:
+        node.stop()
+        node.server.peer_socket.close()
@@ -0,0 +1,56 @@
+import asyncio
+
+import pytest
+
+import async_client
+import server
+
+
+class ResetConnection:
+    """送信すると接続がリセットされるソケット"""
+
+    def __init__(self, fail=True):
+        self.fail = fail
+        self.sent = []
+
+    def sendall(self, data):
+        if self.fail:
+            raise ConnectionResetError("reset by peer")
+        self.sent.append(data)
+
+
+def test_failed_accept_returns_the_channel_slot():
+    chat = server.Server(
+        tcp_address=("127.0.0.1", 0), udp_address=("127.0.0.1", 0), max_channels=1
+    )
+    try:
+        for _ in range(3):
+            with pytest.raises(ConnectionResetError):
+                chat.open_channel(ResetConnection())
+        assert chat.open_channel(ResetConnection(fail=False))
+        # 上限に達したら受け付けない
+        assert not chat.open_channel(ResetConnection(fail=False))
+    finally:
+        chat.tcp_socket.close()
+        chat.udp_socket.close()
+
+
+def test_pipelined_requests_share_one_channel(chat_server):
+    chat = chat_server(max_channels=1)
+
+    async def main():
+        client = await async_client.connect(chat.tcp_address, chat.udp_address)
+        # レスポンスを待たずに続けて送る
+        sessions = await asyncio.gather(
+            *(client.create_room(f"room{i}", "host") for i in range(5))
+        )
+        listing = await client.list_rooms(prefix="room")
+        # 1本目が使っている間は2本目のチャネルを開けない
+        with pytest.raises(ConnectionError):
+            await async_client.connect(chat.tcp_address, chat.udp_address)
+        for session in sessions:
+            await session.leave()
+        await client.close()
+        return [room["room_name"] for room in listing["rooms"]]
+
+    assert asyncio.run(main()) == [f"room{i}" for i in range(5)]
@@ -0,0 +1,107 @@
+import asyncio
+import random
+
+import async_client
+import fragment
+import packet
+
+
+def pieces(message, message_id=1, size=4):
+    return packet.pack_fragments(message, message_id, size=size)
+
+
+def test_reassembles_out_of_order(clock):
+    reassembler = fragment.Reassembler(clock=clock)
+    first, second, third = pieces(b"hello world")
+    assert reassembler.add(1, third) is None
+    assert reassembler.add(1, first) is None
+    assert reassembler.add(1, second) == b"hello world"
+    assert len(reassembler.partial) == 0
+    assert reassembler.size == 0
+
+
+def test_single_fragment(clock):
+    reassembler = fragment.Reassembler(clock=clock)
+    assert reassembler.add(1, pieces(b"hi")[0]) == b"hi"
+
+
+def test_duplicate_fragment_is_ignored(clock):
+    reassembler = fragment.Reassembler(clock=clock)
+    first, second = pieces(b"abcdefgh")
+    reassembler.add(1, first)
+    assert reassembler.add(1, first) is None
+    assert reassembler.size == 4
+    assert reassembler.add(1, second) == b"abcdefgh"
+
+
+def test_senders_are_separate(clock):
+    reassembler = fragment.Reassembler(clock=clock)
+    a1, a2 = pieces(b"aaaaaaaa")
+    b1, b2 = pieces(b"bbbbbbbb")
+    reassembler.add(1, a1)
+    reassembler.add(2, b1)
+    assert reassembler.add(2, b2) == b"bbbbbbbb"
+    assert reassembler.add(1, a2) == b"aaaaaaaa"
+
+
+def test_expires_incomplete_message(clock):
+    reassembler = fragment.Reassembler(timeout=10.0, clock=clock)
+    first, second = pieces(b"abcdefgh")
+    reassembler.add(1, first)
+    clock.now = 10.0
+    assert reassembler.add(1, second) is None
+    assert reassembler.dropped == 1
+    # 捨てた後に届いた断片は新しい組み立てとして扱う
+    assert len(reassembler.partial) == 1
+
+
+def test_drops_oldest_over_message_limit(clock):
+    reassembler = fragment.Reassembler(max_messages=2, clock=clock)
+    for message_id in (1, 2, 3):
+        reassembler.add(1, pieces(b"abcdefgh", message_id)[0])
+    assert reassembler.dropped == 1
+    assert list(reassembler.partial) == [(1, 2), (1, 3)]
+
+
+def test_drops_oldest_over_byte_limit(clock):
+    reassembler = fragment.Reassembler(max_bytes=6, clock=clock)
+    reassembler.add(1, pieces(b"abcdefgh", 1)[0])
+    reassembler.add(1, pieces(b"abcdefgh", 2)[0])
+    assert reassembler.dropped == 1
+    assert reassembler.size == 4
+
+
+def test_rejects_bad_index(clock):
+    reassembler = fragment.Reassembler(clock=clock)
+    bad = packet.FRAGMENT_HEADER.pack(1, 2, 2) + b"x"
+    assert reassembler.add(1, bad) is None
+    assert len(reassembler.partial) == 0
+
+
+async def relay_through(server, text):
+    """host・bobで部屋に入り、bobの発言をhostが受け取ったテキストを返す"""
+    client = await async_client.connect(server.tcp_address, server.udp_address)
+    try:
+        host = await client.create_room("big", "host")
+        bob = await client.join_room("big", "bob")
+        await bob.send(text)
+        event = await asyncio.wait_for(host.events.get(), 5)
+        await host.leave()
+        return event.text
+    finally:
+        await client.close()
+
+
+def test_large_compressible_message_round_trip(chat_server):
+    server = chat_server()
+    # 圧縮すると1データグラムに収まるが、展開後は受信バッファを超える
+    text = "ab" * 2500
+    assert asyncio.run(relay_through(server, text)) == "bob: " + text
+    assert server.server.metrics.drops.value("malformed") == 0
+
+
+def test_large_random_message_round_trip(chat_server):
+    server = chat_server()
+    rng = random.Random(1)
+    text = "".join(chr(rng.randrange(0x3040, 0x30FF)) for _ in range(6000))
+    assert asyncio.run(relay_through(server, text)) == "bob: " + text
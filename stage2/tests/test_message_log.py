@@ -0,0 +1,61 @@
+import asyncio
+import os
+
+import async_client
+import message_log
+
+
+def test_sync_survives_concurrent_close(tmp_path, monkeypatch):
+    log = message_log.MessageLog(str(tmp_path), fsync_interval=3600)
+    room_log = log.open_room("room")
+    room_log.append(b"hello")
+    fsync = os.fsync
+
+    def close_then_fsync(fd):
+        # fdを集めてからfsyncするまでの間に閉じられた場合
+        monkeypatch.setattr(os, "fsync", fsync)
+        room_log.close()
+        fsync(fd)
+
+    monkeypatch.setattr(os, "fsync", close_then_fsync)
+    room_log.sync()
+    log.close()
+
+
+def test_sync_after_roll_keeps_appending(tmp_path):
+    log = message_log.MessageLog(str(tmp_path), segment_bytes=64, fsync_interval=3600)
+    room_log = log.open_room("room")
+    for i in range(20):
+        room_log.append(f"message {i}".encode())
+        room_log.sync()
+    assert [bytes(frame) for frame in room_log.latest(2)] == [b"message 18", b"message 19"]
+    log.close()
+
+
+def test_history_survives_restart(chat_server, tmp_path):
+    log_dir = str(tmp_path)
+    first = chat_server(message_log_dir=log_dir)
+
+    async def chat():
+        client = await async_client.connect(first.tcp_address, first.udp_address)
+        host = await client.create_room("kept", "host")
+        bob = await client.join_room("kept", "bob")
+        await bob.send("one")
+        await bob.send("two")
+        # 退出せずにサーバーを止める(部屋とログは残る)
+        host.close()
+        bob.close()
+        await client.close()
+
+    asyncio.run(chat())
+    first.stop()
+    second = chat_server(message_log_dir=log_dir)
+
+    async def rejoin():
+        client = await async_client.connect(second.tcp_address, second.udp_address)
+        carol = await client.join_room("kept", "carol", history_count=10)
+        await carol.leave()
+        await client.close()
+        return carol.history
+
+    assert asyncio.run(rejoin()) == ["bob: one", "bob: two"]
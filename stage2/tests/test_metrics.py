@@ -0,0 +1,55 @@
+import urllib.error
+import urllib.request
+
+import pytest
+
+import benchmark
+from loopback import join, wait_until
+
+
+def scrape(server, path="/metrics"):
+    """メトリクスのHTTPエンドポイントを取得する
+
+    :return: 系列名(ラベルつき) -> 値
+    """
+    host, port = server.server.metrics_server.httpd.server_address
+    with urllib.request.urlopen(f"http://{host}:{port}{path}", timeout=5) as response:
+        text = response.read().decode("utf-8")
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+
+@pytest.fixture
+def metrics_server(chat_server):
+    server = chat_server(metrics_address=("127.0.0.1", 0))
+    server.server.start_metrics()
+    yield server
+    server.server.stop_metrics()
+
+
+def test_relay_is_counted_on_the_endpoint(metrics_server):
+    host_sock, host = join(metrics_server, 1, "room", "host")
+    bob_sock, bob = join(metrics_server, 2, "room", "bob")
+    datagram = benchmark.build_datagram("room", bob, "hello", compact=True)
+    bob_sock.sendto(datagram, metrics_server.udp_address)
+    assert host_sock.recv(4096) == "bob: hello".encode()
+    wait_until(lambda: scrape(metrics_server)["chat_datagrams_sent_total"] == 1)
+    samples = scrape(metrics_server)
+    assert samples["chat_datagrams_received_total"] == 1
+    assert samples["chat_received_bytes_total"] == len(datagram)
+    assert samples["chat_sent_bytes_total"] == len("bob: hello".encode())
+    assert samples["chat_active_rooms"] == 1
+    assert samples["chat_active_users"] == 2
+    assert samples['chat_fanout_seconds_count{room_size="1-10"}'] == 1
+    for sock in (host_sock, bob_sock):
+        sock.close()
+
+
+def test_unknown_path_is_not_found(metrics_server):
+    with pytest.raises(urllib.error.HTTPError) as excinfo:
+        scrape(metrics_server, "/")
+    assert excinfo.value.code == 404
@@ -0,0 +1,123 @@
+import asyncio
+import json
+
+import pytest
+
+import async_client
+import packet
+import reliable
+import server
+import tcrp
+
+
+def data(sequence, body=b"m", sender=7):
+    return packet.pack_sequenced(packet.KIND_DATA, sequence, sender, body)
+
+
+@pytest.fixture
+def receiver(clock):
+    receiver = reliable.ReliableReceiver(nack_interval=0.2, clock=clock)
+    receiver.start(1)
+    return receiver
+
+
+def test_delivers_in_order(receiver):
+    assert receiver.receive(data(1, b"a")) == [(packet.KIND_DATA, 7, b"a")]
+    assert receiver.receive(data(2, b"b")) == [(packet.KIND_DATA, 7, b"b")]
+    assert receiver.missing_ranges() == []
+
+
+def test_holds_until_gap_is_filled(receiver):
+    assert receiver.receive(data(2, b"b")) == []
+    assert receiver.receive(data(3, b"c")) == []
+    assert receiver.missing_ranges() == [(1, 1)]
+    delivered = receiver.receive(data(1, b"a"))
+    assert [item[2] for item in delivered] == [b"a", b"b", b"c"]
+
+
+def test_drops_duplicates(receiver):
+    receiver.receive(data(1))
+    assert receiver.receive(data(1)) == []
+    receiver.receive(data(3))
+    assert receiver.receive(data(3)) == []
+
+
+def test_nack_interval(receiver, clock):
+    receiver.receive(data(4))
+    assert receiver.missing_ranges() == [(1, 3)]
+    clock.now = 0.1
+    assert receiver.missing_ranges() == []
+    clock.now = 0.2
+    assert receiver.missing_ranges() == [(1, 3)]
+
+
+def test_heartbeat_reveals_tail_loss(receiver):
+    receiver.receive(data(1))
+    receiver.receive(packet.pack_sequenced(packet.KIND_HEARTBEAT, 3, 0))
+    assert receiver.missing_ranges() == [(2, 2)]
+
+
+def test_lost_range_is_skipped(receiver):
+    receiver.receive(data(4, b"d"))
+    delivered = receiver.receive(packet.pack_sequenced(packet.KIND_LOST, 1, 3))
+    assert delivered == [(packet.KIND_DATA, 7, b"d")]
+    assert receiver.missing_ranges() == []
+
+
+def test_skip_own_message(receiver):
+    assert receiver.skip(1) == []
+    assert receiver.receive(data(2, b"b")) == [(packet.KIND_DATA, 7, b"b")]
+    assert receiver.missing_ranges() == []
+
+
+def test_unsequenced_passes_through(receiver):
+    datagram = packet.pack_sequenced(packet.KIND_CLOSED, 0, 0, b"bye")
+    assert receiver.receive(datagram) == [(packet.KIND_CLOSED, 0, b"bye")]
+
+
+def test_join_sequence_is_fixed_when_the_member_is_added():
+    chat = server.Server(tcp_address=("127.0.0.1", 0), udp_address=("127.0.0.1", 0))
+    try:
+        host = chat.handle_room("room", ("127.0.0.1", 5000), "host", chat.CREATE_ROOM, True)
+        chat.relay(host.room, host, b"before")
+        bob = chat.handle_room("room", ("127.0.0.1", 5001), "bob", chat.JOIN_ROOM, True)
+        # 参加してからレスポンスを作るまでに中継されたメッセージ
+        chat.relay(host.room, host, b"after")
+        response = chat.build_state_res("room", chat.JOIN_ROOM, chat.REQUEST_COMPLETION, bob)
+        payload = json.loads(response[tcrp.HEADER_BYTE_SIZE :])
+        assert payload["sequence"] == 2
+    finally:
+        chat.tcp_socket.close()
+        chat.udp_socket.close()
+
+
+def test_lost_datagram_is_retransmitted_on_nack(chat_server):
+    chat = chat_server()
+
+    async def main():
+        client = await async_client.connect(
+            chat.tcp_address, chat.udp_address, nack_interval=0.05
+        )
+        host = await client.create_room("room", "host")
+        bob = await client.join_room("room", "bob")
+        receive = host.datagram_received
+        dropped = []
+
+        def lose_first_message(data):
+            if not dropped and data[1] == packet.KIND_DATA:
+                dropped.append(data)
+                return
+            receive(data)
+
+        host.datagram_received = lose_first_message
+        await bob.send("one")
+        await bob.send("two")
+        texts = [(await asyncio.wait_for(host.events.get(), 5)).text for _ in range(2)]
+        await host.leave()
+        await client.close()
+        return dropped, texts
+
+    dropped, texts = asyncio.run(main())
+    assert len(dropped) == 1
+    assert texts == ["bob: one", "bob: two"]
+    assert chat.server.retransmits.value("data") == 1
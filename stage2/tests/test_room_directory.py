@@ -0,0 +1,72 @@
+import asyncio
+
+import async_client
+import room_directory
+from loopback import join
+
+
+def make_directory(*names):
+    directory = room_directory.RoomDirectory()
+    for name in names:
+        directory.add(name)
+    return directory
+
+
+def test_sorted_and_removed():
+    directory = make_directory(b"c", b"a", b"b")
+    assert directory.search() == ([b"a", b"b", b"c"], False)
+    directory.remove(b"b")
+    directory.remove(b"missing")
+    assert directory.search() == ([b"a", b"c"], False)
+    assert len(directory) == 2
+
+
+def test_prefix_and_contains():
+    directory = make_directory(b"dev-ops", b"dev-web", b"devil", b"general", b"web")
+    assert directory.search(prefix=b"dev-")[0] == [b"dev-ops", b"dev-web"]
+    assert directory.search(contains=b"web")[0] == [b"dev-web", b"web"]
+    assert directory.search(prefix=b"dev", contains=b"web")[0] == [b"dev-web"]
+
+
+def test_pages_with_after():
+    directory = make_directory(*(f"room{i}".encode() for i in range(5)))
+    page, more = directory.search(limit=2)
+    assert (page, more) == ([b"room0", b"room1"], True)
+    page, more = directory.search(after=page[-1], limit=2)
+    assert (page, more) == ([b"room2", b"room3"], True)
+    page, more = directory.search(after=page[-1], limit=2)
+    assert (page, more) == ([b"room4"], False)
+
+
+def test_after_removed_name():
+    directory = make_directory(b"a", b"b", b"c")
+    directory.remove(b"b")
+    assert directory.search(after=b"b")[0] == [b"c"]
+
+
+def test_utf8_order():
+    directory = make_directory("部屋".encode(), b"zebra", "éclair".encode())
+    assert directory.search()[0] == [b"zebra", "éclair".encode(), "部屋".encode()]
+
+
+def test_list_rooms_over_control_channel(chat_server):
+    chat = chat_server()
+    sockets = [join(chat, 1, name, "host")[0] for name in ("a1", "b1", "a3", "a2")]
+    sockets.append(join(chat, 2, "a1", "bob")[0])
+
+    async def main():
+        client = await async_client.connect(chat.tcp_address, chat.udp_address)
+        first = await client.list_rooms(prefix="a", limit=2)
+        second = await client.list_rooms(prefix="a", after=first["next"], limit=2)
+        await client.close()
+        return first, second
+
+    first, second = asyncio.run(main())
+    for sock in sockets:
+        sock.close()
+    assert first["rooms"] == [
+        {"room_name": "a1", "users": 2},
+        {"room_name": "a2", "users": 1},
+    ]
+    assert [room["room_name"] for room in second["rooms"]] == ["a3"]
+    assert second["next"] is None
@@ -0,0 +1,200 @@
+import asyncio
+import json
+import os
+import socket
+
+import async_client
+import benchmark
+import history
+import packet
+import tcrp
+from loopback import join, wait_until
+
+
+async def open_room(server, room_name="room"):
+    """ホストとして部屋を作成する
+
+    :return: (ChatClient, Session)
+    """
+    client = await async_client.connect(server.tcp_address, server.udp_address)
+    return client, await client.create_room(room_name, "host")
+
+
+def test_forged_and_unsigned_datagrams_are_dropped_before_rate_limit(chat_server):
+    server = chat_server(require_mac=True, sender_rate=10, inbound_queue=4)
+    chat = server.server
+
+    async def main():
+        client, host = await open_room(server)
+        forger = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # 存在しないセッションIDとでたらめなMAC
+        for _ in range(10):
+            session_id = int.from_bytes(os.urandom(4), "big")
+            forged = packet.pack_compact(session_id, b"spam", packet.FLAG_MAC)
+            forger.sendto(forged + os.urandom(packet.MAC_SIZE), server.udp_address)
+        # トークンを知っていても、MACのない従来形式は受け付けない
+        forger.sendto(packet.pack_legacy(b"room", host.token.encode(), b"hi"), server.udp_address)
+        # 正規の送信元からでも、MACのないデータグラムは受け付けない
+        host.transport.sendto(packet.pack_compact(host.session_id, b"hi"), server.udp_address)
+        forger.close()
+        await asyncio.to_thread(wait_until, lambda: chat.metrics.drops.value("bad_mac") == 12)
+        await host.leave()
+        await client.close()
+
+    asyncio.run(main())
+    assert len(chat.sender_limiter) == 0
+    assert len(chat.inbound_queue) == 0
+    assert chat.metrics.drops.value("queue_full") == 0
+
+
+def test_legacy_datagram_is_relayed(chat_server):
+    server = chat_server()
+    host_sock, host = join(server, 1, "room", "host")
+    bob_sock, bob = join(server, 2, "room", "bob")
+    bob_sock.sendto(benchmark.build_datagram("room", bob, "hello"), server.udp_address)
+    assert host_sock.recv(4096) == "bob: hello".encode()
+    host_sock.close()
+    bob_sock.close()
+
+
+def test_truncated_datagram_is_dropped(chat_server):
+    server = chat_server()
+    sock = benchmark.open_udp_socket()
+    sock.sendto(b"\x07", server.udp_address)
+    sock.close()
+    wait_until(lambda: server.server.metrics.drops.value("malformed") == 1)
+
+
+def test_compact_datagram_is_relayed_from_the_bound_address(chat_server):
+    server = chat_server()
+    host_sock, host = join(server, 1, "room", "host")
+    bob_sock, bob = join(server, 2, "room", "bob")
+    datagram = benchmark.build_datagram("room", bob, "hello", compact=True)
+    # セッションIDは入室時のアドレスに結びつくので、ほかのアドレスからは中継しない
+    other = benchmark.open_udp_socket()
+    other.sendto(datagram, server.udp_address)
+    wait_until(lambda: server.server.metrics.drops.value("bad_mac") == 1)
+    bob_sock.sendto(datagram, server.udp_address)
+    assert host_sock.recv(4096) == "bob: hello".encode()
+    for sock in (host_sock, bob_sock, other):
+        sock.close()
+
+
+def fetch_history(server, room_name, token, count):
+    """FETCH_HISTORYで履歴を取得する"""
+    encoded_room_name = room_name.encode()
+    payload = json.dumps({"token": token, "count": count}).encode()
+    header = tcrp.pack_header(len(encoded_room_name), 4, 0, len(payload))
+    with socket.create_connection(server.tcp_address) as conn:
+        conn.sendall(header + encoded_room_name + payload)
+        _, _, state, payload_size = tcrp.unpack_header(
+            tcrp.recv_exactly(conn, tcrp.HEADER_BYTE_SIZE)
+        )
+        frames = history.unpack_frames(tcrp.recv_exactly(conn, payload_size))
+    return [bytes(frame).decode() for frame in frames]
+
+
+def test_history_keeps_the_latest_messages(chat_server):
+    server = chat_server(history_messages=3)
+    host_sock, host = join(server, 1, "room", "host")
+    bob_sock, bob = join(server, 2, "room", "bob")
+    for i in range(5):
+        bob_sock.sendto(benchmark.build_datagram("room", bob, f"m{i}"), server.udp_address)
+        host_sock.recv(4096)
+    assert fetch_history(server, "room", host["token"], 10) == ["bob: m2", "bob: m3", "bob: m4"]
+    assert fetch_history(server, "room", host["token"], 1) == ["bob: m4"]
+    host_sock.close()
+    bob_sock.close()
+
+
+def test_quick_messages_are_coalesced_into_one_batch(chat_server):
+    server = chat_server(coalesce_window=0.2)
+    host_sock, host = join(server, 1, "room", "host")
+    bob_sock, bob = join(server, 2, "room", "bob")
+    for text in ("one", "two", "three"):
+        datagram = benchmark.build_datagram("room", bob, text, compact=True)
+        bob_sock.sendto(datagram, server.udp_address)
+    data = host_sock.recv(4096)
+    assert (data[0], data[1]) == (packet.COMPACT_MARKER, packet.KIND_BATCH)
+    assert [bytes(frame) for frame in packet.split_datagrams(data)] == [
+        b"bob: one",
+        b"bob: two",
+        b"bob: three",
+    ]
+    for sock in (host_sock, bob_sock):
+        sock.close()
+
+
+def test_large_message_is_compressed_for_negotiated_receivers(chat_server):
+    server = chat_server(compress_threshold=256)
+    host_sock, host = join(server, 1, "room", "host", compress=True)
+    bob_sock, bob = join(server, 2, "room", "bob")
+    carol_sock, carol = join(server, 2, "room", "carol", binary=True, compress=True)
+    message = "ありがとうございます。" * 40
+    datagram = benchmark.build_datagram("room", bob, message, compact=True)
+    bob_sock.sendto(datagram, server.udp_address)
+    expected = f"bob: {message}".encode()
+    for sock in (host_sock, carol_sock):
+        data = sock.recv(4096)
+        assert (data[0], data[1]) == (packet.COMPACT_MARKER, packet.KIND_COMPRESSED)
+        assert len(data) < len(expected)
+        assert packet.unpack_compressed(data) == expected
+    wait_until(lambda: server.server.compression_saved.value() > 0)
+    for sock in (host_sock, bob_sock, carol_sock):
+        sock.close()
+
+
+def test_small_message_is_not_compressed(chat_server):
+    server = chat_server(compress_threshold=256)
+    host_sock, host = join(server, 1, "room", "host", compress=True)
+    bob_sock, bob = join(server, 2, "room", "bob")
+    bob_sock.sendto(benchmark.build_datagram("room", bob, "hi", compact=True), server.udp_address)
+    assert host_sock.recv(4096) == b"bob: hi"
+    for sock in (host_sock, bob_sock):
+        sock.close()
+
+
+def test_host_handoff_keeps_the_room_open(chat_server):
+    server = chat_server(host_handoff=True)
+
+    async def main():
+        client, host = await open_room(server)
+        bob = await client.join_room("room", "bob")
+        carol = await client.join_room("room", "carol")
+        await host.leave()
+        handed_off = await asyncio.wait_for(bob.__anext__(), 5)
+        bob_is_host = server.server.rooms.get("room").host_token == bob.token
+        await carol.send("hi")
+        relayed = await asyncio.wait_for(bob.__anext__(), 5)
+        await bob.leave()
+        carol_events = [await asyncio.wait_for(carol.__anext__(), 5) for _ in range(2)]
+        # 最後の参加者が退出すると部屋を終了する
+        await carol.leave()
+        await client.close()
+        return handed_off, bob_is_host, relayed, carol_events
+
+    handed_off, bob_is_host, relayed, carol_events = asyncio.run(main())
+    assert handed_off.type == async_client.LEFT
+    assert handed_off.text.endswith("bobが新しいホストになりました")
+    assert bob_is_host
+    assert (relayed.type, relayed.text) == (async_client.MESSAGE, "carol: hi")
+    assert [event.type for event in carol_events] == [async_client.LEFT, async_client.LEFT]
+    assert carol_events[1].text.endswith("carolが新しいホストになりました")
+    assert "room" not in server.server.rooms
+
+
+def test_sender_over_its_rate_is_dropped_without_limiting_others(chat_server):
+    server = chat_server(sender_rate=0.001, sender_burst=3)
+    host_sock, host = join(server, 1, "room", "host")
+    bob_sock, bob = join(server, 2, "room", "bob")
+    carol_sock, carol = join(server, 2, "room", "carol")
+    for i in range(5):
+        datagram = benchmark.build_datagram("room", bob, str(i), compact=True)
+        bob_sock.sendto(datagram, server.udp_address)
+    wait_until(lambda: server.server.metrics.drops.value("sender_rate") == 2)
+    datagram = benchmark.build_datagram("room", carol, "hi", compact=True)
+    carol_sock.sendto(datagram, server.udp_address)
+    received = [host_sock.recv(4096) for _ in range(4)]
+    assert received == [b"bob: 0", b"bob: 1", b"bob: 2", b"carol: hi"]
+    for sock in (host_sock, bob_sock, carol_sock):
+        sock.close()
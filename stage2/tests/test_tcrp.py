@@ -0,0 +1,101 @@
+import json
+import socket
+import struct
+import threading
+import time
+
+import benchmark
+import handshake
+import server
+import tcrp
+from loopback import join
+
+
+def test_header_round_trip():
+    header = tcrp.pack_header(4, 2, 1, 1234)
+    assert len(header) == tcrp.HEADER_BYTE_SIZE
+    assert tcrp.unpack_header(header) == (4, 2, 1, 1234)
+
+
+def test_header_with_full_width_payload_size():
+    size = 1 << 200
+    header = struct.pack(
+        tcrp.HEADER_FORMAT, 4, 2, 1, size.to_bytes(tcrp.PAYLOAD_SIZE_BYTE_SIZE, "big")
+    )
+    assert tcrp.unpack_header(header) == (4, 2, 1, size)
+
+
+def test_asyncio_server_answers_handshakes(chat_server):
+    chat = chat_server()
+    host = benchmark.request_room(chat.tcp_address, 1, "room", "host", ("127.0.0.1", 5000))
+    assert chat.server.rooms["room"].host_token == host["token"]
+    # 同名の部屋は作成できない
+    request = benchmark.encode_join_request(1, "room", "bob", ("127.0.0.1", 5001))
+    with socket.create_connection(chat.tcp_address) as conn:
+        conn.sendall(request)
+        _, operation, state, payload_size = tcrp.unpack_header(
+            tcrp.recv_exactly(conn, tcrp.HEADER_BYTE_SIZE)
+        )
+        response = json.loads(tcrp.recv_exactly(conn, payload_size))
+    assert (operation, state, response["status"]) == (1, 0, 400)
+
+
+def test_threaded_handshakes_do_not_wait_for_a_slow_client():
+    chat = server.Server(
+        tcp_address=("127.0.0.1", 0), udp_address=("127.0.0.1", 0), read_timeout=1.0
+    )
+    tcp_address = chat.tcp_socket.getsockname()
+    chat.tcp_socket.listen()
+
+    def accept_until_closed():
+        try:
+            chat._Server__hand_tcp_con()
+        except OSError:
+            # 待ち受けソケットを閉じたら終わる
+            pass
+
+    acceptor = threading.Thread(target=accept_until_closed, daemon=True)
+    acceptor.start()
+    try:
+        # ヘッダーの途中で止まるクライアント
+        slow = socket.create_connection(tcp_address)
+        slow.sendall(tcrp.pack_header(4, 1, 0, 10)[:10])
+        started_at = time.monotonic()
+        benchmark.request_room(tcp_address, 1, "room", "host", ("127.0.0.1", 5000))
+        assert time.monotonic() - started_at < 0.5
+        # 読み込み期限を過ぎたら切断される
+        slow.settimeout(5)
+        assert slow.recv(1) == b""
+        slow.close()
+    finally:
+        chat.tcp_socket.shutdown(socket.SHUT_RDWR)
+        chat.tcp_socket.close()
+        chat.udp_socket.close()
+        acceptor.join(5)
+
+
+def test_binary_join_handshake(chat_server):
+    chat = chat_server()
+    host_sock, host = join(chat, 1, "room", "host")
+    bob_sock, bob = join(chat, 2, "room", "bob", binary=True)
+    member = chat.server.sessions[bob["session_id"]]
+    assert member.token == bob["token"]
+    assert member.address == bob_sock.getsockname()
+    bob_sock.sendto(benchmark.build_datagram("room", bob, "hi", compact=True), chat.udp_address)
+    assert host_sock.recv(4096) == "bob: hi".encode()
+    host_sock.close()
+    bob_sock.close()
+
+
+def test_binary_join_to_a_missing_room_answers_in_binary(chat_server):
+    chat = chat_server()
+    request = benchmark.encode_join_request(2, "none", "bob", ("127.0.0.1", 5000), binary=True)
+    with socket.create_connection(chat.tcp_address) as conn:
+        conn.sendall(request)
+        _, _, state, payload_size = tcrp.unpack_header(
+            tcrp.recv_exactly(conn, tcrp.HEADER_BYTE_SIZE)
+        )
+        payload = tcrp.recv_exactly(conn, payload_size)
+    assert handshake.is_binary(payload)
+    response = handshake.unpack_join_response(payload)
+    assert (state, response["status"], response["token"]) == (0, 400, None)
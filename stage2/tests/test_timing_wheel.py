@@ -0,0 +1,76 @@
+import time
+
+import pytest
+
+import benchmark
+import timing_wheel
+from loopback import join
+
+
+@pytest.fixture
+def wheel(clock):
+    # 8スロット×3段(512tick先まで1周せずに保持する)
+    return timing_wheel.TimingWheel(tick=1.0, slots=8, levels=3, clock=clock)
+
+
+def test_expires_at_deadline(wheel):
+    wheel.touch("a", 5)
+    assert wheel.advance(4) == []
+    assert wheel.advance(5) == ["a"]
+    assert len(wheel) == 0
+
+
+def test_touch_extends_deadline(wheel, clock):
+    wheel.touch("a", 5)
+    clock.now = 3
+    wheel.advance()
+    wheel.touch("a", 5)
+    assert wheel.advance(7) == []
+    assert wheel.advance(8) == ["a"]
+
+
+def test_touch_shortens_deadline_once(wheel):
+    wheel.touch("a", 100)
+    wheel.touch("a", 3)
+    assert wheel.advance(3) == ["a"]
+    assert wheel.advance(200) == []
+
+
+def test_cancel(wheel):
+    wheel.touch("a", 2)
+    wheel.cancel("a")
+    assert wheel.advance(10) == []
+    assert len(wheel) == 0
+
+
+def test_cascades_from_upper_levels(wheel):
+    # 上の段に置かれ、期限が近づくと下の段へ振り分け直される
+    wheel.touch("b", 20)
+    wheel.touch("c", 300)
+    assert wheel.advance(19) == []
+    assert wheel.advance(20) == ["b"]
+    assert wheel.advance(299) == []
+    assert wheel.advance(300) == ["c"]
+
+
+def test_beyond_capacity_is_not_lost(wheel):
+    # tick * slots ** levels = 512秒より先の期限は置き直しながら待つ
+    wheel.touch("d", 1500)
+    assert wheel.advance(1499) == []
+    assert wheel.advance(1500) == ["d"]
+
+
+def test_idle_session_is_expired_by_the_server(chat_server):
+    server = chat_server(session_timeout=1)
+    host_sock, host = join(server, 1, "room", "host")
+    bob_sock, bob = join(server, 2, "room", "bob")
+    # ホストだけが発言し続ける
+    host_datagram = benchmark.build_datagram("room", host, "ping", compact=True)
+    deadline = time.monotonic() + 5
+    while server.server.sessions.get(bob["session_id"]) is not None:
+        assert time.monotonic() < deadline, "bob was not expired"
+        host_sock.sendto(host_datagram, server.udp_address)
+        time.sleep(0.2)
+    assert host["session_id"] in server.server.sessions
+    host_sock.close()
+    bob_sock.close()
@@ -0,0 +1,111 @@
+import asyncio
+import json
+import shutil
+import socket
+import tempfile
+
+import pytest
+
+import async_client
+import packet
+import workers
+
+
+def room_owned_by(worker_index, worker_count=2):
+    """指定したワーカーが担当する部屋名を探す"""
+    for i in range(1000):
+        room_name = f"room{i}"
+        if workers.owner_of_room(room_name.encode(), worker_count) == worker_index:
+            return room_name
+
+
+@pytest.fixture
+def run_dir():
+    # Unixソケットのパス長の上限に収まるよう短いディレクトリを使う
+    path = tempfile.mkdtemp(prefix="chat-test-")
+    yield path
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def start_worker(chat_server, run_dir, worker_index, **kwargs):
+    return chat_server(
+        server_class=workers.WorkerServer,
+        worker_index=worker_index,
+        worker_count=2,
+        run_dir=run_dir,
+        **kwargs,
+    )
+
+
+def test_datagrams_and_requests_reach_the_owning_worker(chat_server, run_dir):
+    first = start_worker(chat_server, run_dir, 0, require_mac=True)
+    second = start_worker(chat_server, run_dir, 1, require_mac=True)
+    room_name = room_owned_by(1)
+
+    async def main():
+        # どちらのワーカーも受け付けたリクエストを担当ワーカーへ中継する
+        client = await async_client.connect(first.tcp_address, first.udp_address)
+        host = await client.create_room(room_name, "host")
+        bob = await client.join_room(room_name, "bob")
+        assert bob.session_id % 2 == 1
+        # 共有ポートで担当外のワーカーに届いた場合と同じく、転送されて中継される
+        bob.udp_address = first.udp_address
+        await bob.send("hello")
+        event = await asyncio.wait_for(host.events.get(), 5)
+        await host.leave()
+        await client.close()
+        return event.text
+
+    assert asyncio.run(main()) == "bob: hello"
+    assert first.server.forwarded.value() >= 1
+    assert second.server.rooms.get(room_name) is None
+
+
+def test_unresponsive_worker_returns_error(chat_server, run_dir):
+    # 受け付けるが応答しないワーカー
+    stuck = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stuck.bind(f"{run_dir}/worker-1.tcrp.sock")
+    stuck.listen()
+    first = start_worker(chat_server, run_dir, 0, read_timeout=0.2)
+
+    async def main():
+        client = await async_client.connect(first.tcp_address, first.udp_address, timeout=3)
+        try:
+            payload = json.dumps({"token": ""}).encode()
+            (_, state, body), = await client.request(
+                async_client.JOIN_ROOM, room_owned_by(1), payload
+            )
+            listing = await client.list_rooms()
+        finally:
+            await client.close()
+        return state, json.loads(body), listing
+
+    try:
+        state, body, listing = asyncio.run(main())
+    finally:
+        stuck.close()
+    assert state == first.server.ERROR_RESPONSE
+    assert body["status"] == 500
+    assert listing["rooms"] == []
+
+
+def test_missing_worker_returns_error(chat_server, run_dir):
+    first = start_worker(chat_server, run_dir, 0)
+
+    async def main():
+        client = await async_client.connect(first.tcp_address, first.udp_address)
+        try:
+            await client.create_room(room_owned_by(1), "host")
+        finally:
+            await client.close()
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(main())
+
+
+def test_ipv6_sender_is_not_forwarded(chat_server, run_dir):
+    first = start_worker(chat_server, run_dir, 0)
+    datagram = packet.pack_compact(1, b"hello")
+    first.call(first.server.handle_datagram, datagram, ("::1", 9000, 0, 0))
+    assert first.server.metrics.drops.value("unsupported_address") == 1
+    assert first.server.forwarded.value() == 0
@@ -0,0 +1,101 @@
+import threading
+import time
+
+
+class TimingWheel:
+    """階層型タイミングホイール(単調時計基準)
+
+    touchはO(1)で期限を更新するだけで、ホイール上の位置は動かさない。
+    スロットの時刻になったときに実際の期限を確認し、まだ先なら置き直す。
+    期限切れのキーはadvanceでまとめて返す。
+    """
+
+    def __init__(self, tick=1.0, slots=64, levels=3, clock=time.monotonic):
+        """
+        :param tick: 1スロットの時間(秒)
+        :param slots: 1段あたりのスロット数
+        :param levels: 段数(tick * slots ** levels 秒先まで1周せずに保持できる)
+        :param clock: 現在時刻を返す関数
+        """
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.clock = clock
+        self.wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+        self.current_tick = int(clock() / tick)
+        # キー -> 期限(tick単位)
+        self.deadlines = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def touch(self, key, timeout):
+        """キーの期限を現在時刻からtimeout秒後にする
+
+        :param key: キー
+        :param timeout: タイムアウト(秒)
+        """
+        deadline = -int(-(self.clock() + timeout) // self.tick)
+        with self.lock:
+            previous = self.deadlines.get(key)
+            self.deadlines[key] = deadline
+            # 期限が延びただけならスロットの時刻に置き直されるので何もしない
+            if previous is None or deadline < previous:
+                self.__place(key, deadline)
+
+    def cancel(self, key):
+        """キーの期限を取り消す(スロットからは発火時に取り除かれる)
+
+        :param key: キー
+        """
+        with self.lock:
+            self.deadlines.pop(key, None)
+
+    def advance(self, now=None):
+        """現在時刻までホイールを進める
+
+        :param now: 現在時刻(省略時はclock())
+        :return: 期限切れになったキーのリスト
+        """
+        if now is None:
+            now = self.clock()
+        target = int(now / self.tick)
+        expired = []
+        with self.lock:
+            while self.current_tick < target:
+                self.current_tick += 1
+                # 上の段のスロットが回ってきたら下の段へ振り分け直す
+                for level in range(1, self.levels):
+                    unit = self.slots**level
+                    if self.current_tick % unit:
+                        break
+                    self.__fire(level, (self.current_tick // unit) % self.slots, expired)
+                self.__fire(0, self.current_tick % self.slots, expired)
+        return expired
+
+    def __fire(self, level, index, expired):
+        """スロットのキーを期限切れか置き直しに振り分ける(self.lockを保持して呼ぶ)"""
+        bucket = self.wheels[level][index]
+        if not bucket:
+            return
+        self.wheels[level][index] = set()
+        for key in bucket:
+            deadline = self.deadlines.get(key)
+            if deadline is None:
+                continue
+            if deadline <= self.current_tick:
+                del self.deadlines[key]
+                expired.append(key)
+            else:
+                self.__place(key, deadline)
+
+    def __place(self, key, deadline):
+        """期限に応じた段とスロットにキーを置く(self.lockを保持して呼ぶ)"""
+        deadline = max(deadline, self.current_tick + 1)
+        delta = deadline - self.current_tick
+        for level in range(self.levels):
+            if delta < self.slots ** (level + 1) or level == self.levels - 1:
+                unit = self.slots**level
+                self.wheels[level][(deadline // unit) % self.slots].add(key)
+                return
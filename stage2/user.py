@@ -1,21 +1,38 @@
 import socket
-import struct
 import threading
 
-class User:
-    TIMEOUT = 300
+import fragment
+import packet
+import reliable
 
-    def __init__(self, user_name):
+class User:
+    def __init__(self, user_name, reliable_mode=True, compress=True):
         self.RANDOM_PORT = 0
         self.udp_server_address = ("127.0.0.1", 9003)
         self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.udp_socket.bind(("127.0.0.1", self.RANDOM_PORT))
         self.user_name = user_name
         self.token = ""
+        # サーバーが割り当てたセッションID(あればコンパクト形式で送信する)
+        self.session_id = None
+        # データグラムにMACを付けるセッション鍵(入室後にトークンから導出する)
+        self.mac_key = None
         self.room_name = ""
         self.is_host = False
         self.address = self.udp_socket.getsockname()
-        self.timer = None
+        # 信頼モード(セッションIDがある場合のみ有効): 下りは連番で欠落を検出して再送要求し、
+        # 上りは1メッセージずつACKを待って再送する
+        self.reliable_mode = reliable_mode
+        self.receiver = reliable.ReliableReceiver(nack_interval=0.2)
+        self.client_sequence = 0
+        self.acked = threading.Event()
+        # 大きなメッセージを圧縮して送受信する(入室時にサーバーと取り決める)
+        self.compress = compress
+        # 1つのデータグラムに収まらないメッセージは断片に分けて送り、受信側で組み立てる
+        self.message_id = 0
+        self.reassembler = fragment.Reassembler()
+        self.ACK_TIMEOUT = 0.5
+        self.MAX_RETRIES = 10
         self.CREATE_ROOM = 1
         self.JOIN_ROOM = 2
         self.QUIT = 3
@@ -69,21 +86,56 @@ class User:
                 continue
             return self.room_name
         
-    def __generate_request(self, message):
+    def __generate_requests(self, message):
         """リクエスト情報の生成
 
         :param message: メッセージ
-        :return request: リクエスト情報
+        :return requests: リクエスト情報のリスト(断片に分けた場合は複数)
         """
-        header = struct.pack(
-            "!B B",
-            len(self.room_name.encode("utf-8")),
-            len(self.token.encode("utf-8")),
-        )
-        body = self.room_name + self.token + message
-        encoded_body = body.encode("utf-8")
-        request_info = header + encoded_body
-        return request_info
+        if self.session_id is not None:
+            return [
+                packet.pack_compact(self.session_id, payload, flags, self.mac_key)
+                for payload, flags in self.__encode_message(message)
+            ]
+        return [
+            packet.pack_legacy(
+                self.room_name.encode("utf-8"),
+                self.token.encode("utf-8"),
+                message.encode("utf-8"),
+            )
+        ]
+
+    def __encode_message(self, message):
+        """メッセージをエンコードし、大きければ圧縮するか断片に分ける
+
+        断片に分けるかは圧縮前の長さで決め、大きなメッセージは圧縮せずに断片に分ける
+        (サーバーは展開後の長さを受信バッファまでに制限し、断片は組み立てずに中継する)。
+
+        :param message: メッセージ
+        :return: [(メッセージまたは断片(byte), フラグ)]
+        """
+        encoded_message = message.encode("utf-8")
+        if len(encoded_message) <= packet.FRAGMENT_SIZE:
+            return [self.__compress_message(encoded_message)]
+        self.message_id += 1
+        return [
+            (fragment_data, packet.FLAG_FRAGMENT)
+            for fragment_data in packet.pack_fragments(encoded_message, self.message_id)
+        ]
+
+    def __compress_message(self, message):
+        """圧縮を取り決めていれば大きなメッセージを圧縮する
+
+        :param message: メッセージ(byte)
+        :return: (メッセージ, フラグ)
+        """
+        if self.compress:
+            return packet.compress_message(message)
+        return message, 0
+
+    def is_reliable(self):
+        """信頼モードで送受信するか"""
+        return self.reliable_mode and self.session_id is not None
 
     def send_message(self):
         """メッセージの送信"""
@@ -91,54 +143,115 @@ class User:
         while True:
             # メッセージの入力
             input_message = self.__input_text("")
-            self.__reset_timer()
-            request_info = self.__generate_request(input_message)
+            try:
+                if self.is_reliable() and "exit" != input_message:
+                    for payload, flags in self.__encode_message(input_message):
+                        if not self.__send_reliable(payload, flags):
+                            break
+                    continue
+                requests = self.__generate_requests(input_message)
+            except ValueError as e:
+                # 断片数の上限を超えるメッセージは送らない
+                print(e)
+                continue
             # メッセージを送信
-            # Todo メッセージのバイトサイズを超えた際の例外処理
-            self.udp_socket.sendto(request_info, self.udp_server_address)
+            for request_info in requests:
+                self.udp_socket.sendto(request_info, self.udp_server_address)
             if "exit" == input_message:
                 self.udp_socket.close()
                 exit()
 
+    def __send_reliable(self, payload, flags):
+        """ACKが届くまで再送する(同じ連番で送るのでサーバーは重複を中継しない)
+
+        :param payload: エンコード済みのメッセージまたは断片
+        :param flags: フラグ
+        :return: ACKが届いたか
+        """
+        self.client_sequence += 1
+        request_info = packet.pack_reliable(
+            self.session_id, self.client_sequence, payload, self.mac_key, flags
+        )
+        self.acked.clear()
+        for _ in range(self.MAX_RETRIES):
+            self.udp_socket.sendto(request_info, self.udp_server_address)
+            if self.acked.wait(self.ACK_TIMEOUT):
+                return True
+        print("メッセージを送信できませんでした")
+        return False
+
+    def __split_batch(self, data):
+        """サーバーが圧縮したりまとめたりして送ったデータグラムを元に戻す
+
+        :param data: 受信データ(タイムアウトした場合はNone)
+        :return: データグラムのリスト
+        """
+        if data is None:
+            return []
+        return packet.split_datagrams(data)
+
+    def __handle_sequenced(self, data):
+        """信頼モードの下りデータグラムを処理する
+
+        :param data: 受信データ
+        :return: 連番順に取り出せたメッセージ(byte)のリスト
+        """
+        _, kind, sequence, value = packet.SEQUENCED_HEADER.unpack_from(data)
+        if kind == packet.KIND_ACK:
+            if sequence == self.client_sequence:
+                self.acked.set()
+            # 自分のメッセージの連番は届かないので欠落として扱わない
+            delivered = self.receiver.skip(value)
+        else:
+            delivered = self.receiver.receive(data)
+        messages = []
+        for kind, session_id, message in delivered:
+            if kind == packet.KIND_FRAGMENT:
+                message = self.reassembler.add(session_id, message)
+                if message is None:
+                    continue
+            messages.append(message)
+        return messages
+
     def receive_message(self):
-        """メッセージの受信"""
+        """メッセージの受信
+
+        一定時間発言がない場合はサーバーが退出させ、本人にも退出メッセージが届く。
+        """
+        if self.is_reliable():
+            # 欠落があれば再送要求を送り直せるよう、受信を定期的に打ち切る
+            self.udp_socket.settimeout(self.receiver.nack_interval)
         while True:
             # メッセージを受信
-            data, _ = self.udp_socket.recvfrom(4096)
-            decoded_data = data.decode("utf-8")
-            print(decoded_data)
-            if (
-                f"ホストが退出したため、チャットルーム:{self.room_name}を終了します。" in decoded_data
-                or decoded_data == f"{self.user_name}が{self.room_name}から退出しました。"
-            ):
-                print("UDPソケットを閉じる")
-                self.__cancel_timer()
-                self.udp_socket.close()
-                exit()
-
-    def __reset_timer(self):
-        """タイムアウトのカウントをリセットする"""
-        self.start_timer()
-
-    def start_timer(self):
-        """タイマーを開始または再開する"""
-        if self.timer:
-            # 既存のタイマーがあればキャンセル
-            self.timer.cancel()
-        self.timer = threading.Timer(User.TIMEOUT, self.__timeout)
-        self.timer.start()
-
-    def __timeout(self):
-        """指定した時間が経過したときに実行される"""
-        print("Timed out!")
-        request_info = self.__generate_request("exit")
-
-        # メッセージを送信
-        # Todo メッセージのバイトサイズを超えた際の例外処理
-        self.udp_socket.sendto(request_info, self.udp_server_address)
-        self.udp_socket.close()
-        exit()
-
-    def __cancel_timer(self):
-        """タイマーを止める"""
-        self.timer.cancel()
+            try:
+                data, _ = self.udp_socket.recvfrom(4096)
+            except socket.timeout:
+                data = None
+            except OSError:
+                # 送信側がexitでソケットを閉じたら受信を終える
+                if self.udp_socket.fileno() == -1:
+                    return
+                raise
+            messages = []
+            for datagram in self.__split_batch(data):
+                if datagram[0] == packet.COMPACT_MARKER:
+                    messages.extend(self.__handle_sequenced(datagram))
+                else:
+                    messages.append(datagram)
+            if self.is_reliable():
+                ranges = self.receiver.missing_ranges()
+                if ranges:
+                    self.udp_socket.sendto(
+                        packet.pack_nack(self.session_id, ranges, self.mac_key),
+                        self.udp_server_address,
+                    )
+            for message in messages:
+                decoded_data = bytes(message).decode("utf-8")
+                print(decoded_data)
+                if (
+                    f"ホストが退出したため、チャットルーム:{self.room_name}を終了します" in decoded_data
+                    or decoded_data == f"{self.user_name}が{self.room_name}から退出しました"
+                ):
+                    print("UDPソケットを閉じる")
+                    self.udp_socket.close()
+                    exit()
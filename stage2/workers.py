@@ -0,0 +1,369 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import struct
+import sys
+import tempfile
+import zlib
+
+import async_server
+import logger as log_config
+import metrics
+import packet
+import tcrp
+
+logger = logging.getLogger("chat")
+
+# ワーカー間で転送するデータグラム: SourceIP(4) | SourcePort(2) | Datagram
+# 送信元はIPv4のアドレスだけを表せる(IPv6の送信元は転送せずに破棄する)
+FORWARD_HEADER = struct.Struct("!4s H")
+
+
+def owner_of_room(room_name, worker_count):
+    """チャットルームを担当するワーカー番号を求める
+
+    プロセスごとに値が変わるhash()ではなくCRC32を使い、全ワーカーで同じ結果にする。
+
+    :param room_name: チャットルーム名(byte)
+    :param worker_count: ワーカー数
+    :return: ワーカー番号
+    """
+    return zlib.crc32(room_name) % worker_count
+
+
+def list_limit(header, body, max_list_rooms):
+    """部屋一覧リクエストの最大件数を求める
+
+    :param header: リクエストヘッダー
+    :param body: リクエストボディ
+    :param max_list_rooms: 1回で返す件数の上限
+    :return: 最大件数
+    """
+    room_name_size, _, _, _ = tcrp.unpack_header(header)
+    request = body[room_name_size:]
+    limit = json.loads(request.decode("utf-8")).get("limit", 100) if request else 100
+    return max(1, min(int(limit), max_list_rooms))
+
+
+def merge_room_lists(responses, limit):
+    """複数のサーバーが返した部屋一覧を名前順に併合する
+
+    各サーバーが名前順にlimit件まで返すので、それらを併合して先頭limit件を返す。
+
+    :param responses: 部屋一覧のレスポンス(ヘッダー + ペイロード)のリスト
+    :param limit: 最大件数
+    :return: 併合した部屋一覧のペイロード
+    """
+    rooms = []
+    has_more = False
+    for response in responses:
+        payload = json.loads(response[tcrp.HEADER_BYTE_SIZE :].decode("utf-8"))
+        rooms.extend(payload.get("rooms", []))
+        has_more = has_more or payload.get("next") is not None
+    rooms.sort(key=lambda room: room["room_name"].encode("utf-8"))
+    has_more = has_more or len(rooms) > limit
+    rooms = rooms[:limit]
+    return json.dumps(
+        {
+            "status": 200,
+            "rooms": rooms,
+            "next": rooms[-1]["room_name"] if has_more and rooms else None,
+        }
+    ).encode("utf-8")
+
+
+class ForwardProtocol(asyncio.DatagramProtocol):
+    """ほかのワーカーから転送されたデータグラムを受け取るプロトコル"""
+
+    def __init__(self, worker):
+        self.worker = worker
+
+    def datagram_received(self, data, addr):
+        """転送元のアドレスを復元して担当ワーカーとして処理する
+
+        :param data: 転送データ
+        :param addr: 転送元ワーカーのソケット
+        """
+        try:
+            ip, port = FORWARD_HEADER.unpack_from(data)
+            self.worker.handle_forwarded_datagram(
+                memoryview(data)[FORWARD_HEADER.size :], (socket.inet_ntoa(ip), port)
+            )
+        except Exception as e:
+            self.worker.metrics.drops.inc(label="malformed")
+            logger.debug("Server Error3: %s", e)
+
+
+class WorkerServer(async_server.AsyncServer):
+    """SO_REUSEPORTで同じポートを共有するワーカープロセスのサーバー
+
+    チャットルームは部屋名のCRC32で1つのワーカーが担当する。
+    担当外のワーカーに届いたデータグラムとTCRPリクエストは、Unixソケットで担当ワーカーへ転送する。
+    部屋の作成は必ず担当ワーカーで行うため、部屋名は全ワーカーで一意になる。
+    """
+
+    def __init__(self, worker_index, worker_count, run_dir, **kwargs):
+        """
+        :param worker_index: ワーカー番号
+        :param worker_count: ワーカー数
+        :param run_dir: ワーカー間通信用のUnixソケットを置くディレクトリ
+        """
+        super().__init__(reuse_port=True, **kwargs)
+        self.worker_index = worker_index
+        self.worker_count = worker_count
+        self.forward_paths = [
+            os.path.join(run_dir, f"worker-{i}.udp.sock") for i in range(worker_count)
+        ]
+        self.tcrp_paths = [
+            os.path.join(run_dir, f"worker-{i}.tcrp.sock") for i in range(worker_count)
+        ]
+        # 転送キューが一杯のときは転送せずに捨てる(イベントループを止めない)
+        self.FORWARD_BUFFER_SIZE = 4 * 1024 * 1024
+        self.forward_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.forward_socket.setsockopt(
+            socket.SOL_SOCKET, socket.SO_SNDBUF, self.FORWARD_BUFFER_SIZE
+        )
+        self.forward_socket.setblocking(False)
+        self.forwarded = self.metrics.add(
+            metrics.Counter(
+                "chat_forwarded_datagrams_total", "datagrams forwarded to the owning worker"
+            )
+        )
+
+    def owns_room(self, room_name):
+        """このワーカーが担当するチャットルームか(ログから復元する部屋を選ぶ)
+
+        :param room_name: チャットルーム名
+        :return: 担当するか
+        """
+        return owner_of_room(room_name.encode("utf-8"), self.worker_count) == self.worker_index
+
+    def next_session_id(self):
+        """担当ワーカーを求められるセッションIDを割り当てる
+
+        セッションIDをワーカー数で割った余りがワーカー番号になる。
+
+        :return: セッションID
+        """
+        sequence = next(self.session_ids) % (packet.MAX_SESSION_ID // self.worker_count)
+        return sequence * self.worker_count + self.worker_index
+
+    def is_remote_session(self, session_id):
+        """ほかのワーカーが担当するセッションか(MACは転送先の担当ワーカーで確認する)
+
+        :param session_id: セッションID
+        :return: ほかのワーカーが担当するか
+        """
+        return session_id % self.worker_count != self.worker_index
+
+    def owner_of_datagram(self, view):
+        """データグラムを担当するワーカー番号を求める
+
+        :param view: 受信データ(memoryview)
+        :return: ワーカー番号
+        """
+        if view[0] == packet.COMPACT_MARKER:
+            _, _, session_id = packet.COMPACT_HEADER.unpack_from(view)
+            return session_id % self.worker_count
+        room_name_size = view[0]
+        header_size = packet.LEGACY_HEADER.size
+        return owner_of_room(view[header_size : header_size + room_name_size], self.worker_count)
+
+    def handle_datagram(self, data, address):
+        """担当ワーカーならそのまま処理し、そうでなければ担当ワーカーへ転送する
+
+        :param data: 受信データ
+        :param address: 送信元アドレス
+        """
+        view = memoryview(data)
+        owner = self.owner_of_datagram(view)
+        if owner == self.worker_index:
+            self.handle_owned_datagram(view, address)
+            return
+        try:
+            source_ip = socket.inet_pton(socket.AF_INET, address[0])
+        except OSError:
+            self.metrics.drops.inc(label="unsupported_address")
+            return
+        forward = FORWARD_HEADER.pack(source_ip, address[1]) + view
+        try:
+            self.forward_socket.sendto(forward, self.forward_paths[owner])
+            self.forwarded.inc()
+        except (BlockingIOError, FileNotFoundError, ConnectionRefusedError):
+            self.metrics.drops.inc(label="forward_failed")
+
+    def handle_forwarded_datagram(self, data, address):
+        """ほかのワーカーから転送されたデータグラムのMACを確認してから処理する
+
+        :param data: 受信データ(memoryview)
+        :param address: 元の送信元アドレス
+        """
+        if not self.verify(data, address):
+            self.metrics.drops.inc(label="bad_mac")
+            return
+        self.handle_owned_datagram(data, address)
+
+    def handle_owned_datagram(self, data, address):
+        """担当しているチャットルームのデータグラムを処理する
+
+        :param data: 受信データ
+        :param address: 送信元アドレス
+        """
+        super().handle_datagram(data, address)
+
+    async def process_tcrp_request(self, header, body):
+        """担当ワーカーならそのまま処理し、そうでなければ担当ワーカーに中継する
+
+        :param header: リクエストヘッダー
+        :param body: リクエストボディ
+        :return: レスポンス
+        """
+        room_name_size, operation, _, _ = tcrp.unpack_header(header)
+        if operation == self.LIST_ROOMS:
+            return await self.list_all_rooms(header, body)
+        owner = owner_of_room(body[:room_name_size], self.worker_count)
+        if owner == self.worker_index:
+            return self.handle_tcrp_request(header, body)
+        try:
+            return await self.request_worker(owner, header, body)
+        except (OSError, asyncio.TimeoutError) as e:
+            room_name = bytes(body[:room_name_size]).decode("utf-8", "replace")
+            logger.warning("Worker %d unavailable: %r", owner, e)
+            return self.build_state_res(room_name, operation, self.ERROR_RESPONSE)
+
+    async def request_worker(self, worker_index, header, body):
+        """ほかのワーカーにTCRPリクエストを中継する
+
+        接続・レスポンスの受信はread_timeout秒で打ち切る(応答しないワーカーで待ち続けない)。
+
+        :param worker_index: 中継先のワーカー番号
+        :return: レスポンス
+        """
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_unix_connection(self.tcrp_paths[worker_index]), self.read_timeout
+        )
+        try:
+            writer.write(header + body)
+            await asyncio.wait_for(writer.drain(), self.read_timeout)
+            # 担当ワーカーはレスポンスを書き終えると接続を閉じる
+            return await asyncio.wait_for(reader.read(), self.read_timeout)
+        finally:
+            writer.close()
+
+    async def list_all_rooms(self, header, body):
+        """全ワーカーのチャットルーム一覧を名前順にまとめて返す(応答のないワーカーは除く)
+
+        :return: レスポンス
+        """
+        results = await asyncio.gather(
+            *(
+                self.request_worker(i, header, body)
+                for i in range(self.worker_count)
+                if i != self.worker_index
+            ),
+            return_exceptions=True,
+        )
+        responses = [self.handle_tcrp_request(header, body)]
+        for result in results:
+            if isinstance(result, bytes):
+                responses.append(result)
+            else:
+                logger.warning("Worker unavailable: %r", result)
+        res_payload = merge_room_lists(responses, list_limit(header, body, self.MAX_LIST_ROOMS))
+        return (
+            tcrp.pack_header(0, self.LIST_ROOMS, self.REQUEST_COMPLETION, len(res_payload))
+            + res_payload
+        )
+
+    async def handle_forwarded_conn(self, reader, writer):
+        """ほかのワーカーから中継されたTCRPリクエストをこのワーカーで処理する
+
+        :param reader: StreamReader
+        :param writer: StreamWriter
+        """
+        try:
+            header, body = await asyncio.wait_for(self.read_request(reader), self.read_timeout)
+            writer.write(self.handle_tcrp_request(header, body))
+            await asyncio.wait_for(writer.drain(), self.read_timeout)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, OSError, ValueError) as e:
+            logger.warning("Server Error1: %r", e)
+        finally:
+            writer.close()
+
+    async def serve(self):
+        """ワーカー間通信用のUnixソケットを登録してから待機する"""
+        loop = asyncio.get_running_loop()
+        forward_path = self.forward_paths[self.worker_index]
+        receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        receiver.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.FORWARD_BUFFER_SIZE)
+        receiver.bind(forward_path)
+        forward_transport, _ = await loop.create_datagram_endpoint(
+            lambda: ForwardProtocol(self), sock=receiver
+        )
+        tcrp_server = await asyncio.start_unix_server(
+            self.handle_forwarded_conn, path=self.tcrp_paths[self.worker_index]
+        )
+        try:
+            await super().serve()
+        finally:
+            tcrp_server.close()
+            forward_transport.close()
+            self.forward_socket.close()
+
+
+def run_worker(worker_index, worker_count, run_dir, log_level, server_kwargs):
+    """ワーカープロセスの処理
+
+    メトリクスのポートはワーカー番号だけずらす(metrics_address指定時)。
+
+    :param worker_index: ワーカー番号
+    :param worker_count: ワーカー数
+    :param run_dir: ワーカー間通信用のディレクトリ
+    :param log_level: ログレベル
+    :param server_kwargs: Serverに渡す設定
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # 親プロセスのログ出力スレッドは引き継がれないので設定し直す
+    log_config.setup_logging(log_level)
+    metrics_address = server_kwargs.get("metrics_address")
+    if metrics_address is not None:
+        host, port = metrics_address
+        server_kwargs = dict(server_kwargs, metrics_address=(host, port + worker_index))
+    WorkerServer(worker_index, worker_count, run_dir, **server_kwargs).start()
+
+
+def run_workers(worker_count, log_level="info", **server_kwargs):
+    """ワーカープロセスを起動し、終了するまで待つ
+
+    :param worker_count: ワーカー数
+    :param log_level: ログレベル
+    :param server_kwargs: Serverに渡す設定
+    """
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise RuntimeError("SO_REUSEPORT is not supported on this platform")
+
+    run_dir = tempfile.mkdtemp(prefix="chat-workers-")
+    processes = [
+        multiprocessing.Process(
+            target=run_worker, args=(i, worker_count, run_dir, log_level, server_kwargs)
+        )
+        for i in range(worker_count)
+    ]
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        for process in processes:
+            process.start()
+        logger.info("Started %d workers", worker_count)
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        shutil.rmtree(run_dir, ignore_errors=True)